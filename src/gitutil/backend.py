@@ -0,0 +1,591 @@
+"""
+backend.py: how the git commands of a script (Add, Commit, Branch,
+Checkout) are carried out.
+
+Commands do their git work through their session's backend:
+
+* SubprocessBackend (the default) uses GitPython, so `git add` and
+  `git checkout` each start a git process.
+* PlumbingBackend does the same work in this process. It writes loose
+  objects, the index (version 2) and ref files directly into .git. Anything
+  it does not reproduce exactly is handed to a SubprocessBackend: ignore
+  and attribute rules, conflicted or split indexes, nested repositories,
+  and checkouts over local changes.
+
+    session = GitSession(backend=PlumbingBackend)
+    session.run_script('lesson.gcs')
+"""
+import bisect
+import hashlib
+import os
+import re
+import stat
+import time
+from os import path
+
+from git import Actor, Commit, Head
+from git.objects.util import altz_to_utctz_str, parse_date
+
+from gitutil.git_fs import GitIndex, IndexTable
+from gitutil.gitobjs import GitBranch, GitObjects
+
+ZERO_SHA1 = '0' * 40
+MODE_FILE = 0o100644
+MODE_EXECUTABLE = 0o100755
+MODE_SYMLINK = 0o120000
+MODE_GITLINK = 0o160000
+MODE_TREE = 0o40000
+ASSUME_VALID = 0x8000
+RULE_FILES = ('.gitignore', '.gitattributes')
+# What git check-ref-format rejects, roughly
+BAD_REF_NAME = re.compile(r'(^|/)\.|\.\.|[\x00-\x20\x7f~^:?*\[\\]|@\{|//|'
+                          r'\.lock(/|$)|[/.]$|^-|^@$|^$')
+
+
+class Backend:
+    """ The git operations a script's commands need """
+
+    def __init__(self, session):
+        self.session = session
+
+    def add(self, files):
+        raise NotImplementedError()
+
+    def commit(self, message):
+        """ Commit the index on HEAD; return the new git.Commit """
+        raise NotImplementedError()
+
+    def branch(self, branch_name):
+        """ Create branch branch_name at HEAD; return its git.Head """
+        raise NotImplementedError()
+
+    def checkout(self, branch_name):
+        raise NotImplementedError()
+
+
+class SubprocessBackend(Backend):
+    """ GitPython: repo.git (a git process per call) and repo.index """
+
+    def add(self, files):
+        return self.session.git.add(files)
+
+    def commit(self, message):
+        return self.session.repo().index.commit(message)
+
+    def branch(self, branch_name):
+        return self.session.repo().create_head(branch_name)
+
+    def checkout(self, branch_name):
+        for head in self.session.repo().heads:
+            if head.name == branch_name:
+                return head.checkout()
+
+
+class PlumbingBackend(Backend):
+    """
+    Writes blobs, trees, commits, refs and the index itself. The index is
+    read once and kept in memory as a dictionary of path -> entry (the ten
+    stat fields of IndexTable then the raw sha1). It is read again only if
+    something else rewrites .git/index.
+    """
+    ENTRY = GitIndex.ENTRY
+    HEADER = GitIndex.HEADER
+
+    def __init__(self, session):
+        super().__init__(session)
+        self.fallback = SubprocessBackend(session)
+        self.gitdir = path.join(session.dir(), '.git')
+        self.objects = GitObjects(self.gitdir)
+        self._entries = None
+        self._index_key = None     # (inode, mtime, size) of the index we hold
+        self._index_mtime = 0      # entries changed since then may be racy
+        self._plain = None
+        self._actors = {}
+
+    # ---- index ------------------------------------------------------------
+
+    @property
+    def index_file(self):
+        return path.join(self.gitdir, 'index')
+
+    def index_key(self):
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def entries(self):
+        """ The index as path -> entry, or None if it uses something this
+            backend does not write (conflicts, assume-valid or extended
+            flags, a split or sparse index)
+        """
+        key = self.index_key()
+        if self._entries is not None and key == self._index_key:
+            return self._entries
+        self._entries = None
+        entries = {}
+        if key is not None:
+            with open(self.index_file, 'rb') as f:
+                index = GitIndex(f.read())
+            if b'link' in index.extension_offsets or b'sdir' in index.extension_offsets:
+                return None
+            t = index.table
+            columns = [getattr(t, field) for field in IndexTable.STAT_FIELDS]
+            for i, p in enumerate(t.paths):
+                if t.stage(i) or t.extended_flags[i] or t.flags[i] & ASSUME_VALID:
+                    return None
+                entries[p] = tuple(c[i] for c in columns) + (bytes(t.sha1s[20 * i:20 * i + 20]),)
+        self._entries = entries
+        self._index_key = key
+        self._index_mtime = key[1] if key is not None else 0
+        return entries
+
+    def write_index(self, entries):
+        """ Write entries as a version 2 index (without extensions) """
+        out = [self.HEADER.pack(b'DIRC', 2, len(entries))]
+        for raw, p in sorted((p.encode('utf-8', 'surrogateescape'), p) for p in entries):
+            e = entries[p]
+            out.append(self.ENTRY.pack(*(v & 0xffffffff for v in e[:10]), e[10],
+                                       min(len(raw), GitIndex.NAME_MASK)))
+            out.append(raw)
+            # NUL padded (by 1 to 8 bytes) to a multiple of 8 bytes
+            out.append(b'\0' * (8 - (self.ENTRY.size + len(raw)) % 8))
+        data = b''.join(out)
+        data += hashlib.sha1(data).digest()
+        self.write_locked(self.index_file, data)
+        self._entries = entries
+        self._index_key = self.index_key()
+        self._index_mtime = self._index_key[1]
+
+    def stat_entry(self, st, mode, sha1):
+        return (st.st_ctime_ns // 1000000000, st.st_ctime_ns % 1000000000,
+                st.st_mtime_ns // 1000000000, st.st_mtime_ns % 1000000000,
+                st.st_dev, st.st_ino, mode, st.st_uid, st.st_gid, st.st_size, sha1)
+
+    def same_stat(self, entry, st):
+        """ True if st is what entry recorded and the file cannot have been
+            changed since within the index's timestamp granularity
+        """
+        if entry is None:
+            return False
+        mtime = entry[2] * 1000000000 + entry[3]
+        return (mtime == st.st_mtime_ns and mtime < self._index_mtime and
+                entry[5] == st.st_ino & 0xffffffff and
+                entry[9] == st.st_size & 0xffffffff)
+
+    # ---- the work tree ----------------------------------------------------
+
+    def worktree_path(self, rel):
+        return path.join(self.session.dir(), *rel.split('/'))
+
+    def read_file(self, rel, st):
+        """ (mode, blob contents) of a work tree file, or None if it is not
+            a regular file or symlink
+        """
+        full = self.worktree_path(rel)
+        if stat.S_ISLNK(st.st_mode):
+            return MODE_SYMLINK, os.fsencode(os.readlink(full))
+        if stat.S_ISREG(st.st_mode):
+            with open(full, 'rb') as f:
+                data = f.read()
+            return (MODE_EXECUTABLE if st.st_mode & 0o100 else MODE_FILE), data
+        return None
+
+    def stage_file(self, entries, rel, st):
+        """ The index entry for work tree file rel, writing its blob. None if
+            it is not something this backend can add.
+        """
+        old = entries.get(rel)
+        mode = (MODE_SYMLINK if stat.S_ISLNK(st.st_mode) else
+                MODE_EXECUTABLE if st.st_mode & 0o100 else MODE_FILE)
+        if self.same_stat(old, st) and old[6] == mode:
+            return old
+        contents = self.read_file(rel, st)
+        if contents is None:
+            return None
+        mode, data = contents
+        sha1 = self.objects.write_object('blob', data)
+        return self.stat_entry(st, mode, bytes.fromhex(sha1))
+
+    def is_clean(self, rel, entry):
+        """ True if the work tree file rel matches its index entry """
+        try:
+            st = os.lstat(self.worktree_path(rel))
+        except FileNotFoundError:
+            return False
+        if self.same_stat(entry, st):
+            return True
+        contents = self.read_file(rel, st)
+        if contents is None or contents[0] != entry[6]:
+            return False
+        data = contents[1]
+        return hashlib.sha1(b'blob %d\0' % len(data) + data).digest() == entry[10]
+
+    def plain(self):
+        """ True unless the repository is set up so that git would not add
+            files as they are or check them out byte for byte (excludes,
+            attributes, line ending conversion, core.filemode off, ...)
+        """
+        if self._plain is None:
+            self._plain = self.read_plain()
+        return self._plain
+
+    def read_plain(self):
+        for name in ('exclude', 'attributes'):
+            try:
+                with open(path.join(self.gitdir, 'info', name)) as f:
+                    if any(line.strip() and not line.startswith('#') for line in f):
+                        return False
+            except FileNotFoundError:
+                pass
+        config = self.session.repo().config_reader()
+        if (config.get_value('core', 'excludesfile', '') or
+                config.get_value('core', 'attributesfile', '') or
+                str(config.get_value('core', 'autocrlf', 'false')).lower() != 'false' or
+                str(config.get_value('core', 'filemode', 'true')).lower() != 'true' or
+                str(config.get_value('core', 'symlinks', 'true')).lower() != 'true' or
+                config.get_value('core', 'sparsecheckout', False) or
+                config.get_value('core', 'splitindex', False)):
+            return False
+        home = os.environ.get('XDG_CONFIG_HOME') or path.join(path.expanduser('~'), '.config')
+        return not any(path.exists(path.join(home, 'git', name))
+                       for name in ('ignore', 'attributes'))
+
+    def has_rules(self, rel):
+        """ True if a .gitignore or .gitattributes applies under rel """
+        directory = self.session.dir()
+        parts = rel.split('/') if rel else []
+        for i in range(len(parts) + 1):
+            d = path.join(directory, *parts[:i])
+            if any(path.lexists(path.join(d, name)) for name in RULE_FILES):
+                return True
+        return False
+
+    def walk(self, rel):
+        """ The (path, lstat) of every file under directory rel, or None if
+            it holds something git treats specially (rules, repositories)
+        """
+        top = self.worktree_path(rel)
+        files = []
+        for root, dirs, names in os.walk(top):
+            if root == self.session.dir():
+                if '.git' in dirs:
+                    dirs.remove('.git')
+            elif '.git' in dirs or '.git' in names:
+                return None
+            if root != top and any(name in names for name in RULE_FILES):
+                return None
+            prefix = path.relpath(root, self.session.dir()).replace(path.sep, '/')
+            prefix = '' if prefix == '.' else prefix + '/'
+            for name in dirs[:]:
+                if path.islink(path.join(root, name)):
+                    dirs.remove(name)   # a symlink to a directory is a file
+                    names.append(name)
+            for name in names:
+                files.append((prefix + name, os.lstat(path.join(root, name))))
+        return files
+
+    # ---- objects and refs -------------------------------------------------
+
+    def write_locked(self, filename, data):
+        """ Replace filename with data through filename.lock, as git does """
+        lock = filename + '.lock'
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        try:
+            f = open(lock, 'xb')
+        except FileExistsError:
+            raise RuntimeError('{} is locked (by {})'.format(filename, lock))
+        try:
+            with f:
+                f.write(data)
+            os.replace(lock, filename)
+        except BaseException:
+            if path.exists(lock):
+                os.remove(lock)
+            raise
+
+    def ref_sha1(self, name):
+        """ The sha1 of ref name (refs/heads/...), or None """
+        try:
+            with open(path.join(self.gitdir, *name.split('/'))) as f:
+                value = f.read().strip()
+            if value:
+                return value
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            pass
+        try:
+            with open(path.join(self.gitdir, 'packed-refs')) as f:
+                for line in f:
+                    if line.rstrip('\n').endswith(' ' + name) and not line.startswith('#'):
+                        return line.split(' ', 1)[0]
+        except FileNotFoundError:
+            pass
+        return None
+
+    def head(self):
+        """ (the ref HEAD points at or None if detached, its sha1 or None) """
+        with open(path.join(self.gitdir, 'HEAD')) as f:
+            value = f.read().strip()
+        if value.startswith('ref: '):
+            return value[5:], self.ref_sha1(value[5:])
+        return None, value
+
+    def signature(self, role):
+        """ 'Name <email> time zone' for role 'author' or 'committer', the
+            way GitPython's index.commit makes it (the name and email are
+            looked up once per backend)
+        """
+        actor = self._actors.get(role)
+        if actor is None:
+            config = self.session.repo().config_reader()
+            actor = Actor.author(config) if role == 'author' else Actor.committer(config)
+            self._actors[role] = actor
+        date = os.environ.get('GIT_{}_DATE'.format(role.upper()))
+        if date:
+            when, offset = parse_date(date)
+        else:
+            when = int(time.time())
+            offset = time.altzone if time.localtime(when).tm_isdst > 0 else time.timezone
+        return '{} <{}> {} {}'.format(actor.name, actor.email, when,
+                                      altz_to_utctz_str(offset))
+
+    def update_ref(self, name, old, new, message):
+        """ Point ref name (or 'HEAD' if detached) at new, with a reflog entry
+            for it and for HEAD if HEAD is on it
+        """
+        target = path.join(self.gitdir, *name.split('/'))
+        self.write_locked(target, (new + '\n').encode('ascii'))
+        line = '{} {} {}\t{}\n'.format(old or ZERO_SHA1, new,
+                                       self.signature('committer'), message)
+        logs = [name]
+        if name != 'HEAD' and self.head()[0] == name:
+            logs.append('HEAD')
+        for log in logs:
+            self.append_reflog(log, line)
+
+    def append_reflog(self, name, line):
+        filename = path.join(self.gitdir, 'logs', *name.split('/'))
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        with open(filename, 'a') as f:
+            f.write(line)
+
+    def write_tree(self, entries):
+        """ Write the trees for index entries; return the root tree's sha1 """
+        root = {}
+        for p, e in entries.items():
+            parts = p.split('/')
+            node = root
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = (e[6], e[10])
+        return self.write_tree_node(root)
+
+    def write_tree_node(self, node):
+        items = []
+        for name, value in node.items():
+            raw = name.encode('utf-8', 'surrogateescape')
+            if isinstance(value, dict):
+                sha1 = bytes.fromhex(self.write_tree_node(value))
+                # Trees sort as if their names ended in '/'
+                items.append((raw + b'/', b'%o %s\0%s' % (MODE_TREE, raw, sha1)))
+            else:
+                mode, sha1 = value
+                items.append((raw, b'%o %s\0%s' % (mode, raw, sha1)))
+        items.sort()
+        return self.objects.write_object('tree', b''.join(i[1] for i in items))
+
+    def tree_files(self, sha1, prefix=''):
+        """ path -> (mode, raw sha1) of every file in a tree """
+        files = {}
+        for mode, name, entry in self.objects[sha1]:
+            mode = int(mode, 8)
+            if mode == MODE_TREE:
+                files.update(self.tree_files(entry, prefix + name + '/'))
+            else:
+                files[prefix + name] = (mode, bytes.fromhex(entry))
+        return files
+
+    # ---- the commands -----------------------------------------------------
+
+    def add(self, files):
+        entries = self.entries()
+        staged = None
+        if entries is not None and self.plain():
+            staged = self.stage(dict(entries), files)
+        if staged is None:
+            self._entries = None
+            return self.fallback.add(files)
+        self.write_index(staged)
+
+    def stage(self, entries, files):
+        """ entries updated as `git add files` would; None if that needs git """
+        work = self.session.dir()
+        keys = sorted(entries)
+        for f in files:
+            rel = path.relpath(path.normpath(path.join(work, f)), work).replace(path.sep, '/')
+            if rel == '.':
+                rel = ''
+            if rel == '..' or rel.startswith('../') or rel.split('/')[0] == '.git':
+                return None
+            if self.has_rules(rel):
+                return None
+            full = self.worktree_path(rel)
+            prefix = rel + '/' if rel else ''
+            under = keys[bisect.bisect_left(keys, prefix):]
+            under = under[:bisect.bisect_left(under, prefix + '\U0010ffff')] if prefix else under
+            if path.isdir(full) and not path.islink(full):
+                found = self.walk(rel)
+                if found is None:
+                    return None
+                seen = set()
+                for p, st in found:
+                    if not self.stage_one(entries, p, st):
+                        return None
+                    seen.add(p)
+                for p in under:   # files deleted from the directory
+                    if p not in seen:
+                        entries.pop(p, None)
+            elif path.lexists(full):
+                if not self.stage_one(entries, rel, os.lstat(full)):
+                    return None
+                for p in under:   # it used to be a directory
+                    entries.pop(p, None)
+            elif rel in entries or under:
+                entries.pop(rel, None)
+                for p in under:
+                    entries.pop(p, None)
+            else:
+                return None   # git reports the pathspec that matched nothing
+            keys = sorted(entries)
+        return entries
+
+    def stage_one(self, entries, rel, st):
+        entry = self.stage_file(entries, rel, st)
+        if entry is None:
+            return False
+        entries[rel] = entry
+        parts = rel.split('/')
+        for i in range(1, len(parts)):   # a file where a directory now is
+            entries.pop('/'.join(parts[:i]), None)
+        return True
+
+    def commit(self, message):
+        """ Commit the index on HEAD; return the new git.Commit """
+        entries = self.entries()
+        if entries is None:
+            self._entries = None
+            return self.fallback.commit(message)
+        tree = self.write_tree(entries)
+        ref, parent = self.head()
+        lines = ['tree ' + tree]
+        if parent:
+            lines.append('parent ' + parent)
+        lines.append('author ' + self.signature('author'))
+        lines.append('committer ' + self.signature('committer'))
+        body = '\n'.join(lines) + '\n\n' + message
+        sha1 = self.objects.write_object('commit', body.encode('utf-8'))
+        subject = message.split('\n', 1)[0]
+        self.update_ref(ref or 'HEAD', parent, sha1, 'commit{}: {}'.format(
+            '' if parent else ' (initial)', subject))
+        # (read lazily by GitPython, so no git process is started here)
+        return Commit(self.session.repo(), bytes.fromhex(sha1))
+
+    def branch(self, branch_name):
+        """ Create branch branch_name at HEAD; return its git.Head """
+        name = GitBranch.PREFIX + branch_name
+        if BAD_REF_NAME.search(branch_name):
+            raise ValueError('Invalid branch name: {!r}'.format(branch_name))
+        sha1 = self.head()[1]
+        if sha1 is None:
+            raise ValueError('Cannot create branch {}: HEAD has no commits yet'
+                             .format(branch_name))
+        existing = self.ref_sha1(name)
+        if existing is not None and existing != sha1:
+            raise ValueError('Branch {} already exists'.format(branch_name))
+        if existing is None:
+            self.update_ref(name, None, sha1, 'branch: Created from HEAD')
+        return Head(self.session.repo(), name)
+
+    def checkout(self, branch_name):
+        """ Switch HEAD, the index and the work tree to branch branch_name (if
+            there is such a branch). Local changes are left to git.
+        """
+        name = GitBranch.PREFIX + branch_name
+        target = self.ref_sha1(name)
+        if target is None:
+            return
+        ref, head = self.head()
+        if ref == name:
+            return
+        entries = self.entries()
+        new_entries = None
+        if entries is not None and head is not None and self.plain():
+            new_entries = self.switch(entries, self.tree_files(self.objects[head].tree),
+                                      self.tree_files(self.objects[target].tree))
+        if new_entries is None:
+            self._entries = None
+            return self.fallback.checkout(branch_name)
+        self.write_index(new_entries)
+        self.write_locked(path.join(self.gitdir, 'HEAD'),
+                          ('ref: ' + name + '\n').encode('utf-8'))
+        self.append_reflog('HEAD', '{} {} {}\tcheckout: moving from {} to {}\n'.format(
+            head, target, self.signature('committer'),
+            ref[len(GitBranch.PREFIX):] if ref else head, branch_name))
+
+    def switch(self, entries, old, new):
+        """ Make the work tree go from tree files old to new; return the new
+            index entries, or None if git should do it (there are staged or
+            local changes, untracked files in the way, submodules)
+        """
+        if len(entries) != len(old) or any(
+                old.get(p) != (e[6], e[10]) for p, e in entries.items()):
+            return None
+        changed = sorted(p for p in set(old) | set(new) if old.get(p) != new.get(p))
+        for p in changed:
+            if MODE_GITLINK in (old.get(p, (0,))[0], new.get(p, (0,))[0]):
+                return None
+            if p in old:
+                if not self.is_clean(p, entries[p]):
+                    return None
+            elif path.lexists(self.worktree_path(p)):
+                return None
+            parts = p.split('/')
+            for i in range(1, len(parts)):
+                d = '/'.join(parts[:i])
+                if d not in old and path.lexists(self.worktree_path(d)) and \
+                        not path.isdir(self.worktree_path(d)):
+                    return None   # an untracked file where a directory goes
+        entries = dict(entries)
+        for p in changed:
+            if p in old:
+                os.remove(self.worktree_path(p))
+                del entries[p]
+                self.remove_empty_dirs(p)
+        for p in changed:
+            if p in new:
+                entries[p] = self.write_worktree_file(p, *new[p])
+        return entries
+
+    def remove_empty_dirs(self, rel):
+        parts = rel.split('/')[:-1]
+        while parts:
+            try:
+                os.rmdir(self.worktree_path('/'.join(parts)))
+            except OSError:
+                return
+            parts.pop()
+
+    def write_worktree_file(self, rel, mode, sha1):
+        """ Check out a blob to rel; return its index entry """
+        full = self.worktree_path(rel)
+        os.makedirs(path.dirname(full), exist_ok=True)
+        data = self.objects.read_body(sha1.hex())
+        if mode == MODE_SYMLINK:
+            os.symlink(os.fsdecode(data), full)
+        else:
+            fd = os.open(full, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o777 if mode == MODE_EXECUTABLE else 0o666)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        return self.stat_entry(os.lstat(full), mode, sha1)
@@ -1,5 +1,6 @@
 from os.path import join
 import os
+import re
 import sys
 import string
 
@@ -29,7 +30,7 @@ class Add(Command):
         Execute git add files on a running session
         :return:
         """
-        return self.session.git.add(self.files)
+        return self.session.backend.add(self.files)
 
     def __str__(self):
         return "<Add {}>".format(self.files)
@@ -51,7 +52,7 @@ class Commit(Command):
             self.message = "commit {}".format(self.number)
 
     def execute(self):
-        return self.session.repo().index.commit(self.message)
+        return self.session.backend.commit(self.message)
 
     def __str__(self):
         return "<Commit {}: \"{}\">".format(self.number, self.message)
@@ -73,7 +74,7 @@ class Branch(Command):
             self.branch_name = 'branch{}'.format(Branch._number)
 
     def execute(self):
-        return self.session.repo().create_head(self.branch_name)
+        return self.session.backend.branch(self.branch_name)
 
     def __str__(self):
         return "<Branch {}>".format(self.branch_name)
@@ -88,10 +89,7 @@ class Checkout(Command):
         self.branch_name = branch_name
 
     def execute(self):
-        heads = self.session.repo().heads
-        for head in heads:
-            if head.name == self.branch_name:
-                head.checkout()
+        return self.session.backend.checkout(self.branch_name)
 
 
 class CreateFile(Command):
@@ -279,78 +277,291 @@ class ReadFileLines(Command):
         return lines
 
 
+class BatchExecutor:
+    """
+    Runs a list of Commands with the same effect as calling execute() on
+    each in turn, but with less work:
+
+    * file edits are buffered per file: touch empties a file's buffer and
+      appends add to it; each file is written once, before the next
+      command that is not itself an edit (an Add, mkdir, Checkout, ...)
+      runs, so errors come from the same command as they would unbatched
+    * a run of adjacent Adds becomes a single add of all their files (one
+      `git add` rather than one per command), so git still applies its
+      ignore rules and attributes as usual
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.edits = {}      # path -> [truncate?, text to append]
+        self.to_add = []     # files from the current run of Adds
+
+    def run(self, commands):
+        for c in commands:
+            self.execute(c)
+        self.flush()
+
+    def execute(self, command):
+        tp = type(command)
+        if tp is Add:
+            self.flush_edits()
+            self.to_add.extend(command.files or [])
+            return
+        self.flush_adds()
+        if tp is CreateFile:
+            self.edits[self.path(command.path)] = [True, []]
+        elif tp is AppendLineToFile:
+            self.edit(command.file).append(command.line + '\n')
+        elif tp is AppendLinesToFile:
+            self.edit(command.file).append('\n'.join(command.lines))
+        else:
+            self.flush_edits()
+            command.execute()
+
+    def path(self, name):
+        return os.path.normpath(join(self.session.dir(), name))
+
+    def edit(self, name):
+        """ The list of text to append to file name """
+        return self.edits.setdefault(self.path(name), [False, []])[1]
+
+    def flush(self):
+        self.flush_edits()
+        self.flush_adds()
+
+    def flush_edits(self):
+        for p, (truncate, chunks) in self.edits.items():
+            with open(p, 'w' if truncate else 'a') as f:
+                f.write(''.join(chunks))
+        self.edits = {}
+
+    def flush_adds(self):
+        files, self.to_add = self.to_add, []
+        if files:
+            self.add(files)
+
+    def add(self, files):
+        self.session.backend.add(files)
+
+
+WHITESPACE = re.compile('[{}]*'.format(re.escape(string.whitespace)))
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+
+class NeedMoreInput(Exception):
+    """ Raised inside the parser when a token runs into the end of the text
+        read so far and more of the script is still to come
+    """
+    pass
+
+
 class CommandParser:
+    """
+    Parses command scripts (see command_scripts/README.md) into Commands.
+
+    The parser keeps the whole script (or, when streaming a file, the part
+    of it read so far) in one buffer and moves a cursor, pos, along it; no
+    remainders of the script are ever copied, so parsing is linear in its
+    length. line and linepos track where the cursor is for error messages.
+    """
+    CHUNK_SIZE = 1 << 16
+
     def __init__(self, session):
         self.session = session
         self.line = 1
         self.linepos = 0
         self.pos = 0
+        self.text = ''
+        self.eof = True
         self.last_result = None  # Track the result of the last consume
+        self._words = {}         # excluded characters -> word regex
 
     def parse_file(self, file):
-        with open(file) as f:
-            contents = f.read()
-        return self.parse(contents)
+        return list(self.iter_file(file))
 
     def parse(self, script):
-        length = len(script)
-        s = script[self.pos:]
-        result = []
-        while s:
-            _, s = self.consume_ws(s)
-            # TODO: Consume comments
-            word, s = self.consume_word(s)
-            _, s = self.consume_ws(s)
-            if word == '':
+        return list(self.iter_commands(script))
+
+    def iter_commands(self, script):
+        """ Yield the Commands of script one at a time """
+        self.reset(script)
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            yield command
+
+    def iter_file(self, file, chunk_size=None):
+        """
+        Yield the Commands of the script in file as it is read, a chunk at a
+        time, so they can be run before the rest of the file is parsed
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        self.reset('', eof=False)
+        with open(file) as f:
+            while True:
+                start = self.pos, self.line, self.linepos
+                try:
+                    command = self.read_command()
+                except NeedMoreInput:
+                    # Go back to the start of the command and read on; text
+                    # before it has been parsed and is dropped
+                    self.pos, self.line, self.linepos = start
+                    chunk = f.read(chunk_size)
+                    if chunk:
+                        self.text = self.text[self.pos:] + chunk
+                        self.pos = 0
+                    else:
+                        self.eof = True
+                    continue
+                if command is None:
+                    return
+                yield command
+
+    def reset(self, text, eof=True):
+        self.text = text
+        self.pos = 0
+        self.eof = eof
+        self.line = 1
+        self.linepos = 0
+
+    def error(self, message, line=None, linepos=None):
+        if line is None:
+            line, linepos = self.line, self.linepos
+        return ParseError("({}:{}) {}".format(line, linepos, message))
+
+    def advance(self, end):
+        """ Move the cursor to end, keeping line and linepos up to date """
+        newlines = self.text.count('\n', self.pos, end)
+        if newlines:
+            self.line += newlines
+            self.linepos = end - self.text.rfind('\n', self.pos, end) - 1
+        else:
+            self.linepos += end - self.pos
+        self.pos = end
+
+    def at_end(self):
+        """ True if there is nothing left to parse; raises NeedMoreInput if
+            the cursor is at the end of the text but more is to come
+        """
+        if self.pos < len(self.text):
+            return False
+        if not self.eof:
+            raise NeedMoreInput()
+        return True
+
+    def peek(self):
+        if self.at_end():
+            raise self.error('Unexpected end of script')
+        return self.text[self.pos]
+
+    def read_command(self):
+        """ The next Command, or None at the end of the script """
+        self.skip_ws()
+        if self.at_end():
+            return None
+        line, linepos = self.line, self.linepos
+        word = self.read_word()
+        self.skip_ws()
+        if word == 'add':
+            return Add(self.session, self.read_tuple())
+        elif word == 'branch':
+            return Branch(self.session, self.read_word())
+        elif word == 'checkout':
+            return Checkout(self.session, self.read_word())
+        elif word == 'commit':
+            return Commit(self.session, self.read_string())
+        elif word == 'touch':
+            return CreateFile(self.session, self.read_word())
+        elif word == 'mkdir':
+            return CreateDirectory(self.session, self.read_word())
+        elif word == 'append-to-file' or word == '>>':
+            fname = self.read_word()
+            self.skip_ws()
+            return AppendLineToFile(self.session, fname, self.read_string())
+        elif word in ('append-to-line', 'insert-line', 'delete-line',
+                      'read-file', 'read-file-lines'):
+            raise NotImplementedError()
+        raise self.error('Unrecognized Command: ' + word, line, linepos)
+
+    def skip_ws(self):
+        """ Move past whitespace; return it """
+        start = self.pos
+        end = WHITESPACE.match(self.text, start).end()
+        self.advance(end)
+        if end == len(self.text) and not self.eof:
+            raise NeedMoreInput()
+        return self.text[start:end]
+
+    def read_word(self, exclude=')"'):
+        """ Read up to the next whitespace or character in exclude """
+        regex = self._words.get(exclude)
+        if regex is None:
+            regex = re.compile('[^{}]*'.format(re.escape(string.whitespace + exclude)))
+            self._words[exclude] = regex
+        start = self.pos
+        end = regex.match(self.text, start).end()
+        if end == len(self.text) and not self.eof:
+            raise NeedMoreInput()
+        self.advance(end)
+        return self.text[start:end]
+
+    def read_string(self):
+        """
+        Read a double quoted string and return what is between the quotes
+        (escapes are kept as they are); '' if there is no string here
+        """
+        if self.at_end() or self.text[self.pos] != '"':
+            return ''
+        m = STRING.match(self.text, self.pos)
+        if m is None:
+            if not self.eof:
+                raise NeedMoreInput()
+            raise self.error('Unmatched quote')
+        self.advance(m.end())
+        return m.group()[1:-1]
+
+    def read_tuple(self):
+        """
+        Read a parenthesized tuple of words or of strings, separated by
+        commas (or whitespace); None if there is no tuple here
+        """
+        if self.at_end() or self.text[self.pos] != '(':
+            return None
+        self.advance(self.pos + 1)
+        entries = []
+        entry_type = None
+        while True:
+            self.skip_ws()
+            c = self.peek()
+            if c == ')':
                 break
-            elif word == 'add':
-                _, s = self.consume_tuple(s)
-                files = self.last_result
-                result.append(Add(self.session, files))
-
-            elif word == 'branch':
-                branch, s = self.consume_word(s)
-                result.append(Branch(self.session, branch))
-
-            elif word == 'checkout':
-                branch, s = self.consume_word(s)
-                result.append(Checkout(self.session, branch))
-
-            elif word == 'commit':
-                msg, s = self.consume_string(s)
-                result.append(Commit(self.session, msg))
-
-            elif word == 'touch':
-                fpath, s = self.consume_word(s)
-                result.append(CreateFile(self.session, fpath))
-
-            elif word == 'mkdir':
-                fpath, s = self.consume_word(s)
-                result.append(CreateDirectory(self.session, fpath))
-
-            elif word == 'append-to-file' or word == '>>':
-                fname, s = self.consume_word(s)
-                _, s = self.consume_ws(s)
-                line, s = self.consume_string(s)
-                result.append(AppendLineToFile(self.session, fname, line))
-
-            elif word == 'append-to-line':
-                raise NotImplementedError()
-            elif word == 'insert-line':
-                raise NotImplementedError()
-            elif word == 'delete-line':
-                raise NotImplementedError()
-            elif word == 'read-file':
-                raise NotImplementedError()
-            elif word == 'read-file-lines':
-                raise NotImplementedError()
+            if c == ',':
+                raise self.error('Empty tuple entry')
+            kind = 'str' if c == '"' else 'word'
+            if entry_type is None:
+                entry_type = kind
+            elif entry_type != kind:
+                raise self.error('Mixed tuple type')
+            if kind == 'str':
+                entries.append(self.read_string())
             else:
-                raise ParseError('Unrecognized Command: ' + word)
-            _, s = self.consume_ws(s)
-        return result
+                entries.append(self.read_word(exclude='),'))
+            self.skip_ws()
+            if self.peek() == ',':
+                self.advance(self.pos + 1)
+        self.advance(self.pos + 1)
+        return entries
+
+    def consume(self, s, read):
+        """ Run read() over the string s; return the cursor position after """
+        self.text = s
+        self.pos = 0
+        self.eof = True
+        self.last_result = read()
+        return self.pos
 
     def consume_ws(self, s):
-        self.last_result = None
         """
         Consume whitespace at the start of a string, keeping track of
         the current line number and the current position, and return a tuple
@@ -359,145 +570,28 @@ class CommandParser:
         :return: (leading_ws, remaining)
         :invariant: leading_ws + remaining = s
         """
-        pos = 0
-        length = len(s)
-        if length == 0:
-            return '', ''
-        c = s[0]
-        while c in string.whitespace:
-            self.linepos += 1
-            if c == '\n':
-                self.line += 1
-                self.linepos = 0
-            pos += 1
-            if pos >= length:
-                self.pos = -1
-                return s, ''
-            c = s[pos]
-
-        self.pos += pos
+        pos = self.consume(s, self.skip_ws)
+        self.last_result = None
         return s[:pos], s[pos:]
 
     def consume_string(self, s):
-        self.last_result = None
-        pos = 0
-        length = len(s)
-        if length == 0:
-            return '', ''
-        c = s[0]
-        if c != "\"":
-            return '', s
-        quote_pos = self.linepos
-        quote_line = self.line
-        if length == 1:
-            raise ParseError("({}:{}) Unmatched quote"
-                             .format(self.line, self.linepos))
-        pos += 1
-        c = s[pos]
-        self.linepos += 1
-        while c != "\"":
-            if c == "\\":
-                pos += 2
-                self.linepos += 2
-                if pos >= length:
-                    raise ParseError("({}:{}) Unmatched quote"
-                                     .format(self.line, self.linepos))
-                if s[pos - 1] == '\n':
-                    self.line += 1
-                    self.linepos = 0
-                c = s[pos]
-            elif c == "\n":
-                # raise ParseError("({}:{}) Unescaped newline in string"
-                #                  .format(self.line, self.linepos))
-                pos += 1
-                c = s[pos]
-            else:
-                pos += 1
-                if pos >= length:
-                    raise ParseError("({}:{}) Unmatched quote"
-                                     .format(self.line, self.linepos))
-                c = s[pos]
-        pos += 1
-        self.linepos += 1
-        self.pos += pos
-        return s[1:pos-1], s[pos:]
+        """ (contents of the string at the start of s, remaining) """
+        pos = self.consume(s, self.read_string)
+        result, self.last_result = self.last_result, None
+        return result, s[pos:]
 
     def consume_tuple(self, s):
-        self.last_result = None
-        pos = 0
-        length = len(s)
-        if length is 0:
-            return '', ''
-        c = s[0]
-        if c is not '(':
+        """ (the tuple at the start of s, remaining); the entries of the
+            tuple are left in last_result
+        """
+        pos = self.consume(s, self.read_tuple)
+        if self.last_result is None:
             return '', s
-        pos += 1
-        self.linepos += 1
-        c = s[pos]
-
-        entries = []
-        entry_type = None
-
-        while c is not ')':
-            left, right = self.consume_ws(s[pos:])
-            pos += len(left)
-            if pos >= length:
-                raise ParseError("({}:{}) Invalid tuple"
-                                 .format(self.line, self.linepos))
-            c = s[pos]
-            if c == '"':
-                if entry_type is None:
-                    entry_type = 'str'
-                elif entry_type is not 'str':
-                    raise ParseError("({}:{}) Mixed tuple type"
-                                     .format(self.line, self.linepos))
-                left, right = self.consume_string(s[pos:])
-                pos += len(left)
-                entries.append(left)
-                c = s[pos]
-
-            elif c in ',':
-                raise ParseError("({}:{}) Empty tuple entry"
-                                 .format(self.line, self.linepos))
-
-            else:
-                if entry_type is None:
-                    entry_type = 'word'
-                elif entry_type is not 'word':
-                    raise ParseError("({}:{}) Mixed tuple type"
-                                     .format(self.line, self.linepos))
-                left, right = self.consume_word(s[pos:], exclude='),')
-                pos += len(left)
-                entries.append(left)
-                c = s[pos]
-                if c is ',':
-                    pos += 1
-                    if pos >= length:
-                        raise ParseError("Unmatched open parenthesis")
-
-            left, right = self.consume_ws(s[pos:])
-            pos += len(left)
-            c = s[pos]
-            if c is ',':
-                pos += 1
-                self.linepos += 1
-                c = s[pos]
-
-        pos += 1
-        self.linepos += 1
-        self.pos += pos
-        self.last_result = entries   # Attach to global state
         return s[:pos], s[pos:]
 
     def consume_word(self, s, exclude=')"'):
+        pos = self.consume(s, lambda: self.read_word(exclude))
         self.last_result = None
-        pos = 0
-        length = len(s)
-        while pos < length and s[pos] not in string.whitespace \
-                and s[pos] not in exclude:
-            pos += 1
-        self.pos += pos
-        self.linepos += pos
         return s[:pos], s[pos:]
 
     def parse_add(self, i, line):
@@ -514,5 +608,5 @@ class CommandParser:
 
 class ParseError(RuntimeError):
     def __init__(self, message):
-        RuntimeError.__init__(self)
+        RuntimeError.__init__(self, message)
         print('[!]' + message, file=sys.stderr)
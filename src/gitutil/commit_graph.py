@@ -0,0 +1,309 @@
+"""
+commit_graph.py: walk the history of a repository.
+
+CommitGraph answers ancestry questions (is_ancestor, merge_bases, rev_list,
+unreachable) over a repository's commits. Parents, commit times and
+generation numbers come from .git/objects/info/commit-graph when git has
+written one, and from the commit objects themselves otherwise.
+
+A commit's generation number is one more than the largest generation of
+its parents (roots are 1), so a commit can only reach commits of a lower
+generation. The walks below visit commits in decreasing generation order,
+which lets them stop as soon as nothing left to visit can change the
+answer instead of walking all the way back to the root commits.
+
+    graph = CommitGraph(GitObjects('.git'))
+    graph.merge_bases(a, b)
+    graph.unreachable(old_tips, new_tips)   # commits lost between two states
+"""
+import heapq
+import mmap
+import struct
+from os import path
+
+GRAPH_SIGNATURE = b'CGPH'
+GRAPH_HEADER = struct.Struct('>4sBBBB')   # signature, version, hash, chunks, bases
+CHUNK_ENTRY = struct.Struct('>4sQ')
+COMMIT_DATA = struct.Struct('>20sLLLL')   # tree, parent 1, parent 2, gen+time
+PARENT_NONE = 0x70000000
+EXTRA_EDGES = 0x80000000
+LAST_EDGE = 0x80000000
+
+
+class CommitGraphFile:
+    """ A memory-mapped commit-graph file (a single file, not a chain) """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, hash_version, chunks, bases = \
+            GRAPH_HEADER.unpack_from(self.map, 0)
+        if signature != GRAPH_SIGNATURE or version != 1 or hash_version != 1:
+            raise ValueError('Unsupported commit-graph file: ' + filename)
+        self.chunks = {}
+        offset = GRAPH_HEADER.size
+        for _ in range(chunks):
+            chunk_id, start = CHUNK_ENTRY.unpack_from(self.map, offset)
+            self.chunks[chunk_id] = start
+            offset += CHUNK_ENTRY.size
+        for required in (b'OIDF', b'OIDL', b'CDAT'):
+            if required not in self.chunks:
+                raise ValueError('{} has no {} chunk'.format(filename, required))
+        self.fanout = struct.unpack_from('>256L', self.map, self.chunks[b'OIDF'])
+        self.count = self.fanout[255]
+        self.oids = self.chunks[b'OIDL']
+        self.data = self.chunks[b'CDAT']
+        self.edges = self.chunks.get(b'EDGE')
+
+    def __len__(self):
+        return self.count
+
+    def position(self, sha1):
+        """ The position of the commit with hex sha1, or None """
+        raw = bytes.fromhex(sha1)
+        first = raw[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            s = self.map[self.oids + 20 * mid:self.oids + 20 * mid + 20]
+            if s < raw:
+                lo = mid + 1
+            elif s > raw:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def sha1(self, pos):
+        return self.map[self.oids + 20 * pos:self.oids + 20 * pos + 20].hex()
+
+    def commit(self, pos):
+        """ (tree, parent positions, generation, commit time) of commit pos """
+        tree, p1, p2, high, low = COMMIT_DATA.unpack_from(
+            self.map, self.data + COMMIT_DATA.size * pos)
+        parents = []
+        if p1 != PARENT_NONE:
+            parents.append(p1)
+        if p2 & EXTRA_EDGES:
+            # Octopus merges list parents 2..n in the EDGE chunk
+            edge = self.edges + 4 * (p2 & ~EXTRA_EDGES)
+            while True:
+                p, = struct.unpack_from('>L', self.map, edge)
+                parents.append(p & ~LAST_EDGE)
+                if p & LAST_EDGE:
+                    break
+                edge += 4
+        elif p2 != PARENT_NONE:
+            parents.append(p2)
+        generation = high >> 2
+        commit_time = ((high & 3) << 32) | low
+        return tree.hex(), parents, generation, commit_time
+
+    def close(self):
+        self.map.close()
+
+
+class CommitGraph:
+    """ Ancestry queries over the commits of a GitObjects store """
+
+    # Flags used while painting the graph
+    INCLUDE = 1
+    EXCLUDE = 2
+    PARENT1 = 1
+    PARENT2 = 2
+    STALE = 4
+
+    def __init__(self, objects, graph_file=None):
+        """
+        :param objects: the GitObjects of the repository
+        :param graph_file: commit-graph file to use (default:
+        objects/info/commit-graph, if there is one)
+        """
+        self.objects = objects
+        if graph_file is None:
+            graph_file = path.join(objects.objects_dir, 'info', 'commit-graph')
+        self.file = None
+        if path.exists(graph_file):
+            try:
+                self.file = CommitGraphFile(graph_file)
+            except ValueError:
+                self.file = None   # e.g. a newer format; use the objects
+        self.info = {}   # sha1 -> (parents, generation, commit time)
+
+    def commit_info(self, sha1):
+        """ (parent sha1s, generation, commit time) of a commit """
+        info = self.info.get(sha1)
+        if info is not None:
+            return info
+        # Commits missing from the graph file (or all of them, without one)
+        # get their generation from their parents'. Work through the
+        # ancestors that still need one without recursing.
+        todo = [sha1]
+        pending = {}
+        while todo:
+            c = todo[-1]
+            if c not in self.info and c not in pending:
+                pending[c] = self.read_commit(c)
+            if c in self.info:
+                todo.pop()
+                continue
+            parents, commit_time = pending[c]
+            missing = [p for p in parents if p not in self.info]
+            if missing:
+                todo.extend(missing)
+                continue
+            todo.pop()
+            generation = 1 + max((self.info[p][1] for p in parents), default=0)
+            self.info[c] = (parents, generation, commit_time)
+        return self.info[sha1]
+
+    def read_commit(self, sha1):
+        """ (parents, commit time) of a commit, from the graph file if it has
+            it (recording its generation too) or else the commit object
+        """
+        pos = self.file.position(sha1) if self.file is not None else None
+        if pos is not None:
+            _, parents, generation, commit_time = self.file.commit(pos)
+            parents = [self.file.sha1(p) for p in parents]
+            if generation:
+                self.info[sha1] = (parents, generation, commit_time)
+            return parents, commit_time
+        commit = self.objects[sha1]
+        return commit.parents, commit.commit_time
+
+    def parents(self, sha1):
+        return self.commit_info(sha1)[0]
+
+    def generation(self, sha1):
+        return self.commit_info(sha1)[1]
+
+    def commit_time(self, sha1):
+        return self.commit_info(sha1)[2]
+
+    def priority(self, sha1):
+        """ Heap key: highest generation (then newest) first """
+        _, generation, commit_time = self.commit_info(sha1)
+        return -generation, -commit_time, sha1
+
+    def is_ancestor(self, ancestor, descendant):
+        """ True if ancestor can be reached from descendant (or is it) """
+        if ancestor == descendant:
+            return True
+        floor = self.generation(ancestor)
+        seen = {descendant}
+        stack = [descendant]
+        while stack:
+            c = stack.pop()
+            for p in self.parents(c):
+                if p == ancestor:
+                    return True
+                # Nothing of a lower generation can reach ancestor
+                if p not in seen and self.generation(p) > floor:
+                    seen.add(p)
+                    stack.append(p)
+        return False
+
+    def ancestors(self, sha1):
+        """ Every commit reachable from sha1 (itself included) """
+        return self.rev_list([sha1])
+
+    def rev_list(self, include, exclude=()):
+        """ The commits reachable from a commit in include but from none in
+            exclude (like git rev-list include ^exclude), newest generation
+            first
+        """
+        INCLUDE, EXCLUDE = self.INCLUDE, self.EXCLUDE
+        flags = {}
+        heap = []
+        interesting = 0   # queued commits that are not excluded
+
+        def mark(sha1, flag):
+            nonlocal interesting
+            old = flags.get(sha1)
+            if old is None:
+                flags[sha1] = flag
+                heapq.heappush(heap, self.priority(sha1))
+                if not flag & EXCLUDE:
+                    interesting += 1
+            elif old | flag != old:
+                flags[sha1] = old | flag
+                if flag & EXCLUDE and not old & EXCLUDE:
+                    interesting -= 1
+
+        for sha1 in exclude:
+            mark(sha1, EXCLUDE)
+        for sha1 in include:
+            mark(sha1, INCLUDE)
+
+        # A commit is popped only after every commit that can reach it (they
+        # all have higher generations), so its flags are final by then.
+        result = []
+        while interesting:
+            c = heapq.heappop(heap)[2]
+            f = flags[c]
+            if not f & EXCLUDE:
+                interesting -= 1
+                result.append(c)
+            for p in self.parents(c):
+                mark(p, f)
+        return result
+
+    def unreachable(self, old_tips, new_tips):
+        """ The commits that could be reached from old_tips (e.g. the branch
+            heads in one snapshot) but cannot from new_tips (those of a later
+            one)
+        """
+        return self.rev_list(old_tips, new_tips)
+
+    def merge_bases(self, a, b):
+        """ The best common ancestors of a and b (several for criss-cross
+            merges, none if their histories are unrelated)
+        """
+        if a == b:
+            return [a]
+        PARENT1, PARENT2, STALE = self.PARENT1, self.PARENT2, self.STALE
+        BOTH = PARENT1 | PARENT2
+        flags = {}
+        heap = []
+        active = 0   # queued commits that are not stale
+        results = []
+
+        def mark(sha1, flag):
+            nonlocal active
+            old = flags.get(sha1)
+            if old is None:
+                flags[sha1] = flag
+                heapq.heappush(heap, self.priority(sha1))
+                if not flag & STALE:
+                    active += 1
+            elif old | flag != old:
+                flags[sha1] = old | flag
+                if flag & STALE and not old & STALE:
+                    active -= 1
+
+        mark(a, PARENT1)
+        mark(b, PARENT2)
+        while active:
+            c = heapq.heappop(heap)[2]
+            f = flags[c]
+            if not f & STALE:
+                active -= 1
+            if f & (BOTH | STALE) == BOTH:
+                # Reached from both sides: a merge base. Everything below it
+                # is a common ancestor too, but not a best one.
+                results.append(c)
+                f |= STALE
+            for p in self.parents(c):
+                mark(p, f)
+        return results
+
+    def merge_base(self, a, b):
+        """ One best common ancestor of a and b, or None """
+        bases = self.merge_bases(a, b)
+        return bases[0] if bases else None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,377 @@
+"""
+fast_import.py: build a whole repository from a list of commands with a
+single `git fast-import`.
+
+ImportStream runs the commands against a model of the repository instead
+of the real one. The model holds the work tree (path -> contents), the index
+(path -> blob mark), and each branch's tip commit and tree. As the model
+changes, ImportStream writes the blobs, commits and branch resets that
+describe it as a fast-import stream. Each commit lists only the paths that
+changed since its parent. Once the stream is imported, HEAD, the work tree
+and the index are written out to match the model.
+
+The model follows what running the commands one at a time does, errors
+included. The one difference is that an error is raised before anything is
+written, so the repository is left untouched.
+"""
+import hashlib
+import os
+import tempfile
+from os import path
+
+from gitutil.backend import BAD_REF_NAME, MODE_FILE, PlumbingBackend
+from gitutil.commands import (Add, AppendLineToFile, AppendLinesToFile, Branch,
+                              Checkout, Commit, CreateDirectory, CreateFile)
+from gitutil.gitobjs import GitBranch, read_refs
+
+COMMANDS = (Add, AppendLineToFile, AppendLinesToFile, Branch, Checkout, Commit,
+            CreateDirectory, CreateFile)
+
+
+def quote_path(p):
+    """ p as fast-import expects it: C-style quoted if it needs to be """
+    if not (p.startswith('"') or '\n' in p or '\\' in p):
+        return p
+    return '"' + p.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class ImportStream:
+    """ The model of a repository that the commands of a script build """
+
+    def __init__(self, session, out, branch):
+        """
+        :param session: the (empty) session the repository will live in
+        :param out: binary file to write the fast-import stream to
+        :param branch: the branch HEAD is on (unborn), e.g. 'master'
+        """
+        self.session = session
+        self.out = out
+        self.backend = PlumbingBackend(session)
+        self.head = branch
+        self.marks = 0
+        self.blobs = {}         # sha1 of contents -> mark
+        self.blob_data = {}     # mark -> contents
+        self.worktree = {}      # path -> contents
+        self.dirs = set()       # directories of the work tree
+        self.index = {}         # path -> blob mark
+        self.index_shared = False   # index is also a branch tip's tree
+        self.dirty = set()      # paths staged since HEAD's commit
+        self.tips = {}          # branch -> (commit mark, tree)
+        self.rels = {}          # name in a command -> rel(name)
+
+    # ---- the stream -------------------------------------------------------
+
+    def write(self, text):
+        self.out.write(text.encode('utf-8', 'surrogateescape'))
+
+    def write_data(self, data):
+        self.write('data {}\n'.format(len(data)))
+        self.out.write(data)
+        self.out.write(b'\n')
+
+    def new_mark(self):
+        self.marks += 1
+        return self.marks
+
+    def blob(self, data):
+        """ The mark of a blob with contents data, writing it if it is new """
+        key = hashlib.sha1(data).digest()
+        mark = self.blobs.get(key)
+        if mark is None:
+            mark = self.blobs[key] = self.new_mark()
+            self.blob_data[mark] = data
+            self.write('blob\nmark :{}\n'.format(mark))
+            self.write_data(data)
+        return mark
+
+    # ---- the model --------------------------------------------------------
+
+    def rel(self, name):
+        """ name as a path relative to the work tree ('' for the top) """
+        rel = self.rels.get(name)
+        if rel is None:
+            work = self.session.dir()
+            rel = path.relpath(path.normpath(path.join(work, name)), work)
+            rel = rel.replace(path.sep, '/')
+            if rel == '..' or rel.startswith('../') or rel.split('/')[0] == '.git':
+                raise ValueError('{} is outside the work tree'.format(name))
+            rel = self.rels[name] = '' if rel == '.' else rel
+        return rel
+
+    def is_dir(self, rel):
+        return rel == '' or rel in self.dirs
+
+    def under(self, paths, rel):
+        """ The paths that are rel or lie under directory rel """
+        if rel == '':
+            return list(paths)
+        prefix = rel + '/'
+        return [p for p in paths if p == rel or p.startswith(prefix)]
+
+    def set_index(self, p, mark):
+        if self.index_shared:
+            self.index = dict(self.index)
+            self.index_shared = False
+        if mark is None:
+            del self.index[p]
+        else:
+            self.index[p] = mark
+        self.dirty.add(p)
+
+    def add_dirs(self, p):
+        """ Record the directories leading to file p """
+        parts = p.split('/')[:-1]
+        for i in range(len(parts), 0, -1):
+            d = '/'.join(parts[:i])
+            if d in self.dirs:
+                break
+            self.dirs.add(d)
+
+    def prune_dirs(self, p):
+        """ Drop the directories leading to removed file p that are now
+            empty, as git does
+        """
+        parts = p.split('/')[:-1]
+        while parts:
+            d = '/'.join(parts)
+            if self.under(self.worktree, d) or self.under(self.dirs - {d}, d):
+                return
+            self.dirs.discard(d)
+            parts.pop()
+
+    def open_file(self, name):
+        """ The path of file name, checked the way open() would """
+        rel = self.rel(name)
+        if self.is_dir(rel):
+            raise IsADirectoryError('Is a directory: ' + name)
+        parent = path.dirname(rel).replace(path.sep, '/')
+        if not self.is_dir(parent):
+            raise FileNotFoundError('No such file or directory: ' + name)
+        return rel
+
+    def execute(self, command):
+        tp = type(command)
+        if tp is CreateFile:
+            self.worktree[self.open_file(command.path)] = b''
+        elif tp is AppendLineToFile:
+            self.append(command.file, command.line + '\n')
+        elif tp is AppendLinesToFile:
+            self.append(command.file, '\n'.join(command.lines))
+        elif tp is CreateDirectory:
+            self.mkdir(command.path)
+        elif tp is Add:
+            self.add(command.files or [])
+        elif tp is Commit:
+            self.commit(command.message)
+        elif tp is Branch:
+            self.branch(command.branch_name)
+        elif tp is Checkout:
+            self.checkout(command.branch_name)
+        else:
+            raise ValueError('Cannot import command {!r}'.format(command))
+
+    def append(self, name, text):
+        rel = self.open_file(name)
+        self.worktree[rel] = self.worktree.get(rel, b'') + text.encode('utf-8')
+
+    def mkdir(self, name):
+        rel = self.rel(name)
+        if self.is_dir(rel) or rel in self.worktree:
+            raise FileExistsError('File exists: ' + name)
+        parts = rel.split('/')
+        for i in range(1, len(parts)):
+            if '/'.join(parts[:i]) in self.worktree:
+                raise NotADirectoryError('Not a directory: ' + name)
+        self.dirs.add(rel)
+        self.add_dirs(rel)
+
+    def add(self, files):
+        for name in files:
+            rel = self.rel(name)
+            if self.is_dir(rel):
+                found = self.under(self.worktree, rel)
+                for p in found:
+                    self.stage(p)
+                for p in set(self.under(self.index, rel)) - set(found):
+                    self.set_index(p, None)
+            elif rel in self.worktree:
+                self.stage(rel)
+            else:
+                gone = self.under(self.index, rel)
+                if not gone:
+                    raise ValueError("pathspec '{}' did not match any files"
+                                     .format(name))
+                for p in gone:
+                    self.set_index(p, None)
+
+    def stage(self, p):
+        mark = self.blob(self.worktree[p])
+        if self.index.get(p) != mark:
+            self.set_index(p, mark)
+
+    def head_tree(self):
+        tip = self.tips.get(self.head)
+        return tip[1] if tip is not None else {}
+
+    def commit(self, message):
+        parent = self.tips.get(self.head)
+        parent_tree = parent[1] if parent is not None else {}
+        mark = self.new_mark()
+        self.write('commit {}{}\nmark :{}\n'.format(GitBranch.PREFIX, self.head, mark))
+        self.write('author {}\n'.format(self.backend.signature('author')))
+        self.write('committer {}\n'.format(self.backend.signature('committer')))
+        self.write_data(message.encode('utf-8'))
+        if parent is not None:
+            self.write('from :{}\n'.format(parent[0]))
+        for p in sorted(self.dirty):
+            blob = self.index.get(p)
+            if blob == parent_tree.get(p):
+                continue
+            if blob is None:
+                self.write('D {}\n'.format(quote_path(p)))
+            else:
+                self.write('M {:o} :{} {}\n'.format(MODE_FILE, blob, quote_path(p)))
+        self.write('\n')
+        self.tips[self.head] = (mark, self.index)
+        self.index_shared = True
+        self.dirty = set()
+
+    def branch(self, branch_name):
+        if BAD_REF_NAME.search(branch_name):
+            raise ValueError('Invalid branch name: {!r}'.format(branch_name))
+        tip = self.tips.get(self.head)
+        if tip is None:
+            raise ValueError('Cannot create branch {}: HEAD has no commits yet'
+                             .format(branch_name))
+        existing = self.tips.get(branch_name)
+        if existing is not None and existing[0] != tip[0]:
+            raise ValueError('Branch {} already exists'.format(branch_name))
+        self.tips[branch_name] = tip
+        self.write('reset {}{}\nfrom :{}\n\n'.format(GitBranch.PREFIX, branch_name,
+                                                     tip[0]))
+
+    def checkout(self, branch_name):
+        if branch_name not in self.tips or branch_name == self.head:
+            return
+        old = self.head_tree()
+        new = self.tips[branch_name][1]
+        changed = [] if old is new else \
+            sorted(p for p in set(old) | set(new) if old.get(p) != new.get(p))
+        for p in changed:
+            staged = self.index.get(p) != old.get(p)
+            if p in old:
+                local = self.worktree.get(p) != self.blob_data[old[p]]
+            else:
+                local = p in self.worktree or self.is_dir(p)
+            if staged or local:
+                raise ValueError('Your local changes to {} would be overwritten '
+                                 'by checkout'.format(p))
+            parts = p.split('/')
+            for i in range(1, len(parts)):
+                d = '/'.join(parts[:i])
+                if d in self.worktree and d not in old:
+                    raise ValueError('Untracked file {} would be overwritten '
+                                     'by checkout'.format(d))
+
+        carried = {p: self.index.get(p) for p in self.dirty
+                   if self.index.get(p) != old.get(p)}
+        self.index = new
+        self.index_shared = True
+        self.dirty = set()
+        for p, mark in carried.items():
+            self.set_index(p, mark)
+
+        for p in changed:
+            if p in old:
+                del self.worktree[p]
+                self.prune_dirs(p)
+        for p in changed:
+            if p in new:
+                self.worktree[p] = self.blob_data[new[p]]
+                self.add_dirs(p)
+        self.head = branch_name
+
+    def finish(self):
+        self.write('done\n')
+
+    # ---- the repository ---------------------------------------------------
+
+    def write_repository(self, marks):
+        """ Write HEAD, the work tree and the index once the stream has been
+            imported (marks: mark -> sha1, from --export-marks)
+        """
+        gitdir = path.join(self.session.dir(), '.git')
+        self.backend.write_locked(path.join(gitdir, 'HEAD'),
+                                  'ref: {}{}\n'.format(GitBranch.PREFIX, self.head)
+                                  .encode('utf-8'))
+        for d in sorted(self.dirs):
+            os.makedirs(self.backend.worktree_path(d), exist_ok=True)
+        for p, data in self.worktree.items():
+            with open(self.backend.worktree_path(p), 'wb') as f:
+                f.write(data)
+        entries = {}
+        for p, mark in self.index.items():
+            sha1 = bytes.fromhex(marks[mark])
+            if self.worktree.get(p) == self.blob_data[mark]:
+                st = os.lstat(self.backend.worktree_path(p))
+                entries[p] = self.backend.stat_entry(st, MODE_FILE, sha1)
+            else:
+                # No stat data, so git compares the file's contents
+                entries[p] = (0,) * 6 + (MODE_FILE, 0, 0, 0, sha1)
+        self.backend.write_index(entries)
+
+
+def read_marks(filename):
+    """ mark -> sha1 from a fast-import --export-marks file """
+    marks = {}
+    with open(filename) as f:
+        for line in f:
+            mark, sha1 = line.split()
+            marks[int(mark[1:])] = sha1
+    return marks
+
+
+def can_import(session, commands):
+    """ True if running commands in session can be done with fast-import:
+        the repository is new and empty, the commands are ones ImportStream
+        models, and nothing (ignore rules, attributes, line ending settings)
+        would make git store files other than as they are
+    """
+    if not all(type(c) in COMMANDS for c in commands):
+        return False
+    work = session.dir()
+    if os.listdir(work) != ['.git'] or path.exists(path.join(work, '.git', 'index')):
+        return False
+    backend = PlumbingBackend(session)
+    ref, sha1 = backend.head()
+    if ref is None or not ref.startswith(GitBranch.PREFIX) or sha1 is not None:
+        return False
+    if read_refs(path.join(work, '.git')) or not backend.plain():
+        return False
+    for c in commands:
+        name = getattr(c, 'path', None) or getattr(c, 'file', None)
+        if name is not None and path.basename(name) in ('.gitignore', '.gitattributes'):
+            return False
+    return True
+
+
+def fast_import(session, commands):
+    """ Run commands in (new, empty) session with one git fast-import """
+    gitdir = path.join(session.dir(), '.git')
+    ref = PlumbingBackend(session).head()[0]
+    with tempfile.TemporaryFile() as out:
+        stream = ImportStream(session, out, ref[len(GitBranch.PREFIX):])
+        for c in commands:
+            stream.execute(c)
+        stream.finish()
+        out.seek(0)
+        fd, marks_file = tempfile.mkstemp(dir=gitdir, prefix='marks')
+        os.close(fd)
+        try:
+            session.git.fast_import('--quiet', '--done',
+                                    '--export-marks=' + marks_file, istream=out)
+            marks = read_marks(marks_file)
+        finally:
+            os.remove(marks_file)
+    stream.write_repository(marks)
+    return stream
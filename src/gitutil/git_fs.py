@@ -2,6 +2,18 @@
 git_fs.py: represent the Git filesystem, starting with .git/ and listing all
 subdirectories and files
 """
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from gitutil.index_report import render_index
 from utils import filesystem as fs
 from utils.filesystem import File, Directory, Path
 
@@ -57,190 +69,820 @@ class Hooks(Directory):
     pass
 
 
+def decode_varint(buf, offset):
+    """ Decode one of git's variable width integers (as used by index v4 path
+        compression and the untracked cache) at buf[offset]; return the value
+        and the offset just past it
+    """
+    c = buf[offset]
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = buf[offset]
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
+
+def read_ewah(buf, offset):
+    """ Decode an EWAH compressed bitmap at buf[offset]; return the sorted
+        positions of its set bits and the offset just past it
+    """
+    bit_size, word_count = struct.unpack_from('>LL', buf, offset)
+    offset += 8
+    words = struct.unpack_from('>{}Q'.format(word_count), buf, offset)
+    offset += 8 * word_count + 4   # the words, then the last RLW's position
+    bits = []
+    pos = 0
+    i = 0
+    while i < word_count:
+        rlw = words[i]
+        i += 1
+        running_bit = rlw & 1
+        running_len = (rlw >> 1) & 0xffffffff
+        literals = rlw >> 33
+        if running_bit:
+            bits.extend(range(pos, pos + 64 * running_len))
+        pos += 64 * running_len
+        for word in words[i:i + literals]:
+            while word:
+                low = word & -word
+                bits.append(pos + low.bit_length() - 1)
+                word ^= low
+            pos += 64
+        i += literals
+    return [b for b in bits if b < bit_size], offset
+
+
+def common_prefix_length(a, b, offset=0, chunk=1 << 16):
+    """ Length of the longest common prefix of the bytes objects a and b,
+        assuming their first offset bytes are known to match
+    """
+    end = min(len(a), len(b))
+    while offset + chunk <= end and a[offset:offset + chunk] == b[offset:offset + chunk]:
+        offset += chunk
+    lo, hi = offset, min(offset + chunk, end)
+    # a[:lo] == b[:lo]; binary search for the first mismatch below hi
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class IndexTable:
+    """
+        The entries of a parsed index, stored column by column: one typed
+        array per numeric field, a flat bytearray holding every 20-byte sha1
+        one after the other, and a list of paths. Row i of every column
+        belongs to the i'th entry (the index is sorted by path).
+
+        If NumPy is installed, as_numpy() returns the numeric columns and
+        sha1s as a structured array for vectorized queries. It is built once
+        and kept until the table changes.
+    """
+    STAT_FIELDS = ('ctime_sec', 'ctime_nsec', 'mtime_sec', 'mtime_nsec', 'dev',
+                   'ino', 'mode', 'uid', 'gid', 'size')
+    FIELDS = STAT_FIELDS + ('flags', 'extended_flags')
+
+    def __init__(self):
+        self._stat = bytearray()    # the raw big-endian 40 bytes per entry
+        self._flags = bytearray()   # the raw big-endian 2 bytes per entry
+        self.extended_flags = array('H')
+        self.sha1s = bytearray()
+        self.paths = []
+        self.offsets = array('L')   # where each entry starts in the index file
+        for field in self.STAT_FIELDS:
+            setattr(self, field, array('I'))
+        self.flags = array('H')
+        self._array = None          # as_numpy(), once built
+
+    def append(self, header, extended_flags, path, offset):
+        """ Add an entry from its raw 62 byte header """
+        self._stat += header[:40]
+        self.sha1s += header[40:60]
+        self._flags += header[60:62]
+        self._array = None
+        self.extended_flags.append(extended_flags)
+        self.paths.append(path)
+        self.offsets.append(offset)
+
+    def extend(self, other):
+        """ Add the entries another (not yet finished) table collected """
+        self._stat += other._stat
+        self._flags += other._flags
+        self._array = None
+        self.extended_flags.extend(other.extended_flags)
+        self.sha1s += other.sha1s
+        self.paths.extend(other.paths)
+        self.offsets.extend(other.offsets)
+
+    def rows(self, start, stop=None, shift=0):
+        """ A (finished) table holding rows start:stop of this finished one,
+            with their offsets moved by shift
+        """
+        if stop is None:
+            stop = len(self)
+        result = IndexTable()
+        for field in self.FIELDS:
+            setattr(result, field, getattr(self, field)[start:stop])
+        result.sha1s = self.sha1s[20 * start:20 * stop]
+        result.paths = self.paths[start:stop]
+        result.offsets = self.offsets[start:stop]
+        if shift:
+            result.offsets = array('L', (o + shift for o in result.offsets))
+        return result
+
+    @classmethod
+    def join(cls, tables):
+        """ One finished table holding the rows of each finished table in turn """
+        result = cls()
+        for t in tables:
+            for field in cls.FIELDS:
+                getattr(result, field).extend(getattr(t, field))
+            result.sha1s += t.sha1s
+            result.paths.extend(t.paths)
+            result.offsets.extend(t.offsets)
+        return result
+
+    def finish(self):
+        """ Decode the raw columns collected by append() """
+        stat = array('I', bytes(self._stat))
+        flags = array('H', bytes(self._flags))
+        if sys.byteorder == 'little':
+            stat.byteswap()
+            flags.byteswap()
+        n = len(self.STAT_FIELDS)
+        for i, field in enumerate(self.STAT_FIELDS):
+            setattr(self, field, stat[i::n])
+        self.flags = flags
+        self._stat = bytearray()
+        self._flags = bytearray()
+        self._array = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def sha1(self, i):
+        """ Hex sha1 of entry i """
+        return self.sha1s[20 * i:20 * i + 20].hex()
+
+    def stage(self, i):
+        return (self.flags[i] >> 12) & 3
+
+    def row(self, i):
+        """ Entry i as a dictionary of field -> value """
+        result = {field: getattr(self, field)[i] for field in self.FIELDS}
+        result['sha1'] = self.sha1(i)
+        result['path'] = self.paths[i]
+        return result
+
+    def key(self, i):
+        """ (path, stage): what identifies entry i within an index """
+        return self.paths[i], self.stage(i)
+
+    def mtime_ns(self, i):
+        return self.mtime_sec[i] * 1000000000 + self.mtime_nsec[i]
+
+    def modified_after(self, t):
+        """ Rows whose mtime is later than t (seconds since the epoch) """
+        ns = int(t * 1000000000)
+        if np is not None:
+            a = self.as_numpy()
+            mtime = a['mtime_sec'].astype('i8') * 1000000000 + a['mtime_nsec']
+            return np.nonzero(mtime > ns)[0].tolist()
+        return [i for i in range(len(self)) if self.mtime_ns(i) > ns]
+
+    def with_mode(self, mode):
+        """ Rows whose mode is mode (e.g. 0o100755) """
+        if np is not None:
+            return np.nonzero(self.as_numpy()['mode'] == mode)[0].tolist()
+        return [i for i, m in enumerate(self.mode) if m == mode]
+
+    def as_numpy(self):
+        """ A NumPy structured array with one record per entry: the fields
+            of FIELDS and the sha1 as a 20-byte 'S20' field (paths stay in
+            self.paths). Built on the first call and reused until the table
+            changes, so treat it as read-only. Requires NumPy.
+        """
+        if np is None:
+            raise ImportError('as_numpy() requires NumPy')
+        if self._array is None:
+            dtype = [(field, 'u4') for field in self.STAT_FIELDS]
+            dtype += [('flags', 'u2'), ('extended_flags', 'u2'),
+                      ('sha1', 'S20')]
+            result = np.empty(len(self), dtype=dtype)
+            for field in self.FIELDS:
+                column = getattr(self, field)
+                result[field] = np.frombuffer(column, dtype=column.typecode)
+            result['sha1'] = np.frombuffer(bytes(self.sha1s), dtype='S20')
+            self._array = result
+        return self._array
+
+
+def diff_tables(old, old_rows, new, new_rows):
+    """ Compare the rows old_rows of the IndexTable old with the rows new_rows
+        of new, matching entries by path and stage. Returns a dictionary:
+
+            'added':   rows (see IndexTable.row) only in new
+            'removed': rows only in old
+            'changed': (old row, new row) pairs whose sha1 or mode differ
+
+        Entries whose only difference is their stat data are not reported.
+    """
+    old_keys = {old.key(i): i for i in old_rows}
+    added, changed = [], []
+    for i in new_rows:
+        j = old_keys.pop(new.key(i), None)
+        if j is None:
+            added.append(new.row(i))
+        elif old.sha1s[20 * j:20 * j + 20] != new.sha1s[20 * i:20 * i + 20] \
+                or old.mode[j] != new.mode[i]:
+            changed.append((old.row(j), new.row(i)))
+    removed = [old.row(j) for j in sorted(old_keys.values())]
+    return {'added': added, 'removed': removed, 'changed': changed}
+
+
 class GitIndex(File):
-    def __init__(self, index, verbose=True):
+    """
+        A parsed .git/index file. The whole file is decoded from a single
+        memoryview by offset, so parsing is linear in the size of the index
+        and no intermediate slices of it are made.
+
+        The entries are kept in table, an IndexTable. indexEntries gives the
+        older list-of-dictionaries view of them (built on first use).
+        lookup(), rows_for_path(), paths_for_sha1() and rows_under() answer
+        questions about particular paths, blobs and directories without
+        scanning every entry; the tables they use are built on first use.
+
+        Versions 2, 3 and 4 (path prefix compression) are understood.
+        Extensions are only located while parsing; each one is decoded the
+        first time it is asked for, through extension() or one of the
+        properties named after it (cached_tree_entries, resolve_undo,
+        untracked_cache, fsmonitor, end_of_index, entry_offsets, split_index).
+    """
+    HEADER = struct.Struct('>4sLL')         # signature, version, entry count
+    ENTRY = struct.Struct('>10L20sH')      # the fixed 62 bytes of an entry
+    EXTENDED_FLAGS = struct.Struct('>H')
+    EXTENSION = struct.Struct('>4sL')      # signature, size
+    ENTRY_FIELDS = [
+        'ctime-sec',
+        'ctime-nano',
+        'mtime-sec',
+        'mtime-nano',
+        'dev',
+        'ino',
+        'mode',
+        'uid',
+        'gid',
+        'file size',
+    ]
+    FLAG_EXTENDED = 0x4000
+    NAME_MASK = 0x0fff
+    HASH_SIZE = 20
+    STAT_DATA = struct.Struct('>9L')       # ctime..file size, without mode
+    EXTENSION_NAMES = {
+        b'TREE': 'cached tree',
+        b'REUC': 'resolve undo',
+        b'link': 'split index',
+        b'UNTR': 'untracked cache',
+        b'FSMN': 'file system monitor cache',
+        b'EOIE': 'end of index entry',
+        b'IEOT': 'index entry offset table',
+        b'sdir': 'sparse directory entries',
+    }
+
+    def __init__(self, index, verbose=False, workers=None, previous=None):
         """
             parse an index file
+
+            verbose: write every entry and cached tree to stdout once parsed
+                (see gitutil.index_report for more control over the output)
+            workers: if more than 1 and the index has an entry offset table
+                (IEOT), decode its blocks of entries on that many threads.
+                Otherwise entries are decoded serially; the result is the
+                same either way.
+            previous: an earlier GitIndex of the same file. Only the entries
+                whose bytes differ from it are decoded; the rest are copied
+                over from previous.table. changes then holds what changed
+                (see diff()).
         """
+        if not isinstance(index, bytes):
+            index = bytes(index)
         super().__init__('index', index, None)
-        self.magic_number = index[0:4]
-        self.version = self.bytes_to_int(index[5:8])
-        self.filecount = self.bytes_to_int(index[9:12])
-        self.cached_tree_entries = []
-        self.indexEntries = []
-        xs = index[12:]
-        while xs:
-            xs.strip(ZEROBYTES)
-            if xs.startswith('TREE'.encode('utf-8')):
-                self.cached_tree_entries, xs = self.read_tree_extension(xs, verbose)
-                break
+        buf = memoryview(index)
+        self.buf = buf
+        self.magic_number, self.version, self.filecount = self.HEADER.unpack_from(buf, 0)
+        if self.magic_number != b'DIRC' or self.version not in (2, 3, 4):
+            raise ValueError('Unsupported index: signature {!r}, version {}'
+                             .format(self.magic_number, self.version))
+        self.table = IndexTable()
+        self._index_entries = None
+        self._rows_by_path = None
+        self._rows_by_sha1 = None
+        self.extension_offsets = {}   # signature -> (offset, size)
+        self._extensions = {}
+        self.changes = None
+
+        if previous is not None and previous.version == self.version:
+            self.reread_entries(buf, previous)
+        else:
+            blocks = None
+            if workers is not None and workers > 1:
+                blocks = self.find_entry_blocks(buf)
+            if blocks:
+                # Blocks are independent (v4 name compression restarts at
+                # each one), so decode them into separate tables and join
+                # them up.
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    tables = list(pool.map(
+                        lambda block: self.read_entries(buf, block[0], block[1]),
+                        blocks))
+                for table, _ in tables:
+                    self.table.extend(table)
             else:
-                entry, xs = self.read_index_entry(xs, verbose)
+                _, self.entries_end = self.read_entries(buf, self.HEADER.size,
+                                                        self.filecount, self.table)
+                self.read_extension_offsets(buf, self.entries_end)
+            self.table.finish()
 
-    def read_tree_extension(self, bs, verbose=True):
         if verbose:
-            print("Reading tree extension")
-        if not bs.startswith("TREE".encode('utf-8')):
-            if verbose:
-                print("Not a valid cached-tree extension")
-            return (None, bs)
-        xs = bs[4:]
-        xs.strip(ZEROBYTES)
-        trees = []
-        t, xs = self.read_cached_tree(xs, verbose)
-        if t == None:
-            return trees, xs  # This should throw an error...
-        while xs:
-            t, xs = self.read_cached_tree(xs, verbose)
-            if t == None:
+            render_index(self)
+
+    def read_entries(self, buf, offset, count, table=None):
+        """ Decode count entries starting at buf[offset] into table (default:
+            a new IndexTable); return the table and the offset after them
+        """
+        if table is None:
+            table = IndexTable()
+        previous_name = b''
+        for _ in range(count):
+            offset, previous_name = self.read_index_entry(buf, offset, table,
+                                                          previous_name)
+        return table, offset
+
+    def reread_entries(self, buf, previous):
+        """ Decode the entries of buf, copying the rows of previous.table
+            for the unchanged entries at either end rather than decoding
+            them again.
+
+            The entries before the first byte that differs from previous are
+            unchanged. From there entries are decoded one at a time until the
+            new entry and all of the entries after it are, byte for byte,
+            the last entries of previous; those are copied over too.
+        """
+        old = previous.table
+        old_buf = previous.buf.obj
+        old_end = previous.entries_end
+        old_count = len(old)
+        count = self.filecount
+
+        same = common_prefix_length(old_buf, buf.obj, self.HEADER.size)
+        if old_count and old_end <= same:
+            start = old_count
+        else:
+            start = bisect_right(old.offsets, same, 1) - 1
+        start = max(0, min(start, count, old_count))
+        offset = old.offsets[start] if start < old_count else old_end
+        previous_name = b''
+        if start:
+            previous_name = old.paths[start - 1].encode('utf-8', 'surrogateescape')
+
+        middle = IndexTable()
+        resumed = None   # first row of old copied after the middle
+        for i in range(start, count):
+            entry_start = offset
+            offset, previous_name = self.read_index_entry(buf, offset, middle,
+                                                          previous_name)
+            k = old_count - (count - i)   # the old row this would line up with
+            if k < start or old.paths[k] != middle.paths[-1]:
+                continue
+            k_start = old.offsets[k]
+            k_end = old.offsets[k + 1] if k + 1 < old_count else old_end
+            if buf.obj[entry_start:offset] != old_buf[k_start:k_end]:
+                continue
+            rest = old_end - k_end
+            if buf.obj[offset:offset + rest] == old_buf[k_end:old_end]:
+                resumed = k + 1
+                self.entries_end = offset + rest
                 break
+        else:
+            self.entries_end = offset
+        middle.finish()
+
+        tables = [old.rows(0, start), middle]
+        old_stop = old_count
+        if resumed is not None:
+            tables.append(old.rows(resumed, shift=self.entries_end - old_end))
+            old_stop = resumed
+        self.table = IndexTable.join(tables)
+        self.read_extension_offsets(buf, self.entries_end)
+        self.changes = diff_tables(old, range(start, old_stop),
+                                   self.table, range(start, start + len(middle)))
+
+    def diff(self, other):
+        """ How this index differs from other, an earlier one. See diff_tables. """
+        return diff_tables(other.table, range(len(other.table)),
+                           self.table, range(len(self.table)))
+
+    @property
+    def rows_by_path(self):
+        """ path -> the rows (one per stage) of the entries for that path """
+        if self._rows_by_path is None:
+            rows = {}
+            for i, p in enumerate(self.table.paths):
+                rows.setdefault(p, []).append(i)
+            self._rows_by_path = rows
+        return self._rows_by_path
+
+    @property
+    def rows_by_sha1(self):
+        """ raw 20 byte sha1 -> the rows of the entries with that object name """
+        if self._rows_by_sha1 is None:
+            rows = {}
+            sha1s = self.table.sha1s
+            for i in range(len(self.table)):
+                rows.setdefault(bytes(sha1s[20 * i:20 * i + 20]), []).append(i)
+            self._rows_by_sha1 = rows
+        return self._rows_by_sha1
+
+    def rows_for_path(self, path):
+        """ The rows of the entries for path (several if it is conflicted) """
+        return self.rows_by_path.get(path, [])
+
+    def lookup(self, path, stage=0):
+        """ The entry for path at stage as a row dictionary (see
+            IndexTable.row), or None if the index does not have one
+        """
+        for i in self.rows_for_path(path):
+            if self.table.stage(i) == stage:
+                return self.table.row(i)
+        return None
+
+    def __contains__(self, path):
+        return path in self.rows_by_path
+
+    def paths_for_sha1(self, sha1):
+        """ The paths whose entries name the object sha1 (hex or raw bytes) """
+        if isinstance(sha1, str):
+            sha1 = bytes.fromhex(sha1)
+        paths = self.table.paths
+        return [paths[i] for i in self.rows_by_sha1.get(sha1, [])]
+
+    def rows_under(self, directory):
+        """ The range of rows of the entries inside directory (relative to the
+            top of the work tree; '' for all of them)
+        """
+        # Entries are sorted by path, so everything under a directory is one
+        # contiguous run that starts at the first path >= 'directory/'
+        paths = self.table.paths
+        if not directory:
+            return range(len(paths))
+        prefix = directory.rstrip('/') + '/'
+        start = bisect_left(paths, prefix)
+        stop = bisect_left(paths, prefix[:-1] + chr(ord('/') + 1), start)
+        return range(start, stop)
+
+    def read_extension_offsets(self, buf, offset):
+        """ Note where each extension from buf[offset] onwards is. Extensions
+            run up to the trailing checksum of the file and are only decoded
+            on demand.
+        """
+        end = len(buf) - self.HASH_SIZE
+        while offset + self.EXTENSION.size <= end:
+            signature, size = self.EXTENSION.unpack_from(buf, offset)
+            offset += self.EXTENSION.size
+            self.extension_offsets[signature] = (offset, size)
+            offset += size
+
+    def find_entry_blocks(self, buf):
+        """ The (offset, count) blocks of the entry offset table, found
+            without decoding any entries: the end of index extension (EOIE)
+            always sits just before the checksum and says where the
+            extensions start. Returns None if there is no table to use.
+        """
+        eoie = len(buf) - self.HASH_SIZE - self.EXTENSION.size - 4 - self.HASH_SIZE
+        if eoie < self.HEADER.size:
+            return None
+        signature, size = self.EXTENSION.unpack_from(buf, eoie)
+        if signature != b'EOIE' or size != 4 + self.HASH_SIZE:
+            return None
+        self.entries_end, = struct.unpack_from('>L', buf, eoie + self.EXTENSION.size)
+        self.read_extension_offsets(buf, self.entries_end)
+        ieot = self.entry_offsets
+        if not ieot or sum(count for _, count in ieot['blocks']) != self.filecount:
+            self.extension_offsets = {}
+            self._extensions = {}
+            return None
+        return ieot['blocks']
+
+    def extension(self, signature):
+        """ The decoded extension with the given 4-byte signature (e.g.
+            b'TREE'), or None if the index does not have it. Extensions this
+            parser has no decoder for are returned as raw bytes.
+        """
+        if signature not in self.extension_offsets:
+            return None
+        if signature not in self._extensions:
+            offset, size = self.extension_offsets[signature]
+            decoder = self.EXTENSION_DECODERS.get(signature)
+            if decoder is None:
+                value = bytes(self.buf[offset:offset + size])
+            else:
+                value = decoder(self, self.buf, offset, offset + size)
+            self._extensions[signature] = value
+        return self._extensions[signature]
+
+    @property
+    def cached_tree_entries(self):
+        return self.extension(b'TREE') or []
+
+    @property
+    def resolve_undo(self):
+        return self.extension(b'REUC')
+
+    @property
+    def untracked_cache(self):
+        return self.extension(b'UNTR')
+
+    @property
+    def fsmonitor(self):
+        return self.extension(b'FSMN')
+
+    @property
+    def end_of_index(self):
+        return self.extension(b'EOIE')
+
+    @property
+    def entry_offsets(self):
+        return self.extension(b'IEOT')
+
+    @property
+    def split_index(self):
+        return self.extension(b'link')
+
+    def read_tree_extension(self, buf, offset, end):
+        """ Parse the cached trees in buf[offset:end] """
+        trees = []
+        while offset < end:
+            t, offset = self.read_cached_tree(buf, offset)
             trees.append(t)
-        return (trees, xs)
+        return trees
 
-    def read_cached_tree(self, bs, verbose=True):
-        if verbose:
-            print("Reading a cached tree")
+    def read_cached_tree(self, buf, offset):
         result = {}
-        # First, clear zeros from left
-        xs = bs
-        xs = xs.strip(ZEROBYTES)
-
-        path_comp, xs = self.read_bytes_til_nul(xs)
-        xs.strip(ZEROBYTES)
+        nul = self.find(buf, ZEROBYTES, offset)
+        path_comp = bytes(buf[offset:nul])
+        offset = nul + 1
 
-        entries_in_index, xs = self.read_bytes_til(xs, delim=SPACEBYTES)
-        xs = xs[1:]  # pass the space
+        space = self.find(buf, SPACEBYTES, offset)
+        entries_in_index = int(bytes(buf[offset:space]))
+        offset = space + 1
 
-        number_of_subtrees, xs = self.read_bytes_til(xs, delim=NEWLINEBYTES)
-        xs = xs[1:]  # pass the newline
+        newline = self.find(buf, NEWLINEBYTES, offset)
+        number_of_subtrees = int(bytes(buf[offset:newline]))
+        offset = newline + 1
 
-        objname = ''.join(['{:02x}'.format(c) for c in xs[:20]])
-        xs = xs[20:]
-        xs = xs.strip(ZEROBYTES)
+        # An invalidated tree (entry count -1) has no object name
+        objname = ''
+        if entries_in_index >= 0:
+            objname = buf[offset:offset + 20].hex()
+            offset += 20
 
-        if path_comp is None or entries_in_index is None or number_of_subtrees is None:
-            return (None, bs)
-        result['path comp'] = str(path_comp)
+        result['path comp'] = path_comp.decode('utf-8', 'surrogateescape')
         result['entries in index'] = str(entries_in_index)
         result['number of subtrees'] = str(number_of_subtrees)
-        result['object-name'] = str(objname)
+        result['object-name'] = objname
+        return result, offset
+
+    def read_resolve_undo(self, buf, offset, end):
+        """ REUC: the stages of conflicted paths, kept so that a resolution
+            can be undone. Returns a list of {'path', 'modes', 'sha1s'}
+            where modes has the (possibly 0) mode of stages 1 to 3 and sha1s
+            the object names of the stages that exist.
+        """
+        result = []
+        while offset < end:
+            nul = self.find(buf, ZEROBYTES, offset)
+            path = bytes(buf[offset:nul]).decode('utf-8', 'surrogateescape')
+            offset = nul + 1
+            modes = []
+            for _ in range(3):
+                nul = self.find(buf, ZEROBYTES, offset)
+                modes.append(int(bytes(buf[offset:nul]), 8))
+                offset = nul + 1
+            sha1s = []
+            for mode in modes:
+                if mode:
+                    sha1s.append(buf[offset:offset + self.HASH_SIZE].hex())
+                    offset += self.HASH_SIZE
+            result.append({'path': path, 'modes': modes, 'sha1s': sha1s})
+        return result
 
-        if verbose:
-            self.print_cached_tree(result)
-
-        return result, xs
-
-    def print_cached_tree(self, tree):
-        print('+' + '-' * 78 + '+')
-        s = 'Cached Tree'
-        s = '{0: ^78}'.format(s)
-        print(s)
-        print('+' + '-' * 78 + '+')
-        fields = [
-            'path comp',
-            'entries in index',
-            'number of subtrees',
-            'object-name',
-        ]
-
-        for key in fields:
-            print('| {:20}'.format(key + ':') + tree[key])
-
-        print('+' + ('-' * 78) + '+')
-        print()
-
-    def read_index_entry(self, bs, verbose=True):
-        xs = bs
-        entry = {}
-        fields = [
-            ('ctime-sec', 4),
-            ('ctime-nano', 4),
-            ('mtime-sec', 4),
-            ('mtime-nano', 4),
-            ('dev', 4),
-            ('ino', 4),
-            ('mode', 4),
-            ('uid', 4),
-            ('gid', 4),
-            ('file size', 4),
-            ('sha1', 20),
-            ('flags', 2),
-        ]
-
-        for (key, size) in fields:
-            entry[key] = hex(self.bytes_to_int(xs[:size]))
-            xs = xs[size:]
-
-        name = xs[:xs.find(0)]
-        xs = xs[xs.find(0):]
-        entry['name'] = str(name)
-
-        self.indexEntries.append(entry)  # Just a dictionary for now
-        if verbose:
-            self.print_index_entry(entry)
-
-        xs = self.strip_zeros_from_bytes(xs)
-        return (entry, xs)
-
-    def print_index_entry(self, entry):
-        fields = [
-            'name',
-            'ctime-sec',
-            'ctime-nano',
-            'mtime-sec',
-            'mtime-nano',
-            'dev',
-            'ino',
-            'mode',
-            'uid',
-            'gid',
-            'file size',
-            'sha1',
-            'flags',
-        ]
-
-        # XXX: This is a temporary hack
-        # TODO: Fix index parse to not read empty index entries
-        # TODO: Figure out WTF the string literal "b''" is doing here...
-        #       frikkin' Python, man, I tell you...
-        if entry['name'] == "b''":
-            return
-
-        print('+' + '-' * 78 + '+')
-        s = 'Index Entry'
-        s = '{0: ^78}'.format(s)
-        print('|' + s + '|')
-        print('+' + '-' * 78 + '+')
-
-        for key in fields:
-            print('| {:11}:'.format(key) + entry[key])
-
-        print('+' + ('-' * 78) + '+')
-        print()
+    def read_stat_data(self, buf, offset):
+        names = ('ctime_sec', 'ctime_nsec', 'mtime_sec', 'mtime_nsec', 'dev',
+                 'ino', 'uid', 'gid', 'size')
+        values = self.STAT_DATA.unpack_from(buf, offset)
+        return dict(zip(names, values)), offset + self.STAT_DATA.size
+
+    def read_cstring(self, buf, offset):
+        nul = self.find(buf, ZEROBYTES, offset)
+        return bytes(buf[offset:nul]).decode('utf-8', 'surrogateescape'), nul + 1
+
+    def read_untracked_cache(self, buf, offset, end):
+        """ UNTR: the untracked cache. Returns a dictionary describing the
+            environment it is valid for, the exclude files it was built with
+            and a 'directories' list in depth-first order, each with its
+            untracked names and (where recorded) stat data and the sha1 of
+            its exclude file.
+        """
+        result = {}
+        ident_len, offset = decode_varint(buf, offset)
+        idents = bytes(buf[offset:offset + ident_len]).split(ZEROBYTES)
+        result['environment'] = [i.decode('utf-8', 'surrogateescape')
+                                 for i in idents if i]
+        offset += ident_len
+        result['info/exclude stat'], offset = self.read_stat_data(buf, offset)
+        result['excludes file stat'], offset = self.read_stat_data(buf, offset)
+        result['dir flags'], = struct.unpack_from('>L', buf, offset)
+        offset += 4
+        result['info/exclude sha1'] = buf[offset:offset + self.HASH_SIZE].hex()
+        offset += self.HASH_SIZE
+        result['excludes file sha1'] = buf[offset:offset + self.HASH_SIZE].hex()
+        offset += self.HASH_SIZE
+        result['exclude per dir'], offset = self.read_cstring(buf, offset)
+
+        count, offset = decode_varint(buf, offset)
+        directories = []
+        result['directories'] = directories
+        if count == 0:
+            return result
+
+        # Directory blocks come in depth-first order; each says how many
+        # of the following blocks are its subdirectories.
+        def read_directory():
+            nonlocal offset
+            untracked, offset = decode_varint(buf, offset)
+            subdirs, offset = decode_varint(buf, offset)
+            d = {}
+            d['name'], offset = self.read_cstring(buf, offset)
+            d['untracked'] = []
+            for _ in range(untracked):
+                name, offset = self.read_cstring(buf, offset)
+                d['untracked'].append(name)
+            d['subdirectories'] = subdirs
+            directories.append(d)
+            for _ in range(subdirs):
+                read_directory()
+
+        read_directory()
+        # Then three bitmaps over the directories: which are valid (and so
+        # have stat data), which are check-only, and which have a hash of
+        # their per-directory exclude file; then the stat data and hashes.
+        valid, offset = read_ewah(buf, offset)
+        check_only, offset = read_ewah(buf, offset)
+        has_sha1, offset = read_ewah(buf, offset)
+        for d in directories:
+            d['valid'] = False
+            d['check only'] = False
+        for i in check_only:
+            directories[i]['check only'] = True
+        for i in valid:
+            directories[i]['valid'] = True
+            directories[i]['stat'], offset = self.read_stat_data(buf, offset)
+        for i in has_sha1:
+            directories[i]['exclude sha1'] = buf[offset:offset + self.HASH_SIZE].hex()
+            offset += self.HASH_SIZE
+        return result
 
-    def bytes_to_int(self, bs):
-        result = 0
-        for b in bs:
-            result += 256 * result + int(b)
+    def read_fsmonitor(self, buf, offset, end):
+        """ FSMN: when the file system monitor was last queried and which
+            entries it has not vouched for ('dirty' row numbers)
+        """
+        version, = struct.unpack_from('>L', buf, offset)
+        offset += 4
+        result = {'version': version}
+        if version == 1:
+            result['token'], = struct.unpack_from('>Q', buf, offset)
+            offset += 8
+        else:
+            result['token'], offset = self.read_cstring(buf, offset)
+        offset += 4   # size of the bitmap that follows
+        result['dirty'], offset = read_ewah(buf, offset)
         return result
 
-    def strip_zeros_from_bytes(self, bs):
-        size = len(bs)
-        i = 0
-        while i < size and bs[i] == 0:
-            i += 1
-        return bs[i:]
+    def read_end_of_index(self, buf, offset, end):
+        """ EOIE: where the extensions start, and a hash of their headers """
+        ext_offset, = struct.unpack_from('>L', buf, offset)
+        return {'offset': ext_offset,
+                'hash': buf[offset + 4:offset + 4 + self.HASH_SIZE].hex()}
+
+    def read_entry_offsets(self, buf, offset, end):
+        """ IEOT: blocks of entries that can be parsed independently, as a
+            list of (offset of first entry, number of entries)
+        """
+        version, = struct.unpack_from('>L', buf, offset)
+        offset += 4
+        count = (end - offset) // 8
+        pairs = struct.unpack_from('>{}L'.format(2 * count), buf, offset)
+        blocks = list(zip(pairs[0::2], pairs[1::2]))
+        return {'version': version, 'blocks': blocks}
+
+    def read_split_index(self, buf, offset, end):
+        """ link: the shared index this one is split from, and which of its
+            entries are deleted or replaced
+        """
+        result = {'shared index': buf[offset:offset + self.HASH_SIZE].hex(),
+                  'delete': [], 'replace': []}
+        offset += self.HASH_SIZE
+        if offset < end:
+            result['delete'], offset = read_ewah(buf, offset)
+            result['replace'], offset = read_ewah(buf, offset)
+        return result
+
+    def read_sparse_directories(self, buf, offset, end):
+        """ sdir: only marks that the index may hold sparse directories """
+        return True
+
+    def read_index_entry(self, buf, offset, table, previous_name=b''):
+        """ Add the index entry starting at buf[offset] to table; return the
+            offset of the next entry and this entry's raw name (which v4
+            indexes compress the next name against)
+        """
+        start = offset
+        header = buf[offset:offset + self.ENTRY.size]
+        flags = int.from_bytes(header[60:62], 'big')
+        offset += self.ENTRY.size
+
+        extended_flags = 0
+        if self.version >= 3 and flags & self.FLAG_EXTENDED:
+            extended_flags = self.EXTENDED_FLAGS.unpack_from(buf, offset)[0]
+            offset += self.EXTENDED_FLAGS.size
+
+        if self.version >= 4:
+            # The name is stored as how many bytes to drop from the end of
+            # the previous entry's name, then a NUL terminated suffix; there
+            # is no padding.
+            strip, offset = decode_varint(buf, offset)
+            nul = self.find(buf, ZEROBYTES, offset)
+            prefix = previous_name[:len(previous_name) - strip]
+            raw = prefix + bytes(buf[offset:nul])
+            offset = nul + 1
+        else:
+            namelen = flags & self.NAME_MASK
+            if namelen == self.NAME_MASK:   # Name too long to fit in the flags
+                namelen = self.find(buf, ZEROBYTES, offset) - offset
+            raw = bytes(buf[offset:offset + namelen])
+            offset += namelen
+            # Entries are NUL padded (by 1 to 8 bytes) to a multiple of 8 bytes
+            offset = start + ((offset - start + 8) & ~7)
+
+        table.append(header, extended_flags, raw.decode('utf-8', 'surrogateescape'),
+                     start)
+        return offset, raw
+
+    def index_entry(self, i):
+        """ Entry i as a dictionary with hex string values """
+        t = self.table
+        entry = {}
+        for key, field in zip(self.ENTRY_FIELDS, IndexTable.STAT_FIELDS):
+            entry[key] = hex(getattr(t, field)[i])
+        entry['sha1'] = t.sha1(i)
+        entry['flags'] = hex(t.flags[i])
+        if t.extended_flags[i]:
+            entry['extended flags'] = hex(t.extended_flags[i])
+        entry['name'] = t.paths[i]
+        return entry
+
+    @property
+    def indexEntries(self):
+        """ Every entry as a dictionary with hex string values """
+        if self._index_entries is None:
+            self._index_entries = [self.index_entry(i) for i in range(len(self.table))]
+        return self._index_entries
+
+    def bytes_to_int(self, bs):
+        """ Big-endian (network order) bytes to int """
+        return int.from_bytes(bs, 'big')
 
-    def read_bytes_til_nul(self, bs, strip_nul=True):
-        i = bs.find(ZEROBYTES)
+    def find(self, buf, delim, offset):
+        """ Index of the first delim at or after offset in the memoryview buf """
+        i = buf.obj.find(delim, offset)
         if i < 0:
-            return (None, bs)
-        if strip_nul:
-            return (bs[:i], bs[i:].strip(ZEROBYTES))
-        return (bs[:i], bs[i:])
-
-    def read_bytes_til(self, xs, delim=ZEROBYTES):
-        i = xs.find(delim)
-        if i < 1:
-            return None, xs
-        return xs[:i], xs[i:]
+            raise ValueError('Malformed index: missing {!r} after offset {}'
+                             .format(delim, offset))
+        return i
+
+
+GitIndex.EXTENSION_DECODERS = {
+    b'TREE': GitIndex.read_tree_extension,
+    b'REUC': GitIndex.read_resolve_undo,
+    b'link': GitIndex.read_split_index,
+    b'UNTR': GitIndex.read_untracked_cache,
+    b'FSMN': GitIndex.read_fsmonitor,
+    b'EOIE': GitIndex.read_end_of_index,
+    b'IEOT': GitIndex.read_entry_offsets,
+    b'sdir': GitIndex.read_sparse_directories,
+}
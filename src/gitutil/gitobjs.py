@@ -1,39 +1,570 @@
 """
     gitobjs.py represents Git atomics - commits, HEAD, index, etc.
+
+    Objects are read from a repository's object database through GitObjects:
+
+        objects = GitObjects('path/to/.git')
+        commit = objects[sha1]          # a GitCommitObj
+        for mode, name, sha1 in objects[commit.tree]:
+            ...
+
+    Looking an object up only inflates as much of it as is needed to read its
+    type and size; the rest is decompressed the first time the object's body
+    (or anything parsed from it) is asked for.
+
+    New loose objects are written with GitObjects.write_object.
 """
+import hashlib
+import os
+import tempfile
+import zlib
+from collections import OrderedDict
+from os import listdir, path, walk
+
 from gitutil.git_fs import GitIndex
+from gitutil.packfile import DeltaBaseCache, Pack
 
+CHUNK_SIZE = 1 << 16
+
+
+class GitObject:
+    """ An object in the object database: its sha1, type and size, plus a
+        body that is read (through store) on first use
+    """
+    type = None
+
+    def __init__(self, sha1, size, store=None, body=None):
+        self.sha1 = sha1
+        self.size = size
+        self.store = store
+        self._body = body
+
+    @property
+    def body(self):
+        """ The object's contents, without the 'type size\\0' header """
+        if self._body is None:
+            self._body = self.store.read_body(self.sha1)
+        return self._body
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.sha1)
 
-class GitBranch:
-    """GitBranch represents a branch in Git."""
-    pass
 
+class GitBlob(GitObject):
+    """Represents the contents of a file"""
+    type = 'blob'
 
-class GitCommitObj:
+
+def parse_headers(body):
+    """ Split a commit or tag body into its header lines (a list of
+        (key, value) pairs, continuation lines folded into the value) and the
+        message that follows the first blank line
+    """
+    head, _, message = body.partition(b'\n\n')
+    headers = []
+    for line in head.split(b'\n'):
+        if line.startswith(b' ') and headers:
+            key, value = headers[-1]
+            headers[-1] = (key, value + '\n' + line[1:].decode('utf-8', 'replace'))
+        elif line:
+            key, _, value = line.partition(b' ')
+            headers.append((key.decode('ascii'), value.decode('utf-8', 'replace')))
+    return headers, message.decode('utf-8', 'replace')
+
+
+def signature_time(signature):
+    """ The time (seconds since the epoch) in an author or committer line
+        such as 'A U Thor <author@example.com> 1112912053 -0700'
+    """
+    if not signature:
+        return 0
+    fields = signature.rsplit(' ', 2)
+    try:
+        return int(fields[-2])
+    except (IndexError, ValueError):
+        return 0
+
+
+class HeaderObject(GitObject):
+    """ A commit or tag: header lines, a blank line, then a message """
+
+    def __init__(self, sha1, size, store=None, body=None):
+        super().__init__(sha1, size, store, body)
+        self._headers = None
+        self._message = None
+
+    def parse(self):
+        """ The (key, value) header lines, parsed on first use """
+        if self._headers is None:
+            self._headers, self._message = parse_headers(self.body)
+        return self._headers
+
+    def header(self, key):
+        """ The first value of the header line key, or None """
+        for k, v in self.parse():
+            if k == key:
+                return v
+        return None
+
+    @property
+    def message(self):
+        self.parse()
+        return self._message
+
+
+class GitCommitObj(HeaderObject):
     """Represents a commit"""
-    pass
+    type = 'commit'
+
+    @property
+    def tree(self):
+        return self.header('tree')
+
+    @property
+    def parents(self):
+        return [v for k, v in self.parse() if k == 'parent']
+
+    @property
+    def author(self):
+        return self.header('author')
+
+    @property
+    def committer(self):
+        return self.header('committer')
+
+    @property
+    def commit_time(self):
+        return signature_time(self.committer)
 
 
 class Git_COMMIT_EDITMSG:
     pass
 
 
+class GitRef:
+    """ A named reference such as refs/tags/v1 and the sha1 it points at.
+        peeled is the object an annotated tag points at, when packed-refs
+        records it.
+    """
+
+    def __init__(self, name, sha1, peeled=None):
+        self.name = name
+        self.sha1 = sha1
+        self.peeled = peeled
+
+    @property
+    def target(self):
+        """ The sha1 this ref ends up at (past any annotated tag we know of) """
+        return self.peeled or self.sha1
+
+    def __eq__(self, other):
+        return (isinstance(other, GitRef) and self.name == other.name and
+                self.sha1 == other.sha1)
+
+    def __hash__(self):
+        return hash((self.name, self.sha1))
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(type(self).__name__, self.name, self.sha1)
+
+
+class GitBranch(GitRef):
+    """GitBranch represents a branch in Git."""
+    PREFIX = 'refs/heads/'
+
+    @property
+    def branch(self):
+        """ The branch name, e.g. 'master' """
+        return self.name[len(self.PREFIX):]
+
+
 class GitHead:
     """GitHead represents the HEAD ref"""
-    pass
+
+    def __init__(self, ref=None, sha1=None):
+        """
+        :param ref: the ref HEAD points at ('refs/heads/master'), or None if
+        HEAD is detached
+        :param sha1: the commit HEAD resolves to (None on an unborn branch)
+        """
+        self.ref = ref
+        self.sha1 = sha1
+
+    @property
+    def detached(self):
+        return self.ref is None
+
+    def __repr__(self):
+        return '<GitHead {} {}>'.format(self.ref or '(detached)', self.sha1)
+
+
+def make_ref(name, sha1, peeled=None):
+    cls = GitBranch if name.startswith(GitBranch.PREFIX) else GitRef
+    return cls(name, sha1, peeled)
+
+
+def read_packed_refs(gitdir):
+    """ The refs in .git/packed-refs, by name """
+    refs = {}
+    try:
+        with open(path.join(gitdir, 'packed-refs')) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return refs
+    last = None
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('^'):
+            if last is not None:
+                last.peeled = line[1:]
+            continue
+        sha1, name = line.split(' ', 1)
+        last = refs[name] = make_ref(name, sha1)
+    return refs
+
+
+def read_refs(gitdir):
+    """ Every ref under refs/, from packed-refs and the loose ref files (which
+        win over packed ones), by name. Symbolic refs such as
+        refs/remotes/origin/HEAD are resolved.
+    """
+    refs = read_packed_refs(gitdir)
+    symbolic = {}
+    top = path.join(gitdir, 'refs')
+    for dirpath, dirnames, fnames in walk(top):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            filename = path.join(dirpath, fname)
+            name = 'refs/' + path.relpath(filename, top).replace(path.sep, '/')
+            with open(filename) as f:
+                value = f.read().strip()
+            if value.startswith('ref: '):
+                symbolic[name] = value[5:]
+            elif value:
+                refs[name] = make_ref(name, value)
+    for name, target in symbolic.items():
+        for _ in range(10):   # git's limit on symbolic ref depth, roughly
+            if target not in symbolic:
+                break
+            target = symbolic[target]
+        if target in refs:
+            refs[name] = make_ref(name, refs[target].sha1)
+    return dict(sorted(refs.items()))
+
+
+def read_head(gitdir, refs=None):
+    """ The GitHead of a .git directory (refs: read_refs(gitdir), if the
+        caller already has them)
+    """
+    with open(path.join(gitdir, 'HEAD')) as f:
+        value = f.read().strip()
+    if not value.startswith('ref: '):
+        return GitHead(None, value)
+    name = value[5:]
+    if refs is None:
+        refs = read_refs(gitdir)
+    ref = refs.get(name)
+    return GitHead(name, ref.sha1 if ref is not None else None)
+
+
+class GitTag(HeaderObject):
+    """Represents an annotated tag"""
+    type = 'tag'
+
+    @property
+    def object(self):
+        """ sha1 of the tagged object """
+        return self.header('object')
+
+    @property
+    def tag(self):
+        return self.header('tag')
+
+
+class GitTree(GitObject):
+    """Represents a tree object: a list of (mode, name, sha1) entries"""
+    type = 'tree'
+
+    def __init__(self, sha1, size, store=None, body=None):
+        super().__init__(sha1, size, store, body)
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            body = self.body
+            entries = []
+            offset = 0
+            while offset < len(body):
+                space = body.index(b' ', offset)
+                nul = body.index(b'\0', space)
+                mode = body[offset:space].decode('ascii')
+                name = body[space + 1:nul].decode('utf-8', 'surrogateescape')
+                entries.append((mode, name, body[nul + 1:nul + 21].hex()))
+                offset = nul + 21
+            self._entries = entries
+        return self._entries
+
+    def get(self, name):
+        """ The (mode, sha1) of the entry called name, or None """
+        for mode, n, sha1 in self.entries:
+            if n == name:
+                return mode, sha1
+        return None
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+OBJECT_TYPES = {cls.type: cls for cls in (GitBlob, GitCommitObj, GitTree, GitTag)}
+
+
+class ObjectCache:
+    """ A least recently used cache holding at most maxsize objects """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+
+def parse_object_header(header, sha1):
+    """ (type, size) from a 'type size' object header """
+    try:
+        tp, size = header.split(b' ')
+        return tp.decode('ascii'), int(size)
+    except ValueError:
+        raise ValueError('Bad header in object {}: {!r}'.format(sha1, header))
 
 
 class GitObjects:
-    pass
+    """
+        The object database of a .git directory. Loose objects are inflated
+        with zlib as a stream, so a large blob never has to be held in memory
+        compressed and decompressed at once. Packed objects are read through
+        memory-mapped packs (see packfile.py). The objects that have been
+        looked up are kept in an LRU cache keyed by sha1.
+    """
 
+    def __init__(self, gitdir, cache_size=1024, delta_cache_bytes=32 << 20):
+        """
+        :param gitdir: the .git directory
+        :param cache_size: how many objects to keep in the cache
+        :param delta_cache_bytes: how much resolved delta base data the packs
+        may keep
+        """
+        self.gitdir = gitdir
+        self.objects_dir = path.join(gitdir, 'objects')
+        self.cache = ObjectCache(cache_size)
+        self.base_cache = DeltaBaseCache(delta_cache_bytes)
+        self._packs = None   # pack filename -> Pack
 
-class GitRef:
-    pass
+    @property
+    def packs(self):
+        """ The packs of the repository, opened on first use """
+        if self._packs is None:
+            self.refresh_packs()
+        return list(self._packs.values())
 
+    def refresh_packs(self):
+        """ Pick up packs added (or drop packs removed) since they were opened """
+        old = self._packs or {}
+        packs = {}
+        pack_dir = path.join(self.objects_dir, 'pack')
+        if path.isdir(pack_dir):
+            for name in sorted(listdir(pack_dir)):
+                if not name.endswith('.pack'):
+                    continue
+                filename = path.join(pack_dir, name)
+                if filename in old:
+                    packs[filename] = old.pop(filename)
+                elif path.exists(filename[:-len('.pack')] + '.idx'):
+                    packs[filename] = Pack(filename, self.base_cache,
+                                           self.read_object, self.read_header)
+        for pack in old.values():
+            pack.close()
+        self._packs = packs
 
-class GitTree:
-    """Represents a tree object"""
-    pass
+    def find_pack(self, sha1):
+        """ The pack holding sha1, or None """
+        raw = bytes.fromhex(sha1)
+        for pack in self.packs:
+            if pack.index.find(raw) is not None:
+                return pack
+        return None
+
+    def close(self):
+        for pack in (self._packs or {}).values():
+            pack.close()
+        self._packs = None
+
+    def loose_path(self, sha1):
+        return path.join(self.objects_dir, sha1[:2], sha1[2:])
+
+    def loose_sha1s(self):
+        """ The sha1s of every loose object """
+        result = []
+        if not path.isdir(self.objects_dir):
+            return result
+        for d in sorted(listdir(self.objects_dir)):
+            if len(d) != 2:
+                continue   # info/, pack/
+            for name in sorted(listdir(path.join(self.objects_dir, d))):
+                if len(name) == 38:
+                    result.append(d + name)
+        return result
+
+    def sha1s(self):
+        """ The sha1s of every object, loose or packed """
+        result = set(self.loose_sha1s())
+        for pack in self.packs:
+            result.update(pack.sha1s())
+        return sorted(result)
+
+    def __contains__(self, sha1):
+        return (sha1 in self.cache or path.exists(self.loose_path(sha1)) or
+                self.find_pack(sha1) is not None)
+
+    def __getitem__(self, sha1):
+        obj = self.cache.get(sha1)
+        if obj is None:
+            tp, size = self.read_header(sha1)
+            cls = OBJECT_TYPES.get(tp)
+            if cls is None:
+                raise ValueError('Unknown type {!r} of object {}'.format(tp, sha1))
+            obj = cls(sha1, size, self)
+            self.cache.put(sha1, obj)
+        return obj
+
+    def get(self, sha1, default=None):
+        try:
+            return self[sha1]
+        except KeyError:
+            return default
+
+    def open_loose(self, sha1):
+        try:
+            return open(self.loose_path(sha1), 'rb')
+        except FileNotFoundError:
+            raise KeyError(sha1)
+
+    def locate(self, sha1):
+        """ The pack holding sha1, or None if it is a loose object """
+        pack = self.find_pack(sha1)
+        if pack is None and not path.exists(self.loose_path(sha1)):
+            # Perhaps it was just packed by git gc or fetched
+            self.refresh_packs()
+            pack = self.find_pack(sha1)
+        return pack
+
+    def read_object(self, sha1):
+        """ (type, body) of an object """
+        obj = self[sha1]
+        return obj.type, obj.body
+
+    def read_header(self, sha1):
+        """ The (type, size) of an object, inflating only its header """
+        pack = self.locate(sha1)
+        if pack is not None:
+            return pack.read_header(sha1)
+        with self.open_loose(sha1) as f:
+            inflater = zlib.decompressobj()
+            out = b''
+            while b'\0' not in out:
+                data = inflater.unconsumed_tail or f.read(512)
+                if not data:
+                    raise ValueError('Truncated object ' + sha1)
+                out += inflater.decompress(data, 64)
+        return parse_object_header(out[:out.index(b'\0')], sha1)
+
+    def stream(self, sha1):
+        """ Yield the body of an object in chunks as it is inflated """
+        pack = self.locate(sha1)
+        if pack is not None:
+            yield pack.read_object(sha1)[1]
+            return
+        with self.open_loose(sha1) as f:
+            inflater = zlib.decompressobj()
+            header = b''
+            size = None
+            seen = 0
+            while True:
+                data = f.read(CHUNK_SIZE)
+                chunk = inflater.decompress(data) if data else inflater.flush()
+                if size is None:
+                    header += chunk
+                    if b'\0' not in header:
+                        if not data:
+                            raise ValueError('Truncated object ' + sha1)
+                        continue
+                    nul = header.index(b'\0')
+                    _, size = parse_object_header(header[:nul], sha1)
+                    chunk = header[nul + 1:]
+                if chunk:
+                    seen += len(chunk)
+                    yield chunk
+                if not data:
+                    break
+            if seen != size:
+                raise ValueError('Object {} is {} bytes, expected {}'
+                                 .format(sha1, seen, size))
+
+    def read_body(self, sha1):
+        """ The whole body of an object """
+        return b''.join(self.stream(sha1))
+
+    def write_object(self, tp, body):
+        """ Store body as a loose object of type tp (unless the repository
+            already has it); return its sha1
+        """
+        data = b'%s %d\0' % (tp.encode('ascii'), len(body)) + body
+        sha1 = hashlib.sha1(data).hexdigest()
+        filename = self.loose_path(sha1)
+        if path.exists(filename) or (self._packs and self.find_pack(sha1)):
+            return sha1
+        directory = path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        # Like git, write a temporary file and move it into place so that a
+        # reader never sees part of an object
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='tmp_obj_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(data))
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, filename)
+        except BaseException:
+            if path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return sha1
 
 
 def main():
@@ -0,0 +1,113 @@
+"""
+index_report.py: render a parsed GitIndex as text.
+
+GitIndex only parses; the records it produces (index_entry(),
+cached_tree_entries) are turned into hog's boxed listing here. Output is
+collected a page at a time and written to the stream in one go, so showing
+a large index costs a write per page rather than a dozen print() calls per
+entry, and a parse never waits on a terminal.
+"""
+import sys
+
+WIDTH = 78
+RULE = '+' + '-' * WIDTH + '+'
+
+ENTRY_FIELDS = [
+    'name',
+    'ctime-sec',
+    'ctime-nano',
+    'mtime-sec',
+    'mtime-nano',
+    'dev',
+    'ino',
+    'mode',
+    'uid',
+    'gid',
+    'file size',
+    'sha1',
+    'flags',
+]
+
+TREE_FIELDS = [
+    'path comp',
+    'entries in index',
+    'number of subtrees',
+    'object-name',
+]
+
+
+def title(s):
+    return [RULE, '|' + '{0: ^{1}}'.format(s, WIDTH) + '|', RULE]
+
+
+def format_index_entry(entry):
+    """ The box for one index entry (a dictionary from GitIndex.index_entry) """
+    lines = title('Index Entry')
+    for key in ENTRY_FIELDS:
+        lines.append('| {:11}:'.format(key) + entry[key])
+    lines += [RULE, '']
+    return '\n'.join(lines) + '\n'
+
+
+def format_cached_tree(tree):
+    """ The box for one cached tree (from GitIndex.cached_tree_entries) """
+    lines = title('Cached Tree')
+    for key in TREE_FIELDS:
+        lines.append('| {:20}'.format(key + ':') + tree[key])
+    lines += [RULE, '']
+    return '\n'.join(lines) + '\n'
+
+
+def ask_to_continue():
+    """ The default pause between pages: wait for the user at the terminal """
+    try:
+        answer = input('-- more (q to stop) --')
+    except EOFError:
+        return False
+    return answer.strip().lower() != 'q'
+
+
+def render_index(index, stream=None, limit=None, page_size=None, pause=None,
+                 trees=True):
+    """
+        Write the entries of index, then its cached trees, to stream.
+
+        stream: where to write (default: sys.stdout)
+        limit: show at most this many entries (and cached trees), followed by
+            a line saying how many were left out
+        page_size: write this many boxes at a time, calling pause() between
+            pages; rendering stops if pause() returns False. pause defaults
+            to asking at the terminal.
+        trees: also show the cached tree extension, if there is one
+
+        Returns the number of boxes written.
+    """
+    if stream is None:
+        stream = sys.stdout
+    if page_size is not None and pause is None:
+        pause = ask_to_continue
+
+    sections = [(len(index.table), index.index_entry, format_index_entry, 'entries')]
+    if trees and b'TREE' in index.extension_offsets:
+        tree_list = index.cached_tree_entries
+        sections.append((len(tree_list), tree_list.__getitem__,
+                         format_cached_tree, 'cached trees'))
+
+    page = []
+    boxes = 0
+    for count, record, fmt, what in sections:
+        shown = count if limit is None else min(count, limit)
+        for i in range(shown):
+            if page_size is not None and boxes and boxes % page_size == 0:
+                stream.write(''.join(page))
+                stream.flush()
+                page = []
+                if not pause():
+                    return boxes
+            page.append(fmt(record(i)))
+            boxes += 1
+        if shown < count:
+            page.append('... {} more {} not shown\n\n'.format(count - shown, what))
+    stream.write(''.join(page))
+    stream.flush()
+    return boxes
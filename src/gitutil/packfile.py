@@ -0,0 +1,381 @@
+"""
+packfile.py: read objects out of git packfiles.
+
+A pack-*.pack file holds many compressed objects back to back; its
+pack-*.idx file lists their sha1s in sorted order with a fan-out table in
+front (entry b says how many sha1s start with a byte <= b). Both files are
+memory-mapped, so finding an object is a fan-out lookup and a binary search
+over the mapped index, and reading one only touches the pages it lives on,
+however large the pack is.
+
+Objects may be stored as deltas against another object in the pack, named
+by offset (OFS_DELTA) or by sha1 (REF_DELTA). Resolved delta bases are kept
+in a DeltaBaseCache, since long chains share most of their bases.
+
+    pack = Pack('.git/objects/pack/pack-1234.pack')
+    tp, body = pack.read_object(sha1)
+
+GitObjects uses every pack of a repository this way.
+"""
+import mmap
+import struct
+import zlib
+from collections import OrderedDict
+
+IDX_MAGIC = b'\377tOc'
+PACK_HEADER = struct.Struct('>4sLL')   # 'PACK', version, object count
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+TYPE_NAMES = {OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob',
+              OBJ_TAG: 'tag'}
+
+INFLATE_CHUNK = 1 << 16
+
+
+def map_file(filename):
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class PackIndex:
+    """ A memory-mapped pack .idx file (version 1 or 2) """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.map = map_file(filename)
+        if self.map[:4] == IDX_MAGIC:
+            self.version, = struct.unpack_from('>L', self.map, 4)
+            if self.version != 2:
+                raise ValueError('Unsupported pack index version {} in {}'
+                                 .format(self.version, filename))
+            fanout = 8
+        else:
+            self.version = 1
+            fanout = 0
+        self.fanout = struct.unpack_from('>256L', self.map, fanout)
+        self.count = self.fanout[255]
+        if self.version == 2:
+            self.sha1_offset = fanout + 256 * 4
+            self.sha1_stride = 20
+            self.crc_offset = self.sha1_offset + 20 * self.count
+            self.offset_offset = self.crc_offset + 4 * self.count
+            self.large_offset = self.offset_offset + 4 * self.count
+        else:
+            # Each entry is a 4-byte offset followed by the sha1
+            self.sha1_offset = 256 * 4 + 4
+            self.sha1_stride = 24
+
+    def __len__(self):
+        return self.count
+
+    def sha1(self, i):
+        """ The raw sha1 of the i'th object (in sha1 order) """
+        start = self.sha1_offset + i * self.sha1_stride
+        return self.map[start:start + 20]
+
+    def offset(self, i):
+        """ Where the i'th object starts in the pack """
+        if self.version == 1:
+            return struct.unpack_from('>L', self.map, self.sha1_offset - 4 +
+                                      i * self.sha1_stride)[0]
+        offset, = struct.unpack_from('>L', self.map, self.offset_offset + 4 * i)
+        if offset & 0x80000000:
+            # Packs over 2GB keep larger offsets in a separate table
+            offset, = struct.unpack_from(
+                '>Q', self.map, self.large_offset + 8 * (offset & 0x7fffffff))
+        return offset
+
+    def find(self, sha1):
+        """ The pack offset of the object with the raw 20 byte sha1, or None """
+        first = sha1[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            s = self.sha1(mid)
+            if s < sha1:
+                lo = mid + 1
+            elif s > sha1:
+                hi = mid
+            else:
+                return self.offset(mid)
+        return None
+
+    def sha1s(self):
+        """ Every hex sha1 in the pack, in sorted order """
+        return [self.sha1(i).hex() for i in range(self.count)]
+
+    def close(self):
+        self.map.close()
+
+
+class DeltaBaseCache:
+    """ Resolved delta bases by (pack filename, offset): an LRU bounded by the
+        total size of the bodies it holds. One cache can serve every pack of
+        a repository.
+    """
+
+    def __init__(self, max_bytes=32 << 20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is not None:
+            self.items.move_to_end(key)
+        return item
+
+    def put(self, key, tp, body):
+        if len(body) > self.max_bytes or key in self.items:
+            return
+        self.items[key] = (tp, body)
+        self.nbytes += len(body)
+        while self.nbytes > self.max_bytes:
+            _, (_, old) = self.items.popitem(last=False)
+            self.nbytes -= len(old)
+
+    def drop_pack(self, filename):
+        """ Forget the bases of pack filename (e.g. once it is closed) """
+        for key in [k for k in self.items if k[0] == filename]:
+            self.nbytes -= len(self.items.pop(key)[1])
+
+    def __len__(self):
+        return len(self.items)
+
+
+def read_size(buf, offset):
+    """ A delta's little-endian base 128 size at buf[offset]; return it and
+        the offset past it
+    """
+    size = 0
+    shift = 0
+    while True:
+        c = buf[offset]
+        offset += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, offset
+
+
+def apply_delta(base, delta):
+    """ The object that delta (copy and insert instructions) makes of base """
+    base_size, offset = read_size(delta, 0)
+    if base_size != len(base):
+        raise ValueError('Delta expects a base of {} bytes, not {}'
+                         .format(base_size, len(base)))
+    result_size, offset = read_size(delta, offset)
+    result = bytearray()
+    end = len(delta)
+    while offset < end:
+        op = delta[offset]
+        offset += 1
+        if op & 0x80:
+            # Copy from base: which of the 4 offset and 3 size bytes follow
+            # is given by the low 7 bits of op
+            copy_offset = copy_size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    copy_offset |= delta[offset] << (8 * i)
+                    offset += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    copy_size |= delta[offset] << (8 * i)
+                    offset += 1
+            if copy_size == 0:
+                copy_size = 0x10000
+            result += base[copy_offset:copy_offset + copy_size]
+        elif op:
+            result += delta[offset:offset + op]
+            offset += op
+        else:
+            raise ValueError('Bad delta instruction 0')
+    if len(result) != result_size:
+        raise ValueError('Delta produced {} bytes, expected {}'
+                         .format(len(result), result_size))
+    return bytes(result)
+
+
+class Pack:
+    """ A memory-mapped packfile and its index """
+
+    def __init__(self, filename, base_cache=None, resolve_ref=None,
+                 resolve_header=None):
+        """
+        :param filename: the pack-*.pack file; its .idx must sit next to it
+        :param base_cache: DeltaBaseCache to use (default: a new one)
+        :param resolve_ref: optional callable returning (type, body) for a
+        hex sha1, used for REF_DELTA bases that are not in this pack
+        :param resolve_header: optional callable returning (type, size) for
+        a hex sha1, used instead of resolve_ref when only the type of such a
+        base is needed
+        """
+        self.filename = filename
+        self.index = PackIndex(filename[:-len('.pack')] + '.idx')
+        self.map = map_file(filename)
+        signature, self.version, count = PACK_HEADER.unpack_from(self.map, 0)
+        if signature != b'PACK' or self.version not in (2, 3):
+            raise ValueError('Not a pack file: ' + filename)
+        if count != len(self.index):
+            raise ValueError('{} has {} objects but its index lists {}'
+                             .format(filename, count, len(self.index)))
+        self.base_cache = base_cache if base_cache is not None else DeltaBaseCache()
+        self.resolve_ref = resolve_ref
+        self.resolve_header = resolve_header
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, sha1):
+        return self.index.find(bytes.fromhex(sha1)) is not None
+
+    def find(self, sha1):
+        """ The offset of the object with hex sha1, or None """
+        return self.index.find(bytes.fromhex(sha1))
+
+    def entry_header(self, offset):
+        """ (type number, size, data offset, base) of the entry at offset.
+            For a delta, size is that of the delta data and base is where
+            its base is: an offset into the pack (OFS_DELTA) or a hex sha1
+            (REF_DELTA). Otherwise base is None.
+        """
+        m = self.map
+        start = offset
+        c = m[offset]
+        offset += 1
+        tp = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = m[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if tp == OBJ_OFS_DELTA:
+            c = m[offset]
+            offset += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = m[offset]
+                offset += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            base = start - distance
+        elif tp == OBJ_REF_DELTA:
+            base = m[offset:offset + 20].hex()
+            offset += 20
+        return tp, size, offset, base
+
+    def inflate(self, offset, size, limit=None):
+        """ Inflate the zlib stream at offset, which expands to size bytes.
+            With limit, stop as soon as limit bytes are out.
+        """
+        inflater = zlib.decompressobj()
+        want = size if limit is None else min(size, limit)
+        out = []
+        n = 0
+        end = len(self.map)
+        while n < want and not inflater.eof and offset < end:
+            data = self.map[offset:offset + INFLATE_CHUNK]
+            chunk = inflater.decompress(data, want - n)
+            offset += len(data) - len(inflater.unconsumed_tail)
+            out.append(chunk)
+            n += len(chunk)
+        result = b''.join(out)
+        if limit is None and len(result) != size:
+            raise ValueError('Object in {} inflated to {} bytes, expected {}'
+                             .format(self.filename, len(result), size))
+        return result
+
+    def base_offset(self, base):
+        """ The pack offset of a delta's base, or None if it is named by a
+            sha1 this pack does not have
+        """
+        if isinstance(base, str):
+            return self.find(base)
+        return base
+
+    def object_header(self, offset):
+        """ (type, size) of the object at offset. Only the first bytes of
+            each delta in its chain are inflated (for the result size, and
+            to follow the chain to the type of the object at its bottom).
+        """
+        tp, size, data, base = self.entry_header(offset)
+        if base is None:
+            return TYPE_NAMES[tp], size
+        # A delta starts with the size of its base and of its result
+        head = self.inflate(data, size, limit=20)
+        _, pos = read_size(head, 0)
+        size, _ = read_size(head, pos)
+        while base is not None:
+            base_offset = self.base_offset(base)
+            if base_offset is None:
+                if self.resolve_header is not None:
+                    tp_name, _ = self.resolve_header(base)
+                elif self.resolve_ref is not None:
+                    tp_name, _ = self.resolve_ref(base)
+                else:
+                    raise KeyError(base)
+                return tp_name, size
+            tp, _, _, base = self.entry_header(base_offset)
+        return TYPE_NAMES[tp], size
+
+    def read_at(self, offset):
+        """ (type, body) of the object at offset, resolving deltas """
+        # Walk down the delta chain to a stored object (or a cached base),
+        # then apply the deltas on the way back up. Every object on the way
+        # up but the last is the base of another delta, so it is cached.
+        deltas = []
+        while True:
+            cached = self.base_cache.get((self.filename, offset))
+            if cached is not None:
+                tp, body = cached
+                break
+            tp, size, data, base = self.entry_header(offset)
+            if base is None:
+                tp, body = TYPE_NAMES[tp], self.inflate(data, size)
+                if deltas:
+                    self.base_cache.put((self.filename, offset), tp, body)
+                break
+            deltas.append((offset, data, size))
+            base_offset = self.base_offset(base)
+            if base_offset is None:
+                if self.resolve_ref is None:
+                    raise KeyError(base)
+                tp, body = self.resolve_ref(base)
+                break
+            offset = base_offset
+        for i in range(len(deltas) - 1, -1, -1):
+            offset, data, size = deltas[i]
+            body = apply_delta(body, self.inflate(data, size))
+            if i:
+                self.base_cache.put((self.filename, offset), tp, body)
+        return tp, body
+
+    def read_header(self, sha1):
+        """ (type, size) of the object with hex sha1 """
+        offset = self.find(sha1)
+        if offset is None:
+            raise KeyError(sha1)
+        return self.object_header(offset)
+
+    def read_object(self, sha1):
+        """ (type, body) of the object with hex sha1 """
+        offset = self.find(sha1)
+        if offset is None:
+            raise KeyError(sha1)
+        return self.read_at(offset)
+
+    def sha1s(self):
+        return self.index.sha1s()
+
+    def close(self):
+        self.base_cache.drop_pack(self.filename)
+        self.map.close()
+        self.index.close()
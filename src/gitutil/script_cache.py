@@ -0,0 +1,124 @@
+"""
+script_cache.py: keep parsed command scripts so they need not be parsed again.
+
+A parsed script is compiled to a plan: a list of [command name, arguments...]
+entries that can be written as JSON and turned back into Commands for any
+session. Plans are stored in a cache directory under the sha1 of the script
+they came from, so an edited script simply gets a new plan.
+
+Caching is opt-in: pass a ScriptCache to GitSession.load_script (or
+run_script) to use it.
+
+The cache directory is $HOG_CACHE_DIR if set, otherwise hog/plans under
+$XDG_CACHE_HOME (~/.cache by default).
+"""
+import hashlib
+import json
+import os
+from os import path
+import tempfile
+
+from gitutil.commands import (CommandParser, Add, Branch, Checkout, Commit,
+                              CreateFile, CreateDirectory, AppendLineToFile)
+
+# Bump when the plan format or the meaning of a command changes
+PLAN_VERSION = 1
+
+# Command class -> the attributes its constructor takes (after the session)
+PLAN_FIELDS = {
+    Add: ('files',),
+    Branch: ('branch_name',),
+    Checkout: ('branch_name',),
+    Commit: ('message',),
+    CreateFile: ('path',),
+    CreateDirectory: ('path',),
+    AppendLineToFile: ('file', 'line'),
+}
+PLAN_COMMANDS = {cls.__name__: cls for cls in PLAN_FIELDS}
+
+
+def default_cache_dir():
+    if os.environ.get('HOG_CACHE_DIR'):
+        return os.environ['HOG_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+    return path.join(base, 'hog', 'plans')
+
+
+def compile_plan(commands):
+    """ The plan (a JSON-friendly list) for a list of parsed Commands """
+    plan = []
+    for c in commands:
+        fields = PLAN_FIELDS.get(type(c))
+        if fields is None:
+            raise ValueError('Cannot compile command {!r}'.format(c))
+        plan.append([type(c).__name__] + [getattr(c, f) for f in fields])
+    return plan
+
+
+def load_plan(plan, session):
+    """ The Commands of a plan, bound to session """
+    return [PLAN_COMMANDS[entry[0]](session, *entry[1:]) for entry in plan]
+
+
+class ScriptCache:
+    """ Compiled plans of command scripts, stored by content hash """
+
+    def __init__(self, directory=None):
+        self.directory = directory or default_cache_dir()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, script):
+        h = hashlib.sha1(script.encode('utf-8'))
+        h.update(b'\0plan version %d' % PLAN_VERSION)
+        return h.hexdigest()
+
+    def plan_path(self, key):
+        return path.join(self.directory, key[:2], key[2:] + '.json')
+
+    def get(self, key):
+        """ The plan stored under key, or None """
+        try:
+            with open(self.plan_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None   # Missing, or unreadable: it will be rewritten
+
+    def put(self, key, plan):
+        filename = self.plan_path(key)
+        try:
+            os.makedirs(path.dirname(filename), exist_ok=True)
+            # Write to a temporary file first so a reader never sees half
+            # a plan
+            fd, tmp = tempfile.mkstemp(dir=path.dirname(filename), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(plan, f)
+            os.replace(tmp, filename)
+        except OSError:
+            pass   # A cache we cannot write to is just a cache miss next time
+
+    def load(self, script, session):
+        """ The Commands of script (its text), from its cached plan when
+            there is one; otherwise it is parsed and its plan stored
+        """
+        key = self.key(script)
+        plan = self.get(key)
+        if plan is not None:
+            try:
+                commands = load_plan(plan, session)
+                self.hits += 1
+                return commands
+            except (KeyError, IndexError, TypeError):
+                pass
+        self.misses += 1
+        commands = CommandParser(session).parse(script)
+        try:
+            plan = compile_plan(commands)
+        except ValueError:
+            return commands
+        self.put(key, plan)
+        return commands
+
+    def load_file(self, script_name, session):
+        with open(script_name) as f:
+            return self.load(f.read(), session)
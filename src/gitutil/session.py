@@ -4,7 +4,9 @@ import shutil
 import tempfile
 import git
 
-from gitutil.commands import CommandParser
+from gitutil.backend import SubprocessBackend
+from gitutil.commands import BatchExecutor, CommandParser
+from gitutil.fast_import import can_import, fast_import
 
 join = osp.join
 
@@ -17,11 +19,14 @@ class GitSession:
     (if one is not provided) and initializing a git repository in it. If a
     directory is provided and there is already a repository, throw an exception.
     """
-    def __init__(self, dir=None, create_repo=True):
+    def __init__(self, dir=None, create_repo=True, backend=None):
         """
         Create a new GitSession
         :param dir: directory to work in (default creates a tmp directory)
         :param create_repo: True to initialize a repository (Not implemented)
+        :param backend: the gitutil.backend class that carries out the git
+        commands of scripts (default SubprocessBackend; PlumbingBackend
+        does without git processes)
         """
         self._dir = dir
         if dir is None:
@@ -36,6 +41,7 @@ class GitSession:
 
         self._repo = git.Repo(self._dir)
         self.git = self._repo.git
+        self.backend = (backend or SubprocessBackend)(self)
 
     def dir(self):
         return self._dir
@@ -48,24 +54,42 @@ class GitSession:
         del self._repo
         del self.git
 
-    def load_script(self, script_name):
-        with open(script_name) as f:
-            script = f.read()
-
-        parser = CommandParser(self)
-        commands = parser.parse(script)
-        return commands
+    def load_script(self, script_name, cache=None):
+        """
+        Parse a command script into Commands for this session
+        :param script_name: the script file
+        :param cache: optional ScriptCache to take the compiled script from
+        (e.g. ScriptCache() for the default cache directory). Without one
+        the script is parsed and nothing is written to disk.
+        """
+        if cache is None:
+            return CommandParser(self).parse_file(script_name)
+        return cache.load_file(script_name, self)
 
-    def run_script(self, script_name):
-        commands = self.load_script(script_name)
-        for c in commands:
-            c.execute()
+    def run_script(self, script_name, cache=None, batch=True):
+        """
+        Run a command script in this session
+        :param batch: run it through a BatchExecutor (False: execute each
+        command on its own)
+        """
+        commands = self.load_script(script_name, cache)
+        if batch:
+            BatchExecutor(self).run(commands)
+        else:
+            for c in commands:
+                c.execute()
 
 
 class AutoGenGitRepo:
     """
     In the interest of automatically creating a git repository, this class
     generates a commit history for a particular lesson.
+
+    When the session's repository is new and empty, the whole history is
+    written by a single `git fast-import` (see gitutil.fast_import) rather
+    than a git operation per command; the result is the same repository
+    (trees, messages, parents, branches, HEAD, index and work tree). Anything
+    else runs the commands one by one.
     """
     def __init__(self, session, to_run=None):
         """
@@ -74,3 +98,18 @@ class AutoGenGitRepo:
         """
         self.session = session
         self.to_run = to_run
+
+    def run(self, to_run=None):
+        """
+        Build the repository
+        :param to_run: the commands to run (default self.to_run)
+        """
+        commands = list(self.to_run if to_run is None else to_run)
+        if can_import(self.session, commands):
+            return fast_import(self.session, commands)
+        BatchExecutor(self.session).run(commands)
+
+    @classmethod
+    def from_script(cls, session, script_name, cache=None):
+        """ An AutoGenGitRepo for the commands of a script """
+        return cls(session, session.load_script(script_name, cache))
@@ -0,0 +1,64 @@
+"""
+Helpers for tests that build the same repository two ways (a script run
+command by command, batched, through another backend or fast-import) and
+check that the results match.
+"""
+import os
+from os.path import join, relpath
+from unittest import TestCase
+
+from gitutil.session import GitSession
+
+
+def repo_state(session):
+    """ Everything running a script leaves behind, apart from dates (and so
+        commit sha1s): the index, HEAD, status, staged changes, the work
+        tree's directories and files, and each branch's history of trees,
+        messages and parent counts
+    """
+    g = session.git
+    files = {}
+    dirs = []
+    for root, ds, names in os.walk(session.dir()):
+        ds[:] = [d for d in ds if d != '.git']
+        dirs.extend(relpath(join(root, d), session.dir()) for d in ds)
+        for name in names:
+            with open(join(root, name)) as f:
+                files[relpath(join(root, name), session.dir())] = f.read()
+    branches = {}
+    for ref in g.for_each_ref('--format=%(refname)', 'refs/heads').split():
+        parents = [len(line.split()) - 1 for line in
+                   g.rev_list('--parents', ref).splitlines()]
+        branches[ref] = parents, g.log('--format=%T %s', ref)
+    return (g.ls_files('-s'), g.rev_parse('--symbolic-full-name', 'HEAD'),
+            g.status('--porcelain'), g.diff('--cached', '--stat'),
+            sorted(dirs), files, branches)
+
+
+class SessionTestCase(TestCase):
+    """ A TestCase whose sessions (from new_session) are cleaned up after
+        each test
+    """
+
+    def setUp(self):
+        self.sessions = []
+
+    def tearDown(self):
+        for s in self.sessions:
+            s.cleanup()
+
+    def new_session(self, backend=None):
+        """ A new session with HEAD on master, whatever git's default """
+        s = GitSession(backend=backend)
+        self.sessions.append(s)
+        s.git.symbolic_ref('HEAD', 'refs/heads/master')
+        return s
+
+    def run_script(self, session, script, batch=False):
+        filename = join(session.dir(), '.git', 'script.gcs')
+        with open(filename, 'w') as f:
+            f.write(script)
+        session.run_script(filename, batch=batch)
+
+    def assertSameRepository(self, expected, actual):
+        self.assertEqual(repo_state(expected), repo_state(actual))
@@ -0,0 +1,143 @@
+import os
+from os.path import join
+from unittest.mock import patch
+
+import git
+
+from gitutil.backend import PlumbingBackend, SubprocessBackend
+from gitutil.test.repo_state import SessionTestCase
+
+SCRIPT = '''touch f1
+>> f1 "one"
+mkdir d1
+mkdir d1/d2
+touch d1/f2
+touch d1/d2/f3
+>> d1/d2/f3 "deep"
+add (f1, d1)
+commit "first"
+branch b1
+>> f1 "two"
+touch d1/f2
+>> d1/f2 "changed"
+add (f1)
+add (d1/f2)
+commit "second"
+checkout b1
+touch d1/new
+add (d1)
+commit "on b1"
+branch b2
+checkout master
+>> f1 "three"
+add (f1)
+commit "third"
+checkout b2
+'''
+
+
+class TestBackend(SessionTestCase):
+
+    def test_same_as_subprocess(self):
+        for batch in (False, True):
+            expected = self.new_session(SubprocessBackend)
+            self.run_script(expected, SCRIPT, batch)
+            plumbing = self.new_session(PlumbingBackend)
+            with patch.object(git.cmd.Git, 'execute', side_effect=AssertionError):
+                self.run_script(plumbing, SCRIPT, batch)
+            self.assertSameRepository(expected, plumbing)
+            plumbing.git.fsck('--strict')
+
+    def test_modes_and_deletes(self):
+        expected = self.new_session(SubprocessBackend)
+        plumbing = self.new_session(PlumbingBackend)
+        for s in (expected, plumbing):
+            d = s.dir()
+            os.makedirs(join(d, 'a', 'b'))
+            with open(join(d, 'a', 'b', 'run'), 'w') as f:
+                f.write('#!/bin/sh\n')
+            os.chmod(join(d, 'a', 'b', 'run'), 0o755)
+            os.symlink('b/run', join(d, 'a', 'link'))
+            with open(join(d, 'gone'), 'w') as f:
+                f.write('x\n')
+            s.backend.add(['.'])
+            s.backend.commit('first')
+            os.remove(join(d, 'gone'))
+            os.remove(join(d, 'a', 'b', 'run'))
+            os.rmdir(join(d, 'a', 'b'))
+            with open(join(d, 'a', 'b'), 'w') as f:
+                f.write('a file where a directory was\n')
+            s.backend.add(['gone', 'a'])
+            s.backend.commit('second')
+            s.backend.branch('b1')
+            s.git.checkout('-q', 'HEAD~1')   # detached
+            s.backend.commit('detached')
+        self.assertSameRepository(expected, plumbing)
+        self.assertEqual(expected.git.log('--format=%T', 'HEAD'),
+                         plumbing.git.log('--format=%T', 'HEAD'))
+        plumbing.git.fsck('--strict')
+
+    def test_return_values(self):
+        """ commit() and branch() return a git.Commit and git.Head whatever
+            the backend (or the plumbing backend's fallback)
+        """
+        for backend in (SubprocessBackend, PlumbingBackend):
+            s = self.new_session(backend)
+            with open(join(s.dir(), 'f1'), 'w') as f:
+                f.write('one\n')
+            s.backend.add(['f1'])
+            commits = [s.backend.commit('first')]
+            if backend is PlumbingBackend:
+                with patch.object(s.backend, 'entries', return_value=None):
+                    commits.append(s.backend.commit('fallback'))
+            head = s.backend.branch('b1')
+            for c in commits:
+                self.assertIsInstance(c, git.Commit)
+            self.assertEqual(s.git.rev_parse('HEAD'), commits[-1].hexsha)
+            self.assertEqual('first', commits[0].message)
+            self.assertIsInstance(head, git.Head)
+            self.assertEqual('b1', head.name)
+            self.assertEqual(commits[-1], head.commit)
+
+    def test_falls_back_to_git(self):
+        s = self.new_session(PlumbingBackend)
+        d = s.dir()
+        with open(join(d, '.gitignore'), 'w') as f:
+            f.write('*.log\n')
+        for name in ('a.txt', 'b.log'):
+            with open(join(d, name), 'w') as f:
+                f.write(name)
+        with patch.object(s.backend.fallback, 'add', wraps=s.backend.fallback.add) as add:
+            s.backend.add(['.'])
+        add.assert_called_once_with(['.'])
+        self.assertEqual(['.gitignore', 'a.txt'], s.git.ls_files().split())
+        # The plumbing backend picks up the index git wrote
+        s.backend.commit('first')
+        self.assertEqual('', s.git.status('--porcelain', '--untracked-files=no'))
+        self.assertEqual(['.gitignore', 'a.txt'],
+                         s.git.ls_tree('--name-only', 'HEAD').split())
+
+        with open(join(d, 'a.txt'), 'w') as f:
+            f.write('local change')
+        s.backend.commit('second')   # an empty change
+        s.backend.branch('b1')
+        with patch.object(s.backend.fallback, 'checkout') as checkout:
+            s.backend.checkout('b1')   # same tree: nothing to do
+            s.backend.checkout('nope')
+        checkout.assert_not_called()
+        self.assertEqual('refs/heads/b1', s.git.symbolic_ref('HEAD'))
+
+    def test_branch_errors(self):
+        s = self.new_session(PlumbingBackend)
+        with self.assertRaises(ValueError):
+            s.backend.branch('b1')   # no commits yet
+        s.backend.commit('empty')
+        for name in ('a..b', 'a b', '-x', 'x.lock', 'x/'):
+            with self.assertRaises(ValueError):
+                s.backend.branch(name)
+        s.backend.branch('b1')
+        s.backend.commit('again')
+        with self.assertRaises(ValueError):
+            s.backend.branch('b1')
+        self.assertEqual(s.git.rev_parse('HEAD~1'), s.git.rev_parse('b1'))
+        self.assertEqual(2, len(s.git.reflog('master').splitlines()))
@@ -149,3 +149,54 @@ class TestCommandParser(TestCase):
 
         for a, e in zip(parsed + ([None] * 20), expected):
             self.assertIsInstance(a,e)
+
+    def script(self):
+        lines = []
+        for i in range(200):
+            lines.append('touch f{}'.format(i))
+            lines.append('>> f{} "line \\"{}\\"\n continued"'.format(i, i))
+            lines.append('add ( f{} ,\n  g{})'.format(i, i))
+            lines.append('commit "commit {}"'.format(i))
+            lines.append('branch b{}\ncheckout b{}'.format(i, i))
+        return '\n'.join(lines) + '\n'
+
+    def describe(self, commands):
+        result = []
+        for c in commands:
+            d = dict(vars(c))
+            d.pop('session')
+            d.pop('number', None)
+            result.append((type(c).__name__, d))
+        return result
+
+    def test_stream_file(self):
+        s = self.script()
+        expected = self.describe(self.parser.parse(s))
+        self.assertEqual(1200, len(expected))
+        self.assertEqual(['f3', 'g3'], expected[3 * 6 + 2][1]['files'])
+        self.assertEqual('line \\"3\\"\n continued', expected[3 * 6 + 1][1]['line'])
+
+        fname = join(self.session.dir(), 'script.gcs')
+        with open(fname, 'w') as f:
+            f.write(s)
+        for chunk_size in (1, 7, 1000):
+            streamed = self.parser.iter_file(fname, chunk_size=chunk_size)
+            self.assertEqual(expected, self.describe(streamed))
+        self.assertEqual(expected, self.describe(self.parser.parse_file(fname)))
+
+    def test_error_position(self):
+        with self.assertRaises(ParseError) as cm:
+            self.parser.parse('touch f1\n\n  frobnicate f1')
+        self.assertEqual('(3:2) Unrecognized Command: frobnicate', str(cm.exception))
+
+        with self.assertRaises(ParseError) as cm:
+            self.parser.parse('touch f1\n>> f1 "unterminated\n\n')
+        self.assertEqual('(2:6) Unmatched quote', str(cm.exception))
+
+        with self.assertRaises(ParseError) as cm:
+            self.parser.parse('add (f1,\n "f2")')
+        self.assertEqual('(2:1) Mixed tuple type', str(cm.exception))
+
+        with self.assertRaises(ParseError) as cm:
+            self.parser.parse('add (f1, f2')
+        self.assertEqual('(1:11) Unexpected end of script', str(cm.exception))
@@ -0,0 +1,103 @@
+from os.path import join
+from unittest import TestCase
+
+from gitutil.commit_graph import CommitGraph
+from gitutil.gitobjs import GitObjects
+from gitutil.session import GitSession
+
+
+class TestCommitGraph(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        self.git = self.session.git
+        self.gitdir = join(self.dir, '.git')
+        self.make_history()
+        self.graph = None
+
+    def tearDown(self):
+        if self.graph is not None:
+            self.graph.close()
+        self.session.cleanup()
+
+    def commit(self, message):
+        self.git.commit('--allow-empty', '-m', message)
+        return self.git.rev_parse('HEAD')
+
+    def make_history(self):
+        """ A few branches, a criss-cross merge and an octopus merge """
+        self.commit('root')
+        for i in range(5):
+            self.commit('master {}'.format(i))
+        self.git.checkout('-b', 'b1')
+        self.commit('b1 0')
+        self.git.checkout('-b', 'b2', 'master')
+        self.commit('b2 0')
+        # criss-cross: b1 and b2 each merge the other's first commit
+        self.git.checkout('b1')
+        self.git.merge('--no-edit', '--no-ff', 'b2~0')
+        self.commit('b1 1')
+        self.git.checkout('b2')
+        self.git.merge('--no-edit', '--no-ff', 'b1~2')
+        self.commit('b2 1')
+        self.git.checkout('-b', 'b3', 'master')
+        self.commit('b3 0')
+        self.git.checkout('master')
+        self.commit('master 5')
+        self.git.merge('--no-edit', 'b1', 'b2', 'b3')
+        self.git.checkout('-b', 'lost', 'b3')
+        self.commit('lost 0')
+        self.commit('lost 1')
+        self.git.checkout('master')
+
+    def all_commits(self):
+        return self.git.rev_list('--all').split()
+
+    def check(self):
+        objects = GitObjects(self.gitdir)
+        self.graph = graph = CommitGraph(objects)
+        self.assertEqual(sorted(self.git.rev_list('master').split()),
+                         sorted(graph.ancestors(self.git.rev_parse('master'))))
+
+        b1, b2 = self.git.rev_parse('b1'), self.git.rev_parse('b2')
+        expected = sorted(self.git.merge_base('--all', b1, b2).split())
+        self.assertEqual(2, len(expected))
+        self.assertEqual(expected, sorted(graph.merge_bases(b1, b2)))
+        master = self.git.rev_parse('master')
+        self.assertEqual([b1], graph.merge_bases(b1, master))
+
+        commits = self.all_commits()
+        for a in commits[::3]:
+            for b in commits[::4]:
+                expected = self.git.execute(['git', 'merge-base', '--is-ancestor',
+                                             a, b], with_exceptions=False,
+                                            with_extended_output=True)[0] == 0
+                self.assertEqual(expected, graph.is_ancestor(a, b), (a, b))
+
+        lost = self.git.rev_parse('lost')
+        self.assertEqual(self.git.rev_list(lost, '^' + master).split(),
+                         graph.unreachable([lost, master], [master]))
+        self.assertEqual([], graph.unreachable([master], [lost, master]))
+        return graph
+
+    def test_without_graph_file(self):
+        graph = self.check()
+        self.assertIsNone(graph.file)
+
+    def test_with_graph_file(self):
+        self.git.commit_graph('write', '--reachable')
+        graph = self.check()
+        self.assertIsNotNone(graph.file)
+        self.assertEqual(len(self.all_commits()), len(graph.file))
+        octopus = self.git.rev_parse('master')
+        self.assertEqual(4, len(graph.parents(octopus)))
+        self.assertEqual(self.git.rev_parse('master^@').split(), graph.parents(octopus))
+
+    def test_commits_after_graph_file(self):
+        self.git.commit_graph('write', '--reachable')
+        self.commit('after the graph')
+        self.check()
+        head = self.git.rev_parse('HEAD')
+        self.assertEqual(1 + self.graph.generation(self.git.rev_parse('HEAD^')),
+                         self.graph.generation(head))
@@ -0,0 +1,101 @@
+import os
+from os.path import join
+from unittest.mock import patch
+
+from gitutil import fast_import
+from gitutil.commands import CommandParser
+from gitutil.session import AutoGenGitRepo
+from gitutil.test.repo_state import SessionTestCase
+
+SCRIPT = '''touch f1
+>> f1 "one"
+mkdir d1
+mkdir d1/d2
+touch d1/d2/f2
+>> d1/d2/f2 "deep"
+mkdir empty
+add (f1, d1)
+commit "first"
+branch b1
+>> f1 "two"
+add (f1)
+commit "second"
+checkout b1
+mkdir d3
+touch d3/only-on-b1
+add (.)
+commit "on b1"
+branch b2
+checkout master
+>> f1 "three"
+add (f1)
+commit "third"
+>> d1/d2/f2 "staged"
+add (d1/d2/f2)
+>> d1/d2/f2 "not staged"
+touch untracked
+checkout b2
+'''
+
+
+class TestFastImport(SessionTestCase):
+
+    def commands(self, session, script=SCRIPT):
+        return CommandParser(session).parse(script)
+
+    def test_same_as_running_commands(self):
+        expected = self.new_session()
+        for c in self.commands(expected):
+            c.execute()
+        imported = self.new_session()
+        with patch('gitutil.session.fast_import', wraps=fast_import.fast_import) as fi:
+            AutoGenGitRepo(imported, self.commands(imported)).run()
+        fi.assert_called_once()
+        self.assertSameRepository(expected, imported)
+        imported.git.fsck('--strict')
+        # The staged change was carried over to b2, and the unstaged one too
+        self.assertEqual('d1/d2/f2', imported.git.diff('--cached', '--name-only'))
+        self.assertEqual('d1/d2/f2', imported.git.diff('--name-only'))
+
+    def test_large_history(self):
+        lines = []
+        for i in range(2000):
+            if i % 500 == 0:
+                lines.append('branch b{}'.format(i))
+            lines.append('touch f{}'.format(i % 50))
+            lines.append('>> f{} "line {}"'.format(i % 50, i))
+            lines.append('add (f{})'.format(i % 50))
+            lines.append('commit "c{}"'.format(i))
+        imported = self.new_session()
+        # (not 'branch b0': there is nothing to branch from yet)
+        commands = self.commands(imported, '\n'.join(lines[1:]))
+        stream = AutoGenGitRepo(imported, commands).run()
+        self.assertEqual('2000', imported.git.rev_list('--count', 'master'))
+        self.assertEqual(['b1000', 'b1500', 'b500', 'master'],
+                         imported.git.branch('--format=%(refname:short)').split())
+        self.assertEqual('', imported.git.status('--porcelain'))
+        self.assertEqual(50, len(stream.index))
+        with open(join(imported.dir(), 'f49')) as f:
+            self.assertEqual('line 1999\n', f.read())
+
+    def test_errors_leave_repository_alone(self):
+        s = self.new_session()
+        bad = ['touch f1\nadd (nope)\n', 'touch nodir/f1\n', 'branch b1\n',
+               'touch f1\nadd (f1)\ncommit "c"\nbranch b1\n'
+               '>> f1 "changed"\nadd (f1)\ncommit "c2"\ncheckout b1\n'
+               '>> f1 "local"\ncheckout master\n']
+        errors = (ValueError, FileNotFoundError)
+        for script in bad:
+            with self.assertRaises(errors):
+                AutoGenGitRepo(s, self.commands(s, script)).run()
+            self.assertEqual(['.git'], os.listdir(s.dir()))
+            self.assertEqual('', s.git.for_each_ref())
+
+    def test_runs_commands_when_repository_is_not_empty(self):
+        s = self.new_session()
+        with open(join(s.dir(), 'existing'), 'w') as f:
+            f.write('existing\n')
+        with patch('gitutil.session.fast_import') as fi:
+            AutoGenGitRepo(s, self.commands(s, 'add (existing)\ncommit "c"\n')).run()
+        fi.assert_not_called()
+        self.assertEqual('existing', s.git.ls_tree('--name-only', 'HEAD'))
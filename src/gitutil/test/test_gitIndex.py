@@ -0,0 +1,322 @@
+import os
+import struct
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from os import makedirs
+from os.path import join
+
+from git.exc import GitCommandError
+
+from gitutil.git_fs import GitIndex, IndexTable, np
+from gitutil.session import GitSession
+
+
+class TestGitIndex(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        self.git = self.session.git
+
+    def tearDown(self):
+        self.session.cleanup()
+
+    def write(self, name, contents):
+        with open(join(self.dir, name), 'w') as f:
+            f.write(contents)
+
+    def make_files(self):
+        makedirs(join(self.dir, 'd1', 'd2'))
+        self.write('f1', 'This is file 1')
+        self.write('f2', 'This is file 2')
+        self.write(join('d1', 'f3'), 'This is file 3')
+        self.write(join('d1', 'd2', 'f4'), 'This is file 4')
+        self.git.add('.')
+        self.git.commit('-m', 'first commit')
+
+    def read_index(self, *args, **kwargs):
+        with open(join(self.dir, '.git', 'index'), 'rb') as f:
+            return GitIndex(f.read(), *args, **kwargs)
+
+    def ls_files(self):
+        """ [(mode, sha1, stage, path)] as reported by git itself """
+        result = []
+        for line in self.git.ls_files('-s').splitlines():
+            info, name = line.split('\t')
+            mode, sha1, stage = info.split()
+            result.append((int(mode, 8), sha1, int(stage), name))
+        return result
+
+    def assertSameIndex(self, expected, actual):
+        self.assertEqual(expected.entries_end, actual.entries_end)
+        self.assertEqual(expected.extension_offsets, actual.extension_offsets)
+        for field in IndexTable.FIELDS:
+            self.assertEqual(getattr(expected.table, field),
+                             getattr(actual.table, field))
+        self.assertEqual(expected.table.sha1s, actual.table.sha1s)
+        self.assertEqual(expected.table.paths, actual.table.paths)
+        self.assertEqual(expected.table.offsets, actual.table.offsets)
+
+    def test_header(self):
+        self.make_files()
+        index = self.read_index(verbose=False)
+        self.assertEqual(b'DIRC', index.magic_number)
+        self.assertEqual(2, index.version)
+        self.assertEqual(4, index.filecount)
+
+    def test_entries(self):
+        self.make_files()
+        index = self.read_index(verbose=False)
+        entries = [(int(e['mode'], 16), e['sha1'], (int(e['flags'], 16) >> 12) & 3,
+                    e['name']) for e in index.indexEntries]
+        self.assertEqual(self.ls_files(), entries)
+
+    def test_cached_tree(self):
+        self.make_files()
+        index = self.read_index(verbose=False)
+        trees = {t['path comp']: t for t in index.cached_tree_entries}
+        self.assertEqual({'', 'd1', 'd2'}, set(trees))
+        self.assertEqual('4', trees['']['entries in index'])
+        self.assertEqual(self.git.rev_parse('HEAD^{tree}'), trees['']['object-name'])
+        self.assertEqual(self.git.rev_parse('HEAD:d1'), trees['d1']['object-name'])
+
+    def test_long_name(self):
+        # Paths of 0xfff bytes or more don't fit in the flags' length field
+        name = '/'.join(['x' * 200] * 25)
+        self.write('f1', 'This is file 1')
+        sha1 = self.git.hash_object('-w', 'f1')
+        self.git.update_index('--add', '--cacheinfo', '100644,{},{}'.format(sha1, name))
+        index = self.read_index(verbose=False)
+        self.assertEqual([name], [e['name'] for e in index.indexEntries])
+
+    def test_bytes_to_int(self):
+        index = GitIndex(b'DIRC' + struct.pack('>LL', 2, 0) + bytes(20), verbose=False)
+        self.assertEqual(0x01020304, index.bytes_to_int(b'\x01\x02\x03\x04'))
+        self.assertEqual(0, len(index.indexEntries))
+
+    def test_table(self):
+        self.make_files()
+        os.chmod(join(self.dir, 'f2'), 0o755)
+        self.git.add('f2')
+        index = self.read_index(verbose=False)
+        table = index.table
+        expected = self.ls_files()
+
+        self.assertEqual(len(expected), len(table))
+        self.assertEqual([e[3] for e in expected], table.paths)
+        self.assertEqual([e[1] for e in expected], [table.sha1(i) for i in range(len(table))])
+        self.assertEqual([e[0] for e in expected], list(table.mode))
+
+        row = table.row(table.paths.index('f1'))
+        st = os.stat(join(self.dir, 'f1'))
+        self.assertEqual(st.st_size, row['size'])
+        self.assertEqual(st.st_ino & 0xffffffff, row['ino'])
+        self.assertEqual(int(st.st_mtime), row['mtime_sec'])
+
+    def test_table_queries(self):
+        self.make_files()
+        os.chmod(join(self.dir, 'f2'), 0o755)
+        self.git.add('f2')
+        table = self.read_index(verbose=False).table
+
+        self.assertEqual(['f2'], [table.paths[i] for i in table.with_mode(0o100755)])
+        self.assertEqual(len(table), len(table.modified_after(0)))
+        self.assertEqual([], table.modified_after(time.time() + 60))
+
+    @skipIf(np is None, 'NumPy is not installed')
+    def test_table_queries_numpy(self):
+        table = IndexTable()
+        # Nanoseconds apart: too close for float seconds to tell apart
+        for i, (sec, nsec, mode) in enumerate([(1700000000, 0, 0o100644),
+                                               (1700000000, 1, 0o100755),
+                                               (1700000001, 0, 0o100644)]):
+            header = struct.pack('>10I20sH', 0, 0, sec, nsec, 0, i, mode, 0, 0,
+                                 0, bytes(20), 2)
+            table.append(header, 0, 'f{}'.format(i), 12 + 64 * i)
+        table.finish()
+
+        a = table.as_numpy()
+        self.assertIs(a, table.as_numpy())
+        self.assertEqual(list(table.mode), a['mode'].tolist())
+        for t in (0, 1700000000.0, 1700000000.5, 1700000001.0):
+            with patch('gitutil.git_fs.np', None):
+                expected = table.modified_after(t)
+            self.assertEqual(expected, table.modified_after(t))
+        self.assertEqual([1, 2], table.modified_after(1700000000.0))
+        self.assertEqual([1], table.with_mode(0o100755))
+
+    def assertMatchesGit(self, index):
+        table = index.table
+        entries = [(table.mode[i], table.sha1(i), table.stage(i), table.paths[i])
+                   for i in range(len(table))]
+        self.assertEqual(self.ls_files(), entries)
+
+    def test_version_3(self):
+        self.make_files()
+        self.write('f5', 'This is file 5')
+        self.git.add('-N', 'f5')   # intent-to-add needs extended flags
+        index = self.read_index(verbose=False)
+        self.assertEqual(3, index.version)
+        self.assertMatchesGit(index)
+
+    def test_version_4(self):
+        self.make_files()
+        self.git.update_index('--index-version', '4')
+        index = self.read_index(verbose=False)
+        self.assertEqual(4, index.version)
+        self.assertMatchesGit(index)
+        self.assertEqual(3, len(index.cached_tree_entries))
+
+    def test_extensions_are_lazy(self):
+        self.make_files()
+        index = self.read_index(verbose=False)
+        self.assertIn(b'TREE', index.extension_offsets)
+        self.assertEqual({}, index._extensions)
+        self.assertIsNone(index.resolve_undo)
+        index.cached_tree_entries
+        self.assertEqual([b'TREE'], list(index._extensions))
+
+    def test_resolve_undo(self):
+        self.write('f1', 'base\n')
+        self.git.add('f1')
+        self.git.commit('-m', 'base')
+        self.git.checkout('-b', 'other')
+        self.write('f1', 'other\n')
+        self.git.commit('-am', 'other')
+        self.git.checkout('-')
+        self.write('f1', 'master\n')
+        self.git.commit('-am', 'master')
+        with self.assertRaises(GitCommandError):
+            self.git.merge('other')
+        self.write('f1', 'resolved\n')
+        self.git.add('f1')
+
+        undo = self.read_index(verbose=False).resolve_undo
+        self.assertEqual(1, len(undo))
+        self.assertEqual('f1', undo[0]['path'])
+        self.assertEqual([0o100644] * 3, undo[0]['modes'])
+        self.assertEqual(self.git.rev_parse('HEAD:f1'), undo[0]['sha1s'][1])
+        self.assertEqual(self.git.rev_parse('other:f1'), undo[0]['sha1s'][2])
+
+    def test_untracked_cache(self):
+        self.make_files()
+        self.git.config('core.untrackedCache', 'true')
+        self.git.update_index('--untracked-cache')
+        self.write('u1', 'untracked')
+        self.write(join('d1', 'u2'), 'untracked')
+        self.git.status()
+
+        cache = self.read_index(verbose=False).untracked_cache
+        self.assertEqual('.gitignore', cache['exclude per dir'])
+        dirs = {d['name']: d for d in cache['directories']}
+        self.assertEqual(['u1'], dirs['']['untracked'])
+        self.assertEqual(['u2'], dirs['d1']['untracked'])
+        self.assertEqual(os.stat(self.dir).st_ino & 0xffffffff,
+                         dirs['']['stat']['ino'])
+
+    def test_fsmonitor(self):
+        self.make_files()
+        hook = join(self.dir, '.git', 'fsmonitor-hook')
+        with open(hook, 'w') as f:
+            f.write("#!/bin/sh\nprintf 'token\\0/\\0'\n")
+        os.chmod(hook, 0o755)
+        self.git.config('core.fsmonitor', hook)
+        self.git.config('core.fsmonitorHookVersion', '2')
+        self.git.update_index('--fsmonitor')
+        self.git.status()
+
+        fsmonitor = self.read_index(verbose=False).fsmonitor
+        self.assertEqual(2, fsmonitor['version'])
+        self.assertEqual('token', fsmonitor['token'])
+
+    def test_offset_table(self):
+        for i in range(1200):
+            self.write('f{}'.format(i), 'This is file {}'.format(i))
+        self.git.add('.')
+        # Changing the version always rewrites the index (a refresh only does
+        # if some entry's stat data changed)
+        self.git.execute(['git', '-c', 'index.threads=4',
+                          '-c', 'index.recordOffsetTable=true',
+                          '-c', 'index.recordEndOfIndexEntries=true',
+                          'update-index', '--index-version', '4'])
+        index = self.read_index(verbose=False)
+        self.assertMatchesGit(index)
+        self.assertEqual(index.entries_end, index.end_of_index['offset'])
+        blocks = index.entry_offsets['blocks']
+        self.assertGreater(len(blocks), 1)
+        self.assertEqual(1200, sum(count for _, count in blocks))
+
+        self.assertSameIndex(index, self.read_index(verbose=False, workers=4))
+
+    def test_workers_without_offset_table(self):
+        self.make_files()
+        index = self.read_index(verbose=False, workers=4)
+        self.assertIsNone(index.entry_offsets)
+        self.assertMatchesGit(index)
+
+    def test_lookups(self):
+        self.make_files()
+        self.write('d1/copy', 'This is file 3')
+        self.git.add('.')
+        index = self.read_index(verbose=False)
+        table = index.table
+
+        self.assertIn('d1/f3', index)
+        self.assertNotIn('d1', index)
+        f3 = index.lookup('d1/f3')
+        self.assertEqual('d1/f3', f3['path'])
+        self.assertIsNone(index.lookup('d1/f3', stage=2))
+        self.assertIsNone(index.lookup('nope'))
+        self.assertEqual(['d1/copy', 'd1/f3'], index.paths_for_sha1(f3['sha1']))
+        self.assertEqual([], index.paths_for_sha1(bytes(20)))
+
+        self.assertEqual(['d1/copy', 'd1/d2/f4', 'd1/f3'],
+                         [table.paths[i] for i in index.rows_under('d1')])
+        self.assertEqual(['d1/d2/f4'],
+                         [table.paths[i] for i in index.rows_under('d1/d2/')])
+        self.assertEqual([], list(index.rows_under('d')))
+        self.assertEqual(len(table), len(index.rows_under('')))
+
+    def check_reread(self, previous):
+        """ Re-read the index against previous; return the changes """
+        index = self.read_index(verbose=False, previous=previous)
+        self.assertSameIndex(self.read_index(verbose=False), index)
+        self.assertEqual(index.diff(previous), index.changes)
+        return index.changes
+
+    def test_reread(self):
+        for i in range(50):
+            self.write('f{:02}'.format(i), 'This is file {}'.format(i))
+        self.git.add('.')
+        self.git.commit('-m', 'first commit')
+        before = self.read_index(verbose=False)
+
+        self.write('f25', 'Changed')
+        self.write('f25a', 'New')
+        self.git.add('.')
+        self.git.rm('f40')
+        changes = self.check_reread(before)
+        self.assertEqual(['f25a'], [e['path'] for e in changes['added']])
+        self.assertEqual(['f40'], [e['path'] for e in changes['removed']])
+        self.assertEqual([('f25', 'f25')],
+                         [(a['path'], b['path']) for a, b in changes['changed']])
+
+        self.assertEqual({'added': [], 'removed': [], 'changed': []},
+                         self.check_reread(self.read_index(verbose=False)))
+
+    def test_reread_v4(self):
+        for i in range(50):
+            self.write('f{:02}'.format(i), 'This is file {}'.format(i))
+        self.git.add('.')
+        self.git.update_index('--index-version', '4')
+        before = self.read_index(verbose=False)
+
+        self.write('f00', 'Changed')
+        self.write('f49', 'Changed')
+        self.write('f10a', 'New')
+        self.git.add('.')
+        changes = self.check_reread(before)
+        self.assertEqual(['f10a'], [e['path'] for e in changes['added']])
+        self.assertEqual(['f00', 'f49'],
+                         [b['path'] for a, b in changes['changed']])
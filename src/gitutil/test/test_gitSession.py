@@ -1,5 +1,142 @@
-from unittest import TestCase
+import os
+from os.path import join
+from unittest.mock import patch
 
+from git import GitCommandError
 
-class TestGitSession(TestCase):
-    pass
+from gitutil.commands import CommandParser
+from gitutil.script_cache import ScriptCache
+from gitutil.test.repo_state import SessionTestCase
+
+SCRIPT = '''touch f1
+mkdir d1
+touch d1/f2
+>> f1 "first line"
+>> d1/f2 "a \\"quoted\\" line"
+add (f1, d1/f2)
+commit "first commit"
+branch b1
+checkout b1
+'''
+
+BATCH_SCRIPT = '''touch f1
+>> f1 "one"
+>> f1 "two"
+mkdir d1
+touch d1/f2
+>> d1/f2 "x"
+add (f1)
+add (d1)
+commit "first"
+>> f1 "three"
+touch d1/f2
+>> d1/f2 "y"
+add (f1)
+add (d1/f2)
+commit "second"
+branch b1
+checkout b1
+touch f3
+add (f3)
+>> f3 "staged before this line"
+'''
+
+
+class TestGitSession(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.session = self.new_session()
+        self.dir = self.session.dir()
+        self.cache = ScriptCache(join(self.dir, '.git', 'hog-cache'))
+        self.script = join(self.dir, '.git', 'script.gcs')
+        with open(self.script, 'w') as f:
+            f.write(SCRIPT)
+
+    def describe(self, commands):
+        return [(type(c).__name__, {k: v for k, v in vars(c).items()
+                                    if k not in ('session', 'number')})
+                for c in commands]
+
+    def test_load_script_cached(self):
+        expected = self.describe(self.session.load_script(self.script))
+        self.assertEqual(expected, self.describe(
+            self.session.load_script(self.script, self.cache)))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+        with patch.object(CommandParser, 'parse', side_effect=AssertionError):
+            commands = self.session.load_script(self.script, self.cache)
+        self.assertEqual(expected, self.describe(commands))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertTrue(all(c.session is self.session for c in commands))
+
+        with open(self.script, 'a') as f:
+            f.write('touch f3\n')
+        self.assertEqual(len(expected) + 1,
+                         len(self.session.load_script(self.script, self.cache)))
+        self.assertEqual(2, self.cache.misses)
+
+    def test_no_cache_by_default(self):
+        cache_dir = join(self.dir, '.git', 'default-cache')
+        with patch.dict(os.environ, {'HOG_CACHE_DIR': cache_dir}):
+            self.session.load_script(self.script)
+            self.session.run_script(self.script)
+        self.assertFalse(os.path.exists(cache_dir))
+
+    def test_run_script(self):
+        self.session.run_script(self.script, self.cache)
+        with open(join(self.dir, 'd1', 'f2')) as f:
+            self.assertEqual('a \\"quoted\\" line\n', f.read())
+        repo = self.session.repo()
+        self.assertEqual('b1', repo.active_branch.name)
+        self.assertEqual('first commit', repo.head.commit.message)
+
+    def test_corrupt_plan(self):
+        self.session.load_script(self.script, self.cache)
+        key = self.cache.key(SCRIPT)
+        with open(self.cache.plan_path(key), 'w') as f:
+            f.write('[["Nope"]]')
+        self.assertEqual(9, len(self.session.load_script(self.script, self.cache)))
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(9, len(self.cache.get(key)))
+
+    def test_batch(self):
+        expected = self.new_session()
+        self.run_script(expected, BATCH_SCRIPT)
+        batched = self.new_session()
+        add = batched.git.add
+        with patch.object(batched, 'git') as git:
+            git.add.side_effect = add
+            self.run_script(batched, BATCH_SCRIPT, batch=True)
+        # One git add per run of adjacent Adds
+        self.assertEqual([(['f1', 'd1'],), (['f1', 'd1/f2'],), (['f3'],)],
+                         [c[0] for c in git.add.call_args_list])
+        self.assertSameRepository(expected, batched)
+
+    def test_batch_ignored_files(self):
+        """ Batched adds refuse ignored files, as separate ones do """
+        scripts = {
+            'sub/.gitignore': 'touch sub/x.log\nadd (sub/x.log)\ncommit "c"\n',
+            '.git/info/exclude': 'touch x.log\nadd (x.log)\ncommit "c"\n',
+        }
+        for ignore, script in scripts.items():
+            for batch in (False, True):
+                session = self.new_session()
+                os.makedirs(os.path.dirname(join(session.dir(), ignore)), exist_ok=True)
+                with open(join(session.dir(), ignore), 'w') as f:
+                    f.write('*.log\n')
+                with self.assertRaises(GitCommandError):
+                    self.run_script(session, script, batch)
+                self.assertEqual('', session.git.ls_files())
+
+    def test_batch_edits_before_directories(self):
+        """ Buffered edits are written before a mkdir, as they would be run
+            one at a time
+        """
+        scripts = {'touch d/f\nmkdir d\n': FileNotFoundError,
+                   'touch d\nmkdir d\n': FileExistsError}
+        for script, error in scripts.items():
+            for batch in (False, True):
+                session = self.new_session()
+                with self.assertRaises(error):
+                    self.run_script(session, script, batch)
@@ -0,0 +1,118 @@
+import os
+from os.path import join
+from unittest import TestCase
+
+from gitutil.gitobjs import GitObjects, GitCommitObj, GitTree, GitBlob, GitTag, \
+    GitBranch, read_refs, read_head
+from gitutil.session import GitSession
+
+
+class TestGitObjects(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        self.git = self.session.git
+        os.makedirs(join(self.dir, 'd1'))
+        self.write('f1', 'This is file 1\n')
+        self.write(join('d1', 'f2'), 'This is file 2\n')
+        self.git.add('.')
+        self.git.commit('-m', 'first commit')
+        self.write('f1', 'Changed\n')
+        self.git.commit('-am', 'second commit\n\nWith a longer message')
+        self.objects = GitObjects(join(self.dir, '.git'))
+
+    def tearDown(self):
+        self.session.cleanup()
+
+    def write(self, name, contents):
+        with open(join(self.dir, name), 'w') as f:
+            f.write(contents)
+
+    def test_commit(self):
+        head = self.git.rev_parse('HEAD')
+        commit = self.objects[head]
+        self.assertIsInstance(commit, GitCommitObj)
+        self.assertEqual(self.git.rev_parse('HEAD^{tree}'), commit.tree)
+        self.assertEqual([self.git.rev_parse('HEAD^')], commit.parents)
+        self.assertEqual('second commit\n\nWith a longer message\n', commit.message)
+        self.assertEqual(int(self.git.log('-1', '--format=%ct')), commit.commit_time)
+        self.assertEqual([], self.objects[commit.parents[0]].parents)
+
+    def test_tree_and_blob(self):
+        tree = self.objects[self.git.rev_parse('HEAD^{tree}')]
+        self.assertIsInstance(tree, GitTree)
+        expected = []
+        for line in self.git.ls_tree('HEAD').splitlines():
+            info, name = line.split('\t')
+            mode, _, sha1 = info.split()
+            expected.append((mode.lstrip('0'), name, sha1))
+        self.assertEqual(expected, list(tree))
+        mode, sha1 = tree.get('f1')
+        blob = self.objects[sha1]
+        self.assertIsInstance(blob, GitBlob)
+        self.assertEqual(8, blob.size)
+        self.assertEqual(b'Changed\n', blob.body)
+        self.assertIsNone(tree.get('nope'))
+
+    def test_tag(self):
+        self.git.tag('-a', 'v1', '-m', 'version 1')
+        tag = self.objects[self.git.rev_parse('v1')]
+        self.assertIsInstance(tag, GitTag)
+        self.assertEqual(self.git.rev_parse('HEAD'), tag.object)
+        self.assertEqual('v1', tag.tag)
+
+    def test_header_only(self):
+        sha1 = self.git.rev_parse('HEAD:f1')
+        blob = self.objects[sha1]
+        self.assertIsNone(blob._body)
+        self.assertEqual(8, blob.size)
+
+    def test_cache(self):
+        objects = GitObjects(join(self.dir, '.git'), cache_size=2)
+        sha1s = objects.loose_sha1s()
+        self.assertEqual(sorted(self.git.rev_list('--all', '--objects',
+                                                  '--no-object-names').split()),
+                         sha1s)
+        first = objects[sha1s[0]]
+        self.assertIs(first, objects[sha1s[0]])
+        self.assertEqual(1, objects.cache.hits)
+        objects[sha1s[1]]
+        objects[sha1s[2]]
+        self.assertEqual(2, len(objects.cache))
+        self.assertNotIn(sha1s[0], objects.cache)
+        self.assertIsNot(first, objects[sha1s[0]])
+
+    def test_missing(self):
+        self.assertNotIn('0' * 40, self.objects)
+        self.assertIsNone(self.objects.get('0' * 40))
+        with self.assertRaises(KeyError):
+            self.objects['0' * 40]
+
+    def test_refs(self):
+        self.git.tag('-a', 'v1', '-m', 'version 1')
+        self.git.branch('b1', 'HEAD^')
+        self.git.pack_refs('--all')
+        self.git.branch('b2')
+        self.git.branch('-f', 'b1', 'HEAD')
+        self.git.symbolic_ref('refs/remotes/origin/HEAD', 'refs/heads/b2')
+
+        refs = read_refs(join(self.dir, '.git'))
+        expected = dict(line.split(' ') for line in
+                        self.git.for_each_ref('--format=%(refname) %(objectname)')
+                        .splitlines())
+        self.assertEqual(expected, {name: ref.sha1 for name, ref in refs.items()})
+        head = self.git.rev_parse('HEAD')
+        self.assertEqual(head, refs['refs/tags/v1'].peeled)
+        self.assertEqual(head, refs['refs/tags/v1'].target)
+        self.assertIsInstance(refs['refs/heads/b1'], GitBranch)
+        self.assertEqual('b1', refs['refs/heads/b1'].branch)
+        self.assertNotIsInstance(refs['refs/tags/v1'], GitBranch)
+
+        branch = self.git.symbolic_ref('HEAD')
+        self.assertEqual((branch, head), (read_head(join(self.dir, '.git')).ref,
+                                          read_head(join(self.dir, '.git')).sha1))
+        self.git.checkout('--detach')
+        detached = read_head(join(self.dir, '.git'))
+        self.assertTrue(detached.detached)
+        self.assertEqual(head, detached.sha1)
@@ -0,0 +1,68 @@
+from contextlib import redirect_stdout
+from io import StringIO
+from os.path import join
+from unittest import TestCase
+
+from gitutil.git_fs import GitIndex
+from gitutil.index_report import render_index
+from gitutil.session import GitSession
+
+
+class TestIndexReport(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        for i in range(10):
+            with open(join(self.dir, 'f{}'.format(i)), 'w') as f:
+                f.write('This is file {}'.format(i))
+        self.session.git.add('.')
+        self.session.git.commit('-m', 'first commit')
+        self.session.git.write_tree()
+
+    def tearDown(self):
+        self.session.cleanup()
+
+    def read_index(self, **kwargs):
+        with open(join(self.dir, '.git', 'index'), 'rb') as f:
+            return GitIndex(f.read(), **kwargs)
+
+    def test_quiet_by_default(self):
+        out = StringIO()
+        with redirect_stdout(out):
+            self.read_index()
+        self.assertEqual('', out.getvalue())
+
+    def test_render(self):
+        out = StringIO()
+        index = self.read_index()
+        self.assertEqual(11, render_index(index, out))
+        text = out.getvalue()
+        self.assertEqual(10, text.count('Index Entry'))
+        self.assertEqual(1, text.count('Cached Tree'))
+        self.assertIn('| name       :f3\n', text)
+
+        verbose = StringIO()
+        with redirect_stdout(verbose):
+            self.read_index(verbose=True)
+        self.assertEqual(text, verbose.getvalue())
+
+    def test_limit(self):
+        out = StringIO()
+        self.assertEqual(4, render_index(self.read_index(), out, limit=3))
+        text = out.getvalue()
+        self.assertEqual(3, text.count('Index Entry'))
+        self.assertIn('... 7 more entries not shown', text)
+
+    def test_pages(self):
+        out = StringIO()
+        pages = []
+
+        def pause():
+            pages.append(out.getvalue().count('Index Entry'))
+            return len(pages) < 2
+
+        self.assertEqual(8, render_index(self.read_index(), out, page_size=4,
+                                         pause=pause))
+        self.assertEqual([4, 8], pages)
+        self.assertEqual(8, out.getvalue().count('Index Entry'))
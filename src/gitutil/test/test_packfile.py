@@ -0,0 +1,168 @@
+import glob
+from os.path import join
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from gitutil.gitobjs import GitObjects
+from gitutil.packfile import Pack, OBJ_OFS_DELTA, OBJ_REF_DELTA
+from gitutil.session import GitSession
+
+
+class TestPackfile(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        self.git = self.session.git
+        self.gitdir = join(self.dir, '.git')
+        lines = ['line {}\n'.format(i) for i in range(200)]
+        for i in range(10):
+            lines[i * 20] = 'changed in commit {}\n'.format(i)
+            with open(join(self.dir, 'f'), 'w') as f:
+                f.write(''.join(lines))
+            self.git.add('f')
+            self.git.commit('-m', 'commit {}'.format(i))
+        self.git.tag('-a', 'v1', '-m', 'version 1')
+        self.objects = None
+
+    def tearDown(self):
+        if self.objects is not None:
+            self.objects.close()
+        self.session.cleanup()
+
+    def cat_file(self, sha1):
+        tp = self.git.cat_file('-t', sha1)
+        body = self.git.execute(['git', 'cat-file', tp, sha1],
+                                stdout_as_string=False, strip_newline_in_stdout=False)
+        return tp, body
+
+    def pack_files(self):
+        return glob.glob(join(self.gitdir, 'objects', 'pack', '*.pack'))
+
+    def check_all_objects(self):
+        expected = sorted(self.git.rev_list('--all', '--objects',
+                                            '--no-object-names').split())
+        self.objects = GitObjects(self.gitdir)
+        self.assertEqual([], self.objects.loose_sha1s())
+        self.assertEqual(expected, self.objects.sha1s())
+        for sha1 in expected:
+            self.assertIn(sha1, self.objects)
+            tp, body = self.cat_file(sha1)
+            obj = self.objects[sha1]
+            self.assertEqual((tp, len(body)), (obj.type, obj.size))
+            self.assertEqual(body, obj.body)
+        self.assertNotIn('0' * 40, self.objects)
+
+    def delta_types(self):
+        pack = Pack(self.pack_files()[0])
+        try:
+            types = set()
+            for i in range(len(pack.index)):
+                types.add(pack.entry_header(pack.index.offset(i))[0])
+            return types
+        finally:
+            pack.close()
+
+    def test_ofs_deltas(self):
+        self.git.repack('-a', '-d', '-f')
+        self.assertIn(OBJ_OFS_DELTA, self.delta_types())
+        self.check_all_objects()
+        self.assertGreater(len(self.objects.base_cache), 0)
+
+    def test_ref_deltas(self):
+        self.git.execute(['git', '-c', 'repack.useDeltaBaseOffset=false',
+                          'repack', '-a', '-d', '-f'])
+        self.assertIn(OBJ_REF_DELTA, self.delta_types())
+        self.check_all_objects()
+
+    def test_ref_delta_base_elsewhere(self):
+        """ REF_DELTA bases outside the pack come from the resolvers (only
+            the header one for a header), or raise KeyError without them
+        """
+        self.git.execute(['git', '-c', 'repack.useDeltaBaseOffset=false',
+                          'repack', '-a', '-d', '-f'])
+        objects = GitObjects(self.gitdir)
+        pack = Pack(self.pack_files()[0])
+        try:
+            deltas = [sha1 for sha1 in pack.sha1s() if pack.entry_header(
+                pack.find(sha1))[0] == OBJ_REF_DELTA]
+            self.assertNotEqual([], deltas)
+            # As if each base were in another pack
+            outside = patch.object(pack, 'base_offset', lambda base: (
+                None if isinstance(base, str) else base))
+            with outside:
+                for sha1 in deltas:
+                    self.assertRaises(KeyError, pack.read_header, sha1)
+                    self.assertRaises(KeyError, pack.read_object, sha1)
+                pack.resolve_ref = Mock(side_effect=objects.read_object)
+                pack.resolve_header = Mock(side_effect=objects.read_header)
+                for sha1 in deltas:
+                    tp, body = self.cat_file(sha1)
+                    self.assertEqual((tp, len(body)), pack.read_header(sha1))
+                    pack.resolve_ref.assert_not_called()
+                    self.assertEqual((tp, body), pack.read_object(sha1))
+                    pack.resolve_ref.reset_mock()
+                pack.resolve_header = None
+                for sha1 in deltas:
+                    tp, body = self.cat_file(sha1)
+                    self.assertEqual((tp, len(body)), pack.read_header(sha1))
+        finally:
+            pack.close()
+            objects.close()
+
+    def test_index_v1(self):
+        self.git.execute(['git', '-c', 'pack.indexVersion=1',
+                          'repack', '-a', '-d', '-f'])
+        with open(self.pack_files()[0][:-len('.pack')] + '.idx', 'rb') as f:
+            self.assertNotEqual(b'\377tOc', f.read(4))
+        self.check_all_objects()
+
+    def write_pack(self, prefix, versions):
+        """ A pack of blobs holding each of versions, through pack-objects """
+        sha1s = []
+        for text in versions:
+            with open(join(self.dir, 'blob'), 'w') as f:
+                f.write(text)
+            sha1s.append(self.git.hash_object('-w', 'blob'))
+        with open(join(self.dir, 'list'), 'w') as f:
+            f.write('\n'.join(sha1s) + '\n')
+        with open(join(self.dir, 'list')) as f:
+            self.git.pack_objects('-q', join(self.gitdir, 'objects', 'pack', 'pack'),
+                                  istream=f)
+        return sha1s
+
+    def test_several_packs(self):
+        # Two packs laid out alike, so their delta bases sit at the same
+        # offsets, with bases of different sizes
+        packs = []
+        for width in (1, 3):
+            lines = ['{} {}\n'.format(width, i) * width for i in range(200)]
+            versions = []
+            for i in range(10):
+                lines[i * 20] = 'changed in version {}\n'.format(i)
+                versions.append(''.join(lines))
+            packs.append(self.write_pack(width, versions))
+        # and the commits of setUp in a third
+        self.git.repack('-d')
+        self.objects = GitObjects(self.gitdir)
+        self.assertEqual([], self.objects.loose_sha1s())
+        self.assertEqual(3, len(self.objects.packs))
+        for sha1s in packs + [self.objects.sha1s()]:
+            for sha1 in sha1s:
+                tp, body = self.cat_file(sha1)
+                self.assertEqual((tp, body), self.objects.read_object(sha1))
+        self.assertGreater(len(self.objects.base_cache), 0)
+
+        # Dropping a pack drops the bases it cached
+        self.objects.close()
+        self.assertEqual(0, len(self.objects.base_cache))
+
+    def test_new_pack_found(self):
+        self.objects = GitObjects(self.gitdir)
+        head = self.git.rev_parse('HEAD')
+        self.assertEqual([], self.objects.packs)
+        self.assertEqual('commit', self.objects[head].type)
+        self.git.gc()
+        self.objects.cache.clear()
+        self.assertEqual('commit 9\n', self.objects[head].message)
+        self.assertEqual(1, len(self.objects.packs))
@@ -3,6 +3,7 @@ import code
 from os import getcwd
 from sys import argv, exit
 
+from gitutil.index_report import render_index
 from snapshots import GitDirLog
 
 welcome_msg = '+' + ('-=' * 39) + '+' + """
@@ -28,10 +29,11 @@ welcome_msg = '+' + ('-=' * 39) + '+' + """
 
 help_msg = ('-=' * 40) + """
                                    Help Menu
-snap(msg='', verbose=True): Take a snapshot of the .git repository. You can add
-        an optional message or set verbose=False to supress printing to stdout.
-        This second option is particularly useful if you are taking a snapshot
-        of a large repository.
+snap(msg='', verbose=True, workers=None): Take a snapshot of the .git
+        repository. You can add an optional message or set verbose=False to
+        supress printing to stdout. This second option is particularly useful
+        if you are taking a snapshot of a large repository, as is setting
+        workers=n to read and hash files with n threads.
 
 print_diffs(start=0, end=-1): Print the difference objects that you've tracked
         so far. You can choose to start on the nth difference object by setting 
@@ -39,6 +41,22 @@ print_diffs(start=0, end=-1): Print the difference objects that you've tracked
         particular, you can enter print_diffs(start=-3,end=-1) to print the last
         two items, print_diffs(start=5, end=7) to print items 5 and 6, etc.
 
+watch(auto=False, debounce=0.5, verbose=True): (Linux only) Watch the .git
+        directory for changes so that snap() only has to look at what changed.
+        With auto=True a snapshot is taken by itself once changes have stopped
+        for debounce seconds, so you can just run git commands and watch.
+
+unwatch(): Stop watching the .git directory.
+
+save(filename): Save the snapshots taken so far to a file. Saving to the same
+        file again only appends the new snapshots.
+
+load(filename): Replace the current snapshots with ones saved to a file.
+
+index(n=-1, limit=20, page_size=None): Print the .git/index entries of the nth
+        snapshot (default: the latest). At most limit entries are shown (None
+        shows them all); set page_size to be asked before each page.
+
 helpme(): Print this help screen.
 """ + ('-=' * 40)
 
@@ -67,12 +85,33 @@ def main():
 
 
 def repl(log):
-    def snap(m='', verbose=True):
-        log.take_snapshot(m, verbose)
+    def snap(m='', verbose=True, workers=None):
+        log.take_snapshot(m, verbose, workers)
 
     def print_diffs(start=0, end=-1):
         log.print_diffs(start, end)
 
+    def watch(auto=False, debounce=0.5, verbose=True):
+        log.watch(auto, debounce, verbose)
+
+    def unwatch():
+        log.unwatch()
+
+    def save(filename):
+        log.save(filename)
+
+    def load(filename):
+        nonlocal log
+        log.unwatch()
+        log = GitDirLog.load(filename)
+        global_vars['log'] = log
+
+    def index(n=-1, limit=20, page_size=None):
+        if not log.snapshots or log.snapshots[n].index is None:
+            print("No index to show: take a snapshot of a .git directory first")
+            return
+        render_index(log.snapshots[n].index, limit=limit, page_size=page_size)
+
     def helpme():
         print(help_msg)
 
@@ -0,0 +1,265 @@
+""" snapshot_log.py: save GitDirLog snapshots to disk and load them back.
+
+    A snapshot log file starts with a short header and is followed by
+    records that are only ever appended:
+
+        BLOB: the raw sha1 of a file's contents followed by the compressed
+              contents. Each distinct sha1 is written once per file.
+        SNAP: one compressed snapshot, stored column by column: all of the
+              paths, then all of the types, sha1s and stat records.
+
+    Loading a log never touches the git directory it was taken from: entries
+    come back with their sha1s and directory rollups intact (so diffs can be
+    computed straight away) and blob contents are only read from the log file
+    when an entry's contents are looked at.
+
+    Use it through GitDirLog:
+
+        log.save('trace.hoglog')
+        log = GitDirLog.load('trace.hoglog')
+"""
+import struct
+import zlib
+from os import path
+
+from gitutil.git_fs import GitIndex
+from snapshots import BlobStore, Entry, GitDirSnapshot, FILE
+
+MAGIC = b'HOGLOG\x00\x01'
+RECORD_HEADER = struct.Struct('>4sQ')  # tag, payload length
+SNAP_HEADER = struct.Struct('>qI20s')  # started, entry count, rollup sha1
+BLOB = b'BLOB'
+SNAP = b'SNAP'
+NO_STAT = (-1, -1, -1, -1)
+
+
+class SnapshotLogError(RuntimeError):
+    pass
+
+
+class FileBlobStore(BlobStore):
+    """ A BlobStore whose blobs may also live in a snapshot log file; those are
+        read (and decompressed) from the file each time they are asked for.
+        nbytes() only counts the blobs held in memory.
+    """
+
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self.offsets = {}  # sha1 -> (offset, length) of compressed contents
+
+    def get(self, sha1, default=None):
+        if sha1 in self.blobs:
+            return self.blobs[sha1]
+        if sha1 not in self.offsets:
+            return default
+        offset, length = self.offsets[sha1]
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def __contains__(self, sha1):
+        return sha1 in self.blobs or sha1 in self.offsets
+
+    def __getitem__(self, sha1):
+        result = self.get(sha1)
+        if result is None:
+            raise KeyError(sha1)
+        return result
+
+    def __len__(self):
+        return len(self.blobs) + len(self.offsets.keys() - self.blobs.keys())
+
+
+def _pack_str(s):
+    bs = s.encode('utf-8', 'surrogateescape')
+    return struct.pack('>I', len(bs)) + bs
+
+
+def _pack_strs(strs):
+    return _pack_str('\0'.join(strs))
+
+
+class _Reader:
+    """ Sequential reader over a bytes payload """
+
+    def __init__(self, bs):
+        self.bs = memoryview(bs)
+        self.pos = 0
+
+    def take(self, n):
+        result = self.bs[self.pos:self.pos + n]
+        self.pos += n
+        return result
+
+    def unpack(self, fmt):
+        result = fmt.unpack_from(self.bs, self.pos)
+        self.pos += fmt.size
+        return result
+
+    def string(self):
+        n, = struct.unpack_from('>I', self.bs, self.pos)
+        self.pos += 4
+        return bytes(self.take(n)).decode('utf-8', 'surrogateescape')
+
+    def strings(self, count):
+        if count == 0:
+            self.string()
+            return []
+        return self.string().split('\0')
+
+
+def encode_snapshot(snap):
+    """ The SNAP payload (before compression) for snap """
+    entries = list(snap.entries.values())
+    root = snap.path.rstrip('/') + '/'
+    names, types, sha1s, stats = [], [], [], []
+    for e in entries:
+        names.append(e.name[len(root):] if e.name.startswith(root) else e.name)
+        types.append(e.type)
+        sha1s.append(bytes.fromhex(e.sha1) if e.sha1 else bytes(20))
+        stats.extend(e.stat if e.stat is not None else NO_STAT)
+    parts = [
+        SNAP_HEADER.pack(snap.started, len(entries), bytes.fromhex(snap.sha1)),
+        _pack_str(snap.message),
+        _pack_str(snap.path),
+        _pack_strs(names),
+        ''.join(types).encode('ascii'),
+        b''.join(sha1s),
+        struct.pack('>{}q'.format(len(stats)), *stats),
+    ]
+    return b''.join(parts)
+
+
+def decode_snapshot(payload, store, gitdir=None, indexes=None):
+    """ Rebuild a GitDirSnapshot from a SNAP payload. gitdir overrides the
+        directory the snapshot was taken of; indexes caches parsed GitIndex
+        objects by sha1 across snapshots.
+    """
+    r = _Reader(payload)
+    started, count, sha1 = r.unpack(SNAP_HEADER)
+    message = r.string()
+    saved_dir = r.string()
+    if gitdir is None:
+        gitdir = saved_dir
+    names = r.strings(count)
+    types = bytes(r.take(count)).decode('ascii')
+    sha1s = r.take(20 * count)
+    stats = struct.unpack_from('>{}q'.format(4 * count), r.bs, r.pos)
+    r.pos += 32 * count
+
+    root = gitdir.rstrip('/') + '/'
+    entries = []
+    index = None
+    for i in range(count):
+        name = root + names[i]
+        stat = stats[4 * i:4 * i + 4]
+        tp = types[i]
+        entry = Entry(name, sha1=sha1s[20 * i:20 * i + 20].hex(), tp=tp,
+                      stat=None if stat == NO_STAT else stat,
+                      store=store if tp == FILE else None)
+        entries.append(entry)
+        if tp == FILE and name.endswith('.git/index'):
+            index = _load_index(entry, store, indexes)
+    return GitDirSnapshot.from_entries(gitdir, message, entries, sha1.hex(),
+                                       started, index, store)
+
+
+def _load_index(entry, store, indexes):
+    if indexes is not None and entry.sha1 in indexes:
+        return indexes[entry.sha1]
+    contents = store.get(entry.sha1)
+    index = None
+    if contents is not None:
+        index = GitIndex(contents, False)
+    if indexes is not None:
+        indexes[entry.sha1] = index
+    return index
+
+
+class SnapshotLogWriter:
+    """ Appends snapshots (and any contents they can still reach) to a log
+        file, creating it if needed
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.written = set()   # blob sha1s already in the file
+        self.snapshot_count = 0
+        if path.exists(filename) and path.getsize(filename) > 0:
+            for tag, offset, length, sha1 in _scan(filename):
+                if tag == BLOB:
+                    self.written.add(sha1)
+                elif tag == SNAP:
+                    self.snapshot_count += 1
+        else:
+            with open(filename, 'wb') as f:
+                f.write(MAGIC)
+
+    def append(self, snapshots, contents=True):
+        """ Append snapshots to the log. With contents=True, the contents of
+            every file entry that are still available (kept in a BlobStore,
+            or unchanged on disk) are saved too.
+        """
+        with open(self.filename, 'ab') as f:
+            for snap in snapshots:
+                for entry in snap.entries.values():
+                    if entry.type != FILE or entry.sha1 in self.written:
+                        continue
+                    is_index = entry.name.endswith('.git/index')
+                    if not contents and not is_index:
+                        continue
+                    # (not entry.contents: that would keep every file
+                    # in memory for the rest of the log's life)
+                    data = entry.read()
+                    if data is None:
+                        continue
+                    blob = bytes.fromhex(entry.sha1) + zlib.compress(data)
+                    f.write(RECORD_HEADER.pack(BLOB, len(blob)))
+                    f.write(blob)
+                    self.written.add(entry.sha1)
+                payload = zlib.compress(encode_snapshot(snap))
+                f.write(RECORD_HEADER.pack(SNAP, len(payload)))
+                f.write(payload)
+                self.snapshot_count += 1
+
+
+def _scan(filename):
+    """ Yield (tag, payload offset, payload length, blob sha1 or None) for
+        each record in the log file, without reading snapshot payloads
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise SnapshotLogError('Not a hog snapshot log: ' + filename)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                raise SnapshotLogError('Truncated snapshot log: ' + filename)
+            tag, length = RECORD_HEADER.unpack(header)
+            offset = f.tell()
+            sha1 = None
+            if tag == BLOB:
+                sha1 = f.read(20).hex()
+            yield tag, offset, length, sha1
+            f.seek(offset + length)
+
+
+def read_log(filename, gitdir=None):
+    """ Load every snapshot in a log file. Returns (snapshots, store), where
+        store is the FileBlobStore the snapshots' entries refer to.
+    """
+    store = FileBlobStore(filename)
+    snapshots = []
+    indexes = {}
+    with open(filename, 'rb') as f:
+        for tag, offset, length, sha1 in _scan(filename):
+            if tag == BLOB:
+                store.offsets[sha1] = (offset + 20, length - 20)
+            elif tag == SNAP:
+                f.seek(offset)
+                payload = zlib.decompress(f.read(length))
+                snapshots.append(decode_snapshot(payload, store, gitdir,
+                                                 indexes))
+    return snapshots, store
@@ -20,8 +20,32 @@
 
     Note that this will return the snapshot object
 
+    On Linux you can also call log.watch() to have inotify record which paths
+    change, so that the next snapshot only looks at those; log.watch(auto=True)
+    takes a snapshot by itself after each burst of changes.
+
+    Snapshots are incremental by default: a file whose stat record (size,
+    mtime, inode and ctime) is unchanged since the previous snapshot is not
+    re-read, and its Entry (and sha1) are reused. Pass incremental=False to
+    GitDirLog to force a full re-scan every time.
+
+    File contents are kept once per distinct sha1 in a BlobStore shared by
+    all of the log's snapshots, so older snapshots still have the contents of
+    files that have changed since. Create the log with keep_contents=False to
+    read contents lazily instead: a file is memory-mapped the first time an
+    entry's contents are asked for (as long as it has not changed since the
+    snapshot was taken) and that version is then added to the BlobStore.
+    Versions nobody looked at before the file changed are not kept.
+
 """
 import hashlib
+import mmap
+from bisect import bisect_left
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from os import path
 from os import walk
@@ -31,88 +55,360 @@ from gitutil.git_fs import GitIndex
 FILE = 'f'
 DIR = 'd'
 
+CHUNK_SIZE = 1 << 16  # bytes read (and hashed) at a time
+
+
+def sort_key(name):
+    """ Key that orders paths component by component, so that a directory is
+        immediately followed by everything under it
+    """
+    return name.replace('/', '\x00')
+
+
+def stat_key(st):
+    """ The part of a stat result that tells us whether a file has changed """
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+
+class BlobStore:
+    """ A content-addressed store of file contents keyed by sha1. Snapshots
+    that share a BlobStore hold each distinct file version only once.
+    """
+
+    def __init__(self):
+        self.blobs = {}
+
+    def add(self, sha1, contents):
+        """ Store contents under sha1 unless already present; return sha1 """
+        if sha1 not in self.blobs:
+            self.blobs[sha1] = contents
+        return sha1
+
+    def get(self, sha1, default=None):
+        return self.blobs.get(sha1, default)
+
+    def nbytes(self):
+        """ Total size of all stored contents """
+        return sum(len(b) for b in self.blobs.values())
+
+    def __contains__(self, sha1):
+        return sha1 in self.blobs
+
+    def __getitem__(self, sha1):
+        return self.blobs[sha1]
+
+    def __len__(self):
+        return len(self.blobs)
+
+
+def format_ns(ns):
+    """ Human readable form of a timestamp in nanoseconds """
+    return str(datetime.fromtimestamp(ns / 1e9))
+
 
 class Entry:
     """ An Entry represents either a file or a directory and stores information
     about the file such as the name, contents, hash, type, create date and
-    modified date.
+    modified date. Contents live in a BlobStore and are looked up by sha1; if
+    they were not kept they are mapped from disk on demand (see load()) and
+    added to the store.
+
+    Snapshots can hold hundreds of thousands of entries, so an Entry only
+    keeps what it needs: dates come from the raw stat record and are only
+    formatted when asked for.
     """
+    __slots__ = ('name', 'sha1', 'type', 'stat', 'store', 'view')
 
-    def __init__(self, name, contents=None, sha1=0, tp=DIR,
-                 cdate=None, mdate=None, uid=None, gid=None, perms=None):
+    def __init__(self, name, contents=None, sha1=0, tp=DIR, stat=None,
+                 store=None):
         self.name = name
-        self.contents = contents
+        if contents is not None:
+            if store is None:
+                store = BlobStore()
+            store.add(sha1, contents)
+        self.store = store
         self.sha1 = sha1
         self.type = tp
-        self.cdate = cdate
-        self.mdate = mdate
-        self.uid = uid
-        self.gid = gid
-        self.perms = perms
-
-        idx = name.index('.git')
-        self.short_name = name[idx:]
+        self.stat = stat  # see stat_key()
+        self.view = None  # the mapping made by load()
+
+    @property
+    def short_name(self):
+        return self.name[self.name.index('.git'):]
+
+    @property
+    def size(self):
+        return None if self.stat is None else self.stat[0]
+
+    @property
+    def mtime_ns(self):
+        return None if self.stat is None else self.stat[1]
+
+    @property
+    def ctime_ns(self):
+        return None if self.stat is None else self.stat[3]
+
+    @property
+    def cdate(self):
+        return None if self.stat is None else format_ns(self.stat[3])
+
+    @property
+    def mdate(self):
+        return None if self.stat is None else format_ns(self.stat[1])
+
+    @property
+    def contents(self):
+        """ The file's contents as bytes, or None if they were not kept and
+            the file has changed since this entry was recorded. Contents read
+            from disk are added to the store, so they outlive the file.
+        """
+        if self.store is not None and self.sha1 in self.store:
+            return self.store[self.sha1]
+        view = self.load()
+        if view is None:
+            return None
+        if self.store is None:
+            self.store = BlobStore()
+        return self.store[self.store.add(self.sha1, bytes(view))]
+
+    def load(self):
+        """ Read-only memoryview of this file's contents on disk (unlike
+            contents, which is always bytes), or None if the file is gone or
+            has changed since this entry was recorded. Files are
+            memory-mapped, so nothing is read until the view is used; the
+            view is made once and kept on the entry.
+        """
+        if self.view is None:
+            self.view = self.map_file()
+        return self.view
+
+    def read(self):
+        """ The file's contents from the store if they are there, otherwise
+            as load() but without keeping the view on the entry or storing
+            anything: for reading many files once (e.g. to save them). None
+            if they are not available.
+        """
+        if self.store is not None and self.sha1 in self.store:
+            return self.store[self.sha1]
+        if self.view is not None:
+            return self.view
+        return self.map_file()
+
+    def map_file(self):
+        """ A new memoryview of the file, or None (see load) """
+        if self.type != FILE or self.stat is None:
+            return None
+        try:
+            with open(self.name, 'rb') as afile:
+                st = os.fstat(afile.fileno())
+                if stat_key(st) != self.stat:
+                    return None
+                if st.st_size == 0:
+                    return memoryview(b'')
+                mapped = mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+        return memoryview(mapped)
 
     def __str__(self):
         return '[{}] {}'.format(self.type, self.short_name)
 
     def long_string(self):
-        return '[{}] {} : {} : {}'.format(self.type, self.short_name, self.sha1,
-                                          self.cdate, self.mdate)
+        return '[{}] {} : {} : {} : {}'.format(self.type, self.short_name,
+                                               self.sha1, self.cdate, self.mdate)
 
     def __repr__(self):
         return str(self)
 
     def __le__(self, other):
-        return self.name <= other.name
+        return sort_key(self.name) <= sort_key(other.name)
 
     def __lt__(self, other):
-        return self.name < other.name
+        return sort_key(self.name) < sort_key(other.name)
 
     def __gt__(self, other):
-        return self.name > other.name
+        return sort_key(self.name) > sort_key(other.name)
 
     def __ge__(self, other):
-        return self.name >= other.name
+        return sort_key(self.name) >= sort_key(other.name)
 
 
 class GitDirParser:
     """ Creates a time-indexed list of entries"""
     ext_to_ignore = ['swp']
-    entries = []
 
-    def __init__(self, mypath, verbose=True):
+    def __init__(self, mypath, previous=None, store=None, workers=None,
+                 keep_contents=True, changed=None):
+        """
+            mypath: the .git directory to parse. The index is parsed quietly;
+                show it with gitutil.index_report.render_index.
+            previous: optional GitDirSnapshot of the same directory. Files
+                whose stat record is unchanged since previous was taken are
+                not read again; their Entry is reused instead.
+            store: BlobStore to keep file contents in (default: a new one)
+            workers: number of threads used to read and hash files. None, 0
+                or 1 scans serially; either way the entries are the same.
+            keep_contents: store file contents in the BlobStore. If False
+                files are only streamed through the hasher, so memory use per
+                file is bounded by CHUNK_SIZE however large it is, and
+                Entry.contents is loaded from disk on demand (and then kept
+                in the store).
+            changed: optional collection of paths known to be the only ones
+                changed since previous (e.g. from a TreeWatcher). When given
+                along with previous, only those paths are looked at; every
+                other entry is carried over from previous.
+        """
         self.path = mypath
+        self.store = store if store is not None else BlobStore()
+        self.keep_contents = keep_contents
+        self.workers = workers
         self.index = None
+        self.entries = []
+        self.started = time.time_ns()
+        self.reused = 0
         if '.git' not in mypath:
             raise RuntimeError("Not a .git repository: " + mypath)
-        for (dirpath, dirnames, fnames) in walk(mypath):
+
+        self.old_entries = {}
+        self.old_index = None
+        self.racy_after = 0
+        if previous is not None:
+            self.old_entries = previous.entries
+            self.old_index = previous.index
+            self.racy_after = previous.started
+
+        # Directories are cheap so we record them as we walk; files are
+        # collected and scanned afterwards (possibly in parallel), then put
+        # back in the slots they were walked in.
+        self.slots = []
+        self.fnames_to_scan = []
+        if changed is not None and previous is not None:
+            self.collect_changed(previous, changed)
+        else:
+            self.collect_tree(mypath)
+
+        if workers is not None and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                scanned = list(pool.map(self.scan_file, self.fnames_to_scan))
+        else:
+            scanned = [self.scan_file(fname) for fname in self.fnames_to_scan]
+
+        for slot, (entry, reused) in zip(self.slots, scanned):
+            self.entries[slot] = entry
+            self.reused += reused
+        self.entries = [e for e in self.entries if e is not None]
+
+    def dir_entry(self, dname):
+        return Entry(dname, sha1=0, tp=DIR, stat=stat_key(os.stat(dname)))
+
+    def collect_tree(self, top):
+        """ Record every directory under top and queue every file to scan """
+        for (dirpath, dirnames, fnames) in walk(top):
             for d in dirnames:
-                dname = dirpath + '/' + d
-                cdt = str(datetime.fromtimestamp(path.getctime(dname)))
-                mdt = str(datetime.fromtimestamp(path.getmtime(dname)))
-                self.entries.append(Entry(dname, contents=None, sha1=0, tp=DIR,
-                                          cdate=cdt, mdate=mdt))
+                self.entries.append(self.dir_entry(path.join(dirpath, d)))
             for f in fnames:
-                fname = path.join(dirpath, f)
+                self.slots.append(len(self.entries))
+                self.fnames_to_scan.append(path.join(dirpath, f))
+                self.entries.append(None)
+
+    def collect_changed(self, previous, changed):
+        """ Carry previous's entries over, except for the changed paths (and
+            everything beneath them), which are looked at again. Directories
+            above a changed path get fresh entries too, since their rollup
+            hash and dates change.
+        """
+        root = self.path.rstrip('/')
+        keys = previous.keys
+        olds = list(previous.entries.values())
+        drop = set()
+        rescan = []
+        # In sort_key order a path's descendants directly follow it, so any
+        # path under the last one kept is already covered by it.
+        for p in sorted((p.rstrip('/') for p in changed), key=sort_key):
+            if p == root or not p.startswith(root + '/'):
+                continue
+            if rescan and p.startswith(rescan[-1] + '/'):
+                continue
+            key = sort_key(p)
+            lo = bisect_left(keys, key)
+            hi = bisect_left(keys, key + '\x01', lo)
+            drop.update(e.name for e in olds[lo:hi])
+            rescan.append(p)
+
+        refresh = set()
+        for p in rescan:
+            parent = path.dirname(p)
+            while parent != root and parent not in refresh:
+                refresh.add(parent)
+                parent = path.dirname(parent)
+        refresh.difference_update(rescan)
+
+        self.index = self.old_index
+        for entry in olds:
+            if entry.name not in drop and entry.name not in refresh:
+                self.entries.append(entry)
+        for d in sorted(refresh):
+            if path.isdir(d):
+                self.entries.append(self.dir_entry(d))
+        for p in rescan:
+            if path.isdir(p):
+                self.entries.append(self.dir_entry(p))
+                self.collect_tree(p)
+            elif path.exists(p):
+                self.slots.append(len(self.entries))
+                self.fnames_to_scan.append(p)
+                self.entries.append(None)
+
+    def scan_file(self, fname):
+        """ Read and hash a single file, or reuse its previous Entry if its
+            stat record is unchanged. Returns (entry, reused); entry is None
+            if the file could not be read.
+        """
+        try:
+            st = os.stat(fname)
+            key = stat_key(st)
+            old = self.old_entries.get(fname)
+            # A file modified after the previous scan started may have
+            # changed again within the same timestamp tick, so only
+            # trust its stat record if it is older than that scan.
+            if old is not None and old.type == FILE and old.stat == key \
+                    and st.st_mtime_ns < self.racy_after:
+                if fname.endswith('.git/index'):
+                    self.index = self.old_index
+                return old, True
+
+            is_index = fname.endswith('.git/index')
+            keep = self.keep_contents or is_index
+            sha1hasher = hashlib.sha1()
+            chunks = []
+            with open(fname, 'rb') as afile:
+                chunk = afile.read(CHUNK_SIZE)
+                while chunk:
+                    sha1hasher.update(chunk)
+                    if keep:
+                        chunks.append(chunk)
+                    chunk = afile.read(CHUNK_SIZE)
+            sha1 = sha1hasher.hexdigest()
+
+            contents = None
+            if keep:
+                contents = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+            if is_index:
                 try:
-                    with open(fname, 'rb') as afile:
-                        contents = afile.read()
-                        if fname.endswith('.git/index'):
-                            self.index = GitIndex(contents, verbose)
-                        contents = str(contents).encode('utf-8')
-
-                    sha1hasher = hashlib.sha1()
-                    sha1hasher.update(contents)
-                    sha1 = sha1hasher.hexdigest()
-                    cdt = str(datetime.fromtimestamp(path.getctime(fname)))
-                    mdt = str(datetime.fromtimestamp(path.getmtime(fname)))
-                    self.entries.append(Entry(fname, contents, sha1, tp=FILE,
-                                              cdate=cdt, mdate=mdt))
-                except Exception as e:
-                    print("Error reading fname: " + fname + '. ' + dirpath, dirnames, fnames)
-                    import traceback
-                    traceback.print_exc()
+                    self.index = GitIndex(contents, False, self.workers,
+                                          self.old_index)
+                except (ValueError, struct.error) as e:
+                    print("Could not parse index {}: {}".format(fname, e))
+                if not self.keep_contents:
+                    contents = None
+
+            return Entry(fname, contents, sha1, tp=FILE, stat=key,
+                         store=self.store), False
+        except Exception as e:
+            print("Error reading fname: " + fname)
+            import traceback
+            traceback.print_exc()
+            return None, False
 
 
 class DiffObject:
@@ -133,34 +429,52 @@ class DiffObject:
         static = []
 
         if fst is None:
-            for key in snd.entries.keys():
-                created.append(snd.entries[key])
+            created.extend(snd.entries.values())
 
-        else:
-            fstkeys = fst.entries.keys()
-            sndkeys = snd.entries.keys()
-            allkeys = set(fstkeys).union(set(sndkeys))
-
-            for key in allkeys:
-                if key not in fstkeys:
-                    # key must be in self.entries and hence created
-                    created.append(snd.entries[key])
+        elif fst.sha1 == snd.sha1:
+            static.extend(snd.entries.values())
 
-                elif key not in sndkeys:
-                    removed.append(fst.entries[key])
-
-                elif key in sndkeys and key in fstkeys:
-                    new, old = snd.entries[key], fst.entries[key]
-                    if new.type == 'd' and old.type == 'd':
+        else:
+            # Both snapshots keep their entries sorted by sort_key, so a single
+            # merge pass finds every difference and keeps each list in order.
+            # Directories carry a rollup hash of their contents (see
+            # GitDirSnapshot.rollup), which lets us skip unchanged subtrees.
+            fkeys, skeys = fst.keys, snd.keys
+            fentries = list(fst.entries.values())
+            sentries = list(snd.entries.values())
+            i, j = 0, 0
+            flen, slen = len(fkeys), len(skeys)
+            while i < flen and j < slen:
+                fkey, skey = fkeys[i], skeys[j]
+                if fkey < skey:
+                    removed.append(fentries[i])
+                    i += 1
+                elif skey < fkey:
+                    created.append(sentries[j])
+                    j += 1
+                else:
+                    new, old = sentries[j], fentries[i]
+                    if new.type == DIR and old.type == DIR \
+                            and new.sha1 == old.sha1:
+                        # Identical rollup hashes: nothing under this
+                        # directory changed, so jump past the whole subtree.
+                        end = skey + '\x01'
+                        iend = bisect_left(fkeys, end, i + 1)
+                        jend = bisect_left(skeys, end, j + 1)
+                        static.extend(sentries[j:jend])
+                        i, j = iend, jend
+                        continue
+                    elif new.type == DIR and old.type == DIR:
+                        static.append(new)
+                    elif new.type == FILE and old.type == FILE \
+                            and new.sha1 == old.sha1:
                         static.append(new)
-
-                    elif new.type == 'f' and old.type == 'f':
-                        if new.sha1 == old.sha1:
-                            static.append(new)
-                        else:
-                            modified.append(new)
                     else:
                         modified.append(new)
+                    i += 1
+                    j += 1
+            removed.extend(fentries[i:])
+            created.extend(sentries[j:])
 
         self.created = created
         self.removed = removed
@@ -180,18 +494,18 @@ class DiffObject:
         print('+' + '-' * 78 + '+')
 
         print('| created [{}]:'.format(len(self.created)))
-        for o in sorted(self.created):
+        for o in self.created:
             print('|    ', o)
         print('| modified [{}]:'.format(len(self.modified)))
-        for o in sorted(self.modified):
+        for o in self.modified:
             print('|    ', o)
         print('| removed [{}]:'.format(len(self.removed)))
-        for o in sorted(self.removed):
+        for o in self.removed:
             print('|    ', o)
 
         if not updated_only:
             print('| static [{}]:'.format(len(self.static)))
-            for o in sorted(self.static):
+            for o in self.static:
                 print('|    ', o)
         print('+' + '-' * 78 + '+')
 
@@ -201,17 +515,82 @@ class GitDirSnapshot:
         GitDirSnapshot holds a snapshot of the .git directory. This is the raw
         content and has little semantic meaning without being processed by a
         GitDir instance
+
+        entries maps each path to its Entry, in sort_key order; keys holds the
+        matching sort keys. Each directory entry's sha1 is a rollup of its
+        children (like a git tree), and sha1 is the rollup of the whole
+        directory, so equal hashes mean equal contents.
     """
 
-    def __init__(self, dir_to_parse, message='', verbose=True):
+    def __init__(self, dir_to_parse, message='', previous=None, store=None,
+                 workers=None, keep_contents=True, changed=None):
+        """
+            dir_to_parse: the .git directory to snapshot
+            message: a description of this snapshot
+            previous: optional earlier snapshot of dir_to_parse to reuse
+                unchanged entries from (see GitDirParser)
+            store: BlobStore shared with other snapshots (default: a new one)
+            workers: threads used to read and hash files (see GitDirParser)
+            keep_contents: keep file contents, not just their sha1
+            changed: the only paths changed since previous (see GitDirParser)
+        """
         self.entries = {}
+        self.path = dir_to_parse
         if message:
             self.message = message
         else:
             self.message = "{}".format(datetime.now().strftime('%m/%d/%y %H:%M:%S'))
-        gdp = GitDirParser(dir_to_parse, verbose)
-        for entry in gdp.entries:
+        gdp = GitDirParser(dir_to_parse, previous, store, workers,
+                           keep_contents, changed)
+        self.store = gdp.store
+        self.index = gdp.index
+        self.started = gdp.started
+        keyed = sorted((sort_key(entry.name), entry) for entry in gdp.entries)
+        self.keys = [key for key, _ in keyed]
+        for _, entry in keyed:
             self.entries[entry.name] = entry
+        self.sha1 = self.rollup(dir_to_parse)
+
+    @classmethod
+    def from_entries(cls, dir_parsed, message, entries, sha1, started,
+                     index=None, store=None):
+        """ Rebuild a snapshot from already sorted entries and their rollup
+            hashes (e.g. when loading one from disk) without parsing anything
+        """
+        snap = cls.__new__(cls)
+        snap.path = dir_parsed
+        snap.message = message
+        snap.store = store
+        snap.index = index
+        snap.started = started
+        snap.entries = {}
+        snap.keys = []
+        for entry in entries:
+            snap.entries[entry.name] = entry
+            snap.keys.append(sort_key(entry.name))
+        snap.sha1 = sha1
+        return snap
+
+    def rollup(self, root):
+        """ Set each directory entry's sha1 to a hash of its children's types,
+            names and sha1s, and return the hash for root itself
+        """
+        children = {}
+        # Children sort after their parent, so walking backwards finishes
+        # every directory's children before reaching the directory.
+        for entry in reversed(list(self.entries.values())):
+            if entry.type == DIR:
+                lines = children.pop(entry.name, [])
+                lines.reverse()
+                entry.sha1 = hashlib.sha1(''.join(lines).encode('utf-8',
+                                          'surrogateescape')).hexdigest()
+            parent, name = path.split(entry.name)
+            children.setdefault(parent, []).append(
+                '{} {} {}\n'.format(entry.type, name, entry.sha1))
+        lines = children.pop(root.rstrip('/'), [])
+        lines.reverse()
+        return hashlib.sha1(''.join(lines).encode('utf-8',
+                            'surrogateescape')).hexdigest()
 
     def parse_git_directory(self, dir_to_parse):
         pass
@@ -220,7 +599,7 @@ class GitDirSnapshot:
         """ assuming that self is newer than other, calculate the difference
             in the .git directory tree
         """
-        pass
+        return DiffObject(other, self)
 
     def __str__(self):
         return 'Snapshot[{}]'.format(self.message)
@@ -232,38 +611,155 @@ class GitDirSnapshot:
 class GitDirLog:
     """ Takes a snapshot of the .git directory """
 
-    def __init__(self, gitdir, autodiff=True):
+    def __init__(self, gitdir, autodiff=True, incremental=True, workers=None,
+                 keep_contents=True):
         """
             gitdir: directory to track
             autodiff: track diffs (and print them) automatically
+            incremental: reuse unchanged entries from the last snapshot
+                instead of re-reading every file
+            workers: default number of threads used to read and hash files
+                (None scans serially)
+            keep_contents: keep every version of file contents in the log's
+                BlobStore as it is scanned. If False contents are loaded
+                lazily from disk, and only the versions that are looked at
+                are kept.
         """
         self.snapshots = []
         self.gitdir = gitdir
         self.autodiff = autodiff
+        self.incremental = incremental
+        self.workers = workers
+        self.keep_contents = keep_contents
+        self.blobs = BlobStore()
         self.diffs = None  # Default, we don't store diffs
+        self.watcher = None
+        self.auto = False
+        self.auto_verbose = True
+        self.debounce = 0.5
+        self.timer = None
+        self.lock = threading.RLock()
 
         if autodiff:
             self.diffs = []
 
-    def take_snapshot(self, message='', verbose=True):
-        snap = GitDirSnapshot(self.gitdir, message, verbose)
-        self.snapshots.append(snap)
-        if self.autodiff:
-            if len(self.snapshots) > 1:
-                s1, s2 = self.snapshots[-2:]
-            else:
-                s1, s2 = None, self.snapshots[-1]
-            diff = DiffObject(s1, s2)
-            self.diffs.append(diff)
-            if verbose:
-                diff.print_diff()
+    def take_snapshot(self, message='', verbose=True, workers=None):
+        """
+            message: a description of the snapshot
+            verbose: print the resulting diff
+            workers: override the log's number of scanning threads
+        """
+        with self.lock:
+            if workers is None:
+                workers = self.workers
+            previous = None
+            changed = None
+            if (self.incremental or self.watcher) and self.snapshots:
+                previous = self.snapshots[-1]
+            if self.watcher is not None:
+                changed, overflowed = self.watcher.drain()
+                if overflowed:
+                    changed = None  # Events were lost; look at everything
+            snap = GitDirSnapshot(self.gitdir, message, previous, self.blobs,
+                                  workers, self.keep_contents, changed)
+            self.snapshots.append(snap)
+            if self.autodiff:
+                if len(self.snapshots) > 1:
+                    s1, s2 = self.snapshots[-2:]
+                else:
+                    s1, s2 = None, self.snapshots[-1]
+                diff = DiffObject(s1, s2)
+                self.diffs.append(diff)
+                if verbose:
+                    diff.print_diff()
+
+            return snap
+
+    def watch(self, auto=False, debounce=0.5, verbose=True):
+        """
+            Use inotify (Linux only) to track which paths under gitdir change,
+            so that later snapshots only look at those paths.
 
-        return snap
+            auto: take a snapshot automatically once changes stop arriving
+            debounce: seconds without events before an automatic snapshot;
+                this groups the burst of changes made by one git command
+            verbose: print the diffs of automatic snapshots
+        """
+        from utils.inotify import TreeWatcher
+        with self.lock:
+            self.unwatch()
+            self.auto = auto
+            self.auto_verbose = verbose
+            self.debounce = debounce
+            self.watcher = TreeWatcher(self.gitdir, self._on_change)
+            if not self.snapshots:
+                # Changes are tracked relative to the last snapshot
+                self.take_snapshot('watch started', verbose)
+
+    def unwatch(self):
+        """ Stop watching gitdir for changes """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+
+    def _on_change(self):
+        if not self.auto:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(self.debounce, self._auto_snapshot)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _auto_snapshot(self):
+        with self.lock:
+            if self.watcher is not None and self.watcher.pending():
+                self.take_snapshot(verbose=self.auto_verbose)
+
+    def save(self, filename, contents=True):
+        """
+            Append this log's snapshots to a snapshot log file (see
+            snapshot_log.py). The file is assumed to hold this log's earlier
+            snapshots, so only the ones it does not have yet are written.
+
+            contents: also save file contents that are still available
+        """
+        from snapshot_log import SnapshotLogWriter
+        with self.lock:
+            writer = SnapshotLogWriter(filename)
+            writer.append(self.snapshots[writer.snapshot_count:], contents)
+
+    @classmethod
+    def load(cls, filename, gitdir=None, **kwargs):
+        """
+            Load a GitDirLog saved with save(). Nothing is re-scanned; new
+            snapshots taken with the loaded log are incremental on its last
+            snapshot.
+
+            gitdir: directory to track from now on (default: the saved one)
+            kwargs: passed to GitDirLog
+        """
+        from snapshot_log import read_log
+        snapshots, store = read_log(filename, gitdir)
+        if gitdir is None:
+            if not snapshots:
+                raise RuntimeError("Empty snapshot log: " + filename)
+            gitdir = snapshots[-1].path
+        log = cls(gitdir, **kwargs)
+        log.snapshots = snapshots
+        log.blobs = store
+        if log.autodiff:
+            log.diffs = log.compute_diffs()
+        return log
 
     def compute_diffs(self):
         diffs = []
         if len(self.snapshots) > 0:
-            s1, s2 = None, self.snapshots[-1]
+            s1, s2 = None, self.snapshots[0]
             diffs = [DiffObject(s1, s2)]  # Seed initial diff
         for i in range(1, len(self.snapshots)):
             s1, s2 = self.snapshots[i - 1], self.snapshots[i]
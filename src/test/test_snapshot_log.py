@@ -0,0 +1,92 @@
+import os
+import tempfile
+from unittest import TestCase
+from os.path import join
+
+from gitutil.session import GitSession
+from snapshots import GitDirLog, FILE
+
+
+class TestSnapshotLog(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        self.gitdir = join(self.dir, '.git')
+        fd, self.logfile = tempfile.mkstemp(suffix='.hoglog')
+        os.close(fd)
+
+    def tearDown(self):
+        self.session.cleanup()
+        os.remove(self.logfile)
+
+    def write(self, name, contents):
+        with open(join(self.dir, name), 'w') as f:
+            f.write(contents)
+
+    def take_snapshots(self, log):
+        log.take_snapshot('empty', verbose=False)
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log.take_snapshot('added f1', verbose=False)
+        self.session.repo().index.commit('first commit')
+        log.take_snapshot('committed', verbose=False)
+
+    def assertSameSnapshots(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for s1, s2 in zip(expected, actual):
+            self.assertEqual(s1.message, s2.message)
+            self.assertEqual(s1.sha1, s2.sha1)
+            self.assertEqual(list(s1.entries), list(s2.entries))
+            for name, e1 in s1.entries.items():
+                e2 = s2.entries[name]
+                self.assertEqual((e1.type, e1.sha1, e1.stat),
+                                 (e2.type, e2.sha1, e2.stat))
+
+    def test_save_and_load(self):
+        log = GitDirLog(self.gitdir, keep_contents=True)
+        self.take_snapshots(log)
+        log.save(self.logfile)
+
+        loaded = GitDirLog.load(self.logfile)
+        self.assertEqual(self.gitdir, loaded.gitdir)
+        self.assertSameSnapshots(log.snapshots, loaded.snapshots)
+        for d1, d2 in zip(log.diffs, loaded.diffs):
+            self.assertEqual([e.name for e in d1.created], [e.name for e in d2.created])
+            self.assertEqual([e.name for e in d1.modified], [e.name for e in d2.modified])
+        for name, entry in log.snapshots[1].entries.items():
+            if entry.type == FILE:
+                self.assertEqual(entry.contents, loaded.snapshots[1].entries[name].contents)
+        self.assertEqual(len(log.snapshots[-1].index.indexEntries),
+                         len(loaded.snapshots[-1].index.indexEntries))
+
+    def test_save_appends(self):
+        log = GitDirLog(self.gitdir)
+        self.take_snapshots(log)
+        log.save(self.logfile)
+        size = os.path.getsize(self.logfile)
+        log.save(self.logfile)
+        self.assertEqual(size, os.path.getsize(self.logfile))
+
+        self.write('f2', 'This is file 2')
+        self.session.git.add('f2')
+        log.take_snapshot('added f2', verbose=False)
+        log.save(self.logfile)
+        self.assertSameSnapshots(log.snapshots, GitDirLog.load(self.logfile).snapshots)
+
+    def test_save_without_keeping_contents(self):
+        """ Saving a log that does not keep contents reads each file from
+            disk without holding on to it
+        """
+        log = GitDirLog(self.gitdir, keep_contents=False)
+        self.take_snapshots(log)
+        log.save(self.logfile)
+        self.assertEqual(0, len(log.blobs))
+        for snap in log.snapshots:
+            self.assertTrue(all(e.view is None for e in snap.entries.values()))
+
+        loaded = GitDirLog.load(self.logfile)
+        self.assertSameSnapshots(log.snapshots, loaded.snapshots)
+        for name, entry in log.snapshots[-1].entries.items():
+            if entry.type == FILE:
+                self.assertEqual(entry.contents, loaded.snapshots[-1].entries[name].contents)
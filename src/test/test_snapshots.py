@@ -0,0 +1,227 @@
+import hashlib
+import os
+import time
+from datetime import datetime
+from unittest import TestCase
+from os.path import join
+
+from gitutil.session import GitSession
+from snapshots import GitDirLog, FILE
+
+
+class TestGitDirLog(TestCase):
+
+    def setUp(self):
+        self.session = GitSession()
+        self.dir = self.session.dir()
+        self.gitdir = join(self.dir, '.git')
+
+    def tearDown(self):
+        self.session.cleanup()
+
+    def write(self, name, contents):
+        with open(join(self.dir, name), 'w') as f:
+            f.write(contents)
+
+    def test_incremental_snapshot_reuses_unchanged_entries(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir)
+        s1 = log.take_snapshot('first', verbose=False)
+        s2 = log.take_snapshot('second', verbose=False)
+
+        self.assertEqual(set(s1.entries), set(s2.entries))
+        for name, entry in s2.entries.items():
+            if entry.type == FILE:
+                self.assertIs(s1.entries[name], entry)
+
+    def test_incremental_snapshot_sees_changes(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir)
+        log.take_snapshot('first', verbose=False)
+        self.write('f2', 'This is file 2')
+        self.session.git.add('f2')
+        log.take_snapshot('second', verbose=False)
+
+        incremental = log.diffs[-1]
+        full = GitDirLog(self.gitdir, incremental=False)
+        full.take_snapshot('full', verbose=False)
+        modified = [e.short_name for e in incremental.modified]
+        self.assertIn('.git/index', modified)
+        self.assertEqual(len(full.snapshots[-1].entries),
+                         len(log.snapshots[-1].entries))
+        for name, entry in full.snapshots[-1].entries.items():
+            self.assertEqual(entry.sha1, log.snapshots[-1].entries[name].sha1)
+
+    def test_snapshots_share_blob_store(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir, incremental=False, keep_contents=True)
+        s1 = log.take_snapshot('first', verbose=False)
+        blobs = len(log.blobs)
+        s2 = log.take_snapshot('second', verbose=False)
+
+        self.assertEqual(blobs, len(log.blobs))
+        for name, entry in s2.entries.items():
+            if entry.type == FILE:
+                self.assertIs(log.blobs, entry.store)
+            self.assertEqual(s1.entries[name].contents, entry.contents)
+
+    def test_parallel_scan_matches_serial_scan(self):
+        for i in range(20):
+            self.write('f{}'.format(i), 'This is file {}'.format(i))
+        self.session.git.add('.')
+        self.session.repo().index.commit('first commit')
+
+        serial = GitDirLog(self.gitdir).take_snapshot('serial', verbose=False)
+        parallel = GitDirLog(self.gitdir, workers=4).take_snapshot('parallel',
+                                                                   verbose=False)
+        self.assertEqual(list(serial.entries), list(parallel.entries))
+        for name, entry in serial.entries.items():
+            self.assertEqual(entry.sha1, parallel.entries[name].sha1)
+            self.assertEqual(entry.contents, parallel.entries[name].contents)
+
+    def test_sha1_is_hash_of_raw_contents(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir, keep_contents=True)
+        snap = log.take_snapshot('first', verbose=False)
+        head = snap.entries[join(self.gitdir, 'HEAD')]
+        with open(join(self.gitdir, 'HEAD'), 'rb') as f:
+            raw = f.read()
+        self.assertEqual(raw, head.contents)
+        self.assertEqual(hashlib.sha1(raw).hexdigest(), head.sha1)
+
+    def test_lazy_contents(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir, keep_contents=False)
+        snap = log.take_snapshot('first', verbose=False)
+        full = GitDirLog(self.gitdir)
+        full = full.take_snapshot('full', verbose=False)
+
+        self.assertEqual(0, len(log.blobs))
+        self.assertIsNotNone(snap.index)
+        files = 0
+        for name, entry in snap.entries.items():
+            self.assertEqual(full.entries[name].sha1, entry.sha1)
+            if entry.type == FILE:
+                files += 1
+                self.assertEqual(full.entries[name].contents, entry.contents)
+                self.assertIsInstance(entry.contents, bytes)
+        # What was read is kept, and the mapping is made once
+        self.assertEqual(files, len(log.blobs))
+        head = snap.entries[join(self.gitdir, 'HEAD')]
+        self.assertIs(head.load(), head.load())
+
+    def test_lazy_contents_of_changed_file(self):
+        log = GitDirLog(self.gitdir, keep_contents=False)
+        snap = log.take_snapshot('first', verbose=False)
+        head = snap.entries[join(self.gitdir, 'HEAD')]
+        config = snap.entries[join(self.gitdir, 'config')]
+        old_config = config.contents
+        with open(join(self.gitdir, 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/some-other-branch\n')
+        with open(join(self.gitdir, 'config'), 'a') as f:
+            f.write('[hog]\n')
+        self.assertIsNone(head.contents)
+        # Read before it changed, so that version was kept
+        self.assertEqual(old_config, config.contents)
+
+    def test_contents_history_kept_by_default(self):
+        log = GitDirLog(self.gitdir)
+        snap = log.take_snapshot('first', verbose=False)
+        head = snap.entries[join(self.gitdir, 'HEAD')]
+        with open(join(self.gitdir, 'HEAD'), 'rb') as f:
+            old = f.read()
+        with open(join(self.gitdir, 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/some-other-branch\n')
+        log.take_snapshot('second', verbose=False)
+        self.assertEqual(old, head.contents)
+        self.assertIn(head.sha1, log.blobs)
+
+    def test_diff_categories_are_ordered(self):
+        log = GitDirLog(self.gitdir)
+        s1 = log.take_snapshot('first', verbose=False)
+        for i in range(5):
+            self.write('f{}'.format(i), 'This is file {}'.format(i))
+        self.session.git.add('.')
+        self.session.repo().index.commit('first commit')
+        s2 = log.take_snapshot('second', verbose=False)
+
+        diff = s2.diff(s1)
+        created = set(s2.entries) - set(s1.entries)
+        removed = set(s1.entries) - set(s2.entries)
+        self.assertEqual(created, {e.name for e in diff.created})
+        self.assertEqual(removed, {e.name for e in diff.removed})
+        for entries in (diff.created, diff.modified, diff.removed, diff.static):
+            self.assertEqual(sorted(entries), entries)
+        self.assertEqual(len(s2.entries),
+                         len(diff.created) + len(diff.modified) + len(diff.static))
+
+    def test_directory_rollup(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir)
+        s1 = log.take_snapshot('first', verbose=False)
+        s2 = log.take_snapshot('second', verbose=False)
+        self.assertEqual(s1.sha1, s2.sha1)
+        self.assertEqual(len(s2.entries), len(s2.diff(s1).static))
+
+        self.write('f2', 'This is file 2')
+        self.session.git.add('f2')
+        s3 = log.take_snapshot('third', verbose=False)
+        self.assertNotEqual(s2.sha1, s3.sha1)
+        refs = join(self.gitdir, 'refs')
+        objects = join(self.gitdir, 'objects')
+        self.assertEqual(s2.entries[refs].sha1, s3.entries[refs].sha1)
+        self.assertNotEqual(s2.entries[objects].sha1, s3.entries[objects].sha1)
+
+        diff = s3.diff(s2)
+        self.assertIn(join(self.gitdir, 'index'), [e.name for e in diff.modified])
+        self.assertEqual(len(s3.entries),
+                         len(diff.created) + len(diff.modified) + len(diff.static))
+
+    def test_watched_snapshot_matches_full_scan(self):
+        self.write('f1', 'This is file 1')
+        self.session.git.add('f1')
+        log = GitDirLog(self.gitdir)
+        log.watch()
+        try:
+            self.write('f2', 'This is file 2')
+            self.session.git.add('f2')
+            self.session.repo().index.commit('first commit')
+            self.session.git.branch('new-branch')
+            time.sleep(0.2)
+            watched = log.take_snapshot('watched', verbose=False)
+        finally:
+            log.unwatch()
+
+        full = GitDirLog(self.gitdir).take_snapshot('full', verbose=False)
+        self.assertEqual(list(full.entries), list(watched.entries))
+        self.assertEqual(full.sha1, watched.sha1)
+
+    def test_auto_snapshot(self):
+        log = GitDirLog(self.gitdir)
+        log.watch(auto=True, debounce=0.1, verbose=False)
+        try:
+            self.write('f1', 'This is file 1')
+            self.session.git.add('f1')
+            deadline = time.time() + 5
+            while len(log.snapshots) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            log.unwatch()
+        self.assertGreaterEqual(len(log.snapshots), 2)
+        self.assertIn(join(self.gitdir, 'index'), log.snapshots[-1].entries)
+
+    def test_entry_dates_come_from_stat(self):
+        snap = GitDirLog(self.gitdir).take_snapshot('first', verbose=False)
+        name = join(self.gitdir, 'HEAD')
+        head = snap.entries[name]
+        st = os.stat(name)
+        self.assertFalse(hasattr(head, '__dict__'))
+        self.assertEqual(st.st_mtime_ns, head.mtime_ns)
+        self.assertEqual(str(datetime.fromtimestamp(st.st_mtime_ns / 1e9)), head.mdate)
+        self.assertEqual('.git/HEAD', head.short_name)
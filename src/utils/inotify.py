@@ -0,0 +1,174 @@
+"""
+inotify.py: a small ctypes wrapper around Linux inotify that watches a
+directory tree and records which paths changed.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class TreeWatcher:
+    """
+    Watches every directory under root and collects the paths that were
+    created, modified, moved or deleted. Events are read on a background
+    thread; call drain() to fetch (and clear) the paths changed so far.
+    """
+
+    def __init__(self, root, on_change=None):
+        """
+        :param root: directory to watch (recursively)
+        :param on_change: optional callable invoked (on the watcher thread)
+        with no arguments after each batch of events
+        """
+        self.libc = _load_libc()
+        self.root = root
+        self.on_change = on_change
+        self.changed = set()
+        self.overflowed = False
+        self.lock = threading.Lock()
+        self.watches = {}  # wd -> directory path
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self._stop_r, self._stop_w = os.pipe()
+        self.add_tree(root)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_tree(self, top):
+        """ Watch top and every directory beneath it """
+        for (dirpath, dirnames, fnames) in os.walk(top):
+            try:
+                wd = _check(self.libc.inotify_add_watch(
+                    self.fd, os.fsencode(dirpath), WATCH_MASK))
+            except OSError:
+                continue  # Removed while we were walking
+            self.watches[wd] = dirpath
+
+    def drain(self):
+        """
+        Return the set of paths changed since the last drain, and whether
+        the kernel dropped events (in which case the set is incomplete and
+        the whole tree should be rescanned).
+        """
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            overflowed, self.overflowed = self.overflowed, False
+        return changed, overflowed
+
+    def pending(self):
+        """ True if there are changes that have not been drained yet """
+        with self.lock:
+            return bool(self.changed) or self.overflowed
+
+    def stop(self):
+        """ Stop watching and release the inotify descriptor """
+        if self.fd is None:
+            return
+        os.write(self._stop_w, b'x')
+        self.thread.join()
+        os.close(self.fd)
+        os.close(self._stop_r)
+        os.close(self._stop_w)
+        self.fd = None
+
+    def _run(self):
+        while True:
+            ready, _, _ = select.select([self.fd, self._stop_r], [], [])
+            if self._stop_r in ready:
+                return
+            try:
+                buf = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                continue
+            self._handle(buf)
+            if self.on_change is not None:
+                self.on_change()
+
+    def _handle(self, buf):
+        changed = []
+        new_dirs = []
+        overflowed = False
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dirpath = self.watches.get(wd)
+            if dirpath is None:
+                continue
+            if name:
+                p = os.path.join(dirpath, os.fsdecode(name))
+            else:
+                p = dirpath
+            changed.append(p)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_dirs.append(p)
+
+        # Anything created in a new directory before its watch was added
+        # would otherwise be missed; the directory itself is already marked
+        # changed, so its contents will be rescanned.
+        for d in new_dirs:
+            self.add_tree(d)
+
+        with self.lock:
+            self.changed.update(changed)
+            self.overflowed = self.overflowed or overflowed